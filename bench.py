@@ -0,0 +1,1067 @@
+"""قياسات أداء بوت نُور الذِّكْر
+
+الاستخدام:
+    python bench.py store [--ops N] [--users N]
+    python bench.py stress [--threads 1,2,4,8] [--taps N] [--io-ms MS] [--switch-interval-us US]
+    python bench.py render [--renders N]
+    python bench.py memory [--users 1000000,5000000] [--dict-max N]
+    python bench.py leaderboard [--users N] [--taps N] [--query-rate R]
+    python bench.py coldstart [--users N] [--tail-ops N]
+    python bench.py load [--users N] [--taps N] [--latency-ms MS] [--rate-limit-ratio R] [--tap-rate R] [--api-rate R] [--runtime threads|async]
+    python bench.py shards [--workers 1,2,4] [--users N] [--taps N]
+    python bench.py router [--updates N] [--repeat N]
+    python bench.py export [--users N] [--backend columnar|memory] [--tap-threads N]
+    python bench.py replay LOG... [--speed 1x|10x|max] [--limit N] [--latency-ms MS] [--api-rate R]
+    python bench.py gateway [--users N] [--taps N] [--broadcast-users N] [--telegram-rate R] [--api-rate R]
+"""
+import os
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# البوت يتطلب رمزاً صالح الشكل عند الاستيراد، ولا يتم أي اتصال بتليجرام هنا
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+import telebot
+import tast3
+from telebot import types
+
+
+def report(name, ops, elapsed):
+    print(f"{name:<28} {ops:>10} ops  {elapsed:8.3f}s  {ops / elapsed:>12,.0f} ops/s")
+
+
+def run_increments(store, ops, users):
+    """زيادة العدادات بنفس نمط handle_dhikr_callback (قراءة ثم تحديث)"""
+    for user_id in range(users):
+        store.initialize(user_id, user_id)
+    start = time.perf_counter()
+    for i in range(ops):
+        user_id = i % users
+        data = store.get(user_id)
+        data['subhan_count'] += 1
+        data['total_count'] += 1
+        store.update(user_id, data)
+    return time.perf_counter() - start
+
+
+def bench_store(args):
+    """مقارنة الزيادات المستمرة في الثانية بين التخزين في الذاكرة وSQLite"""
+    memory = tast3.MemoryUserStore({}, {}, threading.Lock())
+    report('memory', args.ops, run_increments(memory, args.ops, args.users))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = tast3.SQLiteUserStore(
+            os.path.join(tmp, 'bench.db'), {}, {}, threading.Lock(),
+            flush_ms=args.flush_ms, flush_ops=args.flush_ops
+        )
+        elapsed = run_increments(store, args.ops, args.users)
+        report('sqlite (write-behind)', args.ops, elapsed)
+        start = time.perf_counter()
+        store.close()
+        print(f"{'sqlite final flush':<28} {time.perf_counter() - start:.3f}s, "
+              f"{store.flushes} flushes, {store.rows_written} rows written")
+
+
+def legacy_tap(store, user_id, key):
+    """النمط القديم: نسخ البيانات ثم الزيادة خارج القفل ثم الكتابة (يفقد الزيادات المتزامنة)"""
+    data = store.get(user_id)
+    time.sleep(0)  # إتاحة تبديل الخيوط كما يحدث بين استدعاءين حقيقيين
+    data[key] += 1
+    data['total_count'] += 1
+    store.update(user_id, data)
+
+
+def atomic_tap(store, user_id, key):
+    store.increment(user_id, key)
+
+
+def run_stress(tap, threads, taps_per_thread, users, io_seconds):
+    """تشغيل عدة خيوط تنقر على نفس المستخدمين؛ زمن الإدخال/الإخراج يحاكي استدعاءات API في المعالج"""
+    store = tast3.MemoryUserStore({}, {}, threading.Lock())
+    for user_id in range(users):
+        store.initialize(user_id, user_id)
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        barrier.wait()
+        # كل الخيوط تمر على المستخدمين بنفس الترتيب فتتزاحم على نفس المستخدم في نفس اللحظة
+        for i in range(taps_per_thread):
+            tap(store, i % users, 'subhan_count')
+            if io_seconds:
+                time.sleep(io_seconds)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = sum(store.get(user_id)['total_count'] for user_id in range(users))
+    return elapsed, threads * taps_per_thread - total
+
+
+def bench_stress(args):
+    """التحقق من عدم فقدان أي زيادة تحت التزامن وقياس توسع الإنتاجية مع عدد الخيوط"""
+    print(f"{args.users} users, {args.taps} taps/thread, simulated handler I/O {args.io_ms}ms, "
+          f"switch interval {args.switch_interval_us}us")
+    # فترة تبديل قصيرة جداً تجعل تداخل الخيوط بين القراءة والكتابة شبه مؤكد في الطريقتين
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(args.switch_interval_us / 1e6)
+    failed = False
+    race_shown = False
+    try:
+        for threads in [int(t) for t in args.threads.split(',')]:
+            for name, tap in (('legacy get/update', legacy_tap), ('atomic increment', atomic_tap)):
+                elapsed, lost = run_stress(tap, threads, args.taps, args.users, args.io_ms / 1000.0)
+                report(f"{name} x{threads}", threads * args.taps, elapsed)
+                print(f"{'':<28} lost updates: {lost}")
+                if tap is atomic_tap and lost:
+                    failed = True
+                if tap is legacy_tap and lost:
+                    race_shown = True
+    finally:
+        sys.setswitchinterval(switch_interval)
+    if not race_shown:
+        print("legacy get/update lost no updates in this run: the race was not reproduced")
+    if failed:
+        raise SystemExit("atomic increment lost updates")
+
+
+def legacy_main_keyboard(counters):
+    """بناء لوحة المفاتيح كما كانت قبل ذاكرة العرض: كائنات جديدة ثم تحويل إلى JSON"""
+    subhan, alhamdulillah, la_ilaha, allahu_akbar = counters
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        types.InlineKeyboardButton(f"سبحان الله ({subhan})", callback_data="dhikr_subhan"),
+        types.InlineKeyboardButton(f"الحمد لله ({alhamdulillah})", callback_data="dhikr_alhamdulillah")
+    )
+    keyboard.add(
+        types.InlineKeyboardButton(f"لا إله إلا الله ({la_ilaha})", callback_data="dhikr_la_ilaha"),
+        types.InlineKeyboardButton(f"الله اكبر ({allahu_akbar})", callback_data="dhikr_allahu_akbar")
+    )
+    keyboard.add(
+        types.InlineKeyboardButton("📊 عرض إحصائياتي", callback_data="show_stats"),
+        types.InlineKeyboardButton("🗑️ مسح عدادي", callback_data="reset_counters")
+    )
+    keyboard.add(
+        types.InlineKeyboardButton("👨‍💻 المطور", callback_data="developer_info"),
+        types.InlineKeyboardButton("📤 شارك البوت", callback_data="share_bot")
+    )
+    keyboard.add(types.InlineKeyboardButton("🏆 لوحة المتصدرين", callback_data="leaderboard"))
+    return keyboard.to_json()
+
+
+def measure_render(name, render, inputs):
+    """زمن المعالج وذروة التخصيصات لكل عملية عرض"""
+    start = time.process_time()
+    for counters in inputs:
+        render(counters)
+    cpu = time.process_time() - start
+
+    # ذروة الذاكرة المؤقتة المخصصة أثناء عملية عرض واحدة
+    sample = inputs[:1000]
+    tracemalloc.start()
+    peak_total = 0
+    for counters in sample:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        render(counters)
+        peak_total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    print(f"{name:<28} {cpu / len(inputs) * 1e6:8.2f} us/render  {peak_total / len(sample):8.0f} B peak/render")
+
+
+def bench_render(args):
+    """مقارنة عرض لوحة العدادات قبل وبعد القالب المُعد مسبقاً"""
+    assert legacy_main_keyboard((1, 2, 3, 4)) == tast3.render_main_keyboard((1, 2, 3, 4))
+    # كل نقرة تغير العدادات، لذا نقيس حالة المفتاح الجديد (قالب) والمفتاح المتكرر (ذاكرة)
+    unique = [(i, i // 2, i // 3, i // 4) for i in range(args.renders)]
+    repeated = [(i % 64, 1, 2, 3) for i in range(args.renders)]
+
+    measure_render('legacy markup + to_json', legacy_main_keyboard, unique)
+    tast3.render_main_keyboard.cache_clear()
+    measure_render('template, new counters', tast3.render_main_keyboard, unique)
+    tast3.render_main_keyboard.cache_clear()
+    measure_render('template, cached counters', tast3.render_main_keyboard, repeated)
+
+    start = time.process_time()
+    for total in range(args.renders):
+        tast3.render_share_keyboard.__wrapped__(total)
+    print(f"{'share keyboard':<28} {(time.process_time() - start) / args.renders * 1e6:8.2f} us/render")
+
+
+def populate(store, users):
+    """ملء التخزين بمستخدمين اصطناعيين بمعرفات بحجم معرفات تليجرام الحقيقية"""
+    for i in range(users):
+        user_id = 5000000000 + i
+        store.initialize(user_id, user_id)
+        store.increment(user_id, 'subhan_count', i % 100)
+        store.set_message_id(user_id, i)
+
+
+def measure_memory(name, factory, users):
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = factory()
+    populate(store, users)
+    elapsed = time.perf_counter() - start
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{name:<12} {users:>10,} users  {current / 2 ** 20:9.1f} MiB  "
+          f"{current / users:7.1f} B/user  (populated in {elapsed:.1f}s)")
+    del store
+
+
+def bench_memory(args):
+    """ذاكرة التخزين القاموسي مقابل العمودي لعدد كبير من المستخدمين"""
+    for users in [int(u) for u in args.users.split(',')]:
+        if users <= args.dict_max:
+            measure_memory('dict', lambda: tast3.MemoryUserStore({}, {}, threading.Lock()), users)
+        else:
+            print(f"{'dict':<12} {users:>10,} users  skipped (above --dict-max)")
+        measure_memory('columnar', lambda: tast3.ColumnarUserStore(threading.Lock()), users)
+
+
+def run_taps(store, taps, users):
+    keys = ('subhan_count', 'alhamdulillah_count', 'la_ilaha_count', 'allahu_akbar_count')
+    start = time.perf_counter()
+    for i in range(taps):
+        store.increment(5000000000 + (i * 7919) % users, keys[i & 3])
+    return time.perf_counter() - start
+
+
+def bench_leaderboard(args):
+    """كلفة فهرس الترتيب على النقرات وزمن استعلام الترتيب مقارنة بالفرز الكامل"""
+    store = tast3.ColumnarUserStore(threading.Lock())
+    start = time.perf_counter()
+    for i in range(args.users):
+        user_id = 5000000000 + i
+        store.initialize(user_id, user_id)
+        # توزيع طويل الذيل: قلة بمجاميع كبيرة وكثرة بمجاميع صغيرة
+        store.increment(user_id, 'subhan_count', int(random.paretovariate(1.2) * 10))
+    print(f"populated {args.users:,} users in {time.perf_counter() - start:.1f}s")
+
+    report('taps, no index', args.taps, run_taps(store, args.taps, args.users))
+
+    board = tast3.Leaderboard(tast3.LEADERBOARD_TOP_SIZE, tast3.LEADERBOARD_PAGE_SIZE)
+    start = time.perf_counter()
+    board.attach(store)
+    print(f"index built in {time.perf_counter() - start:.2f}s")
+    report('taps, with index', args.taps, run_taps(store, args.taps, args.users))
+
+    # استعلامات ترتيب وصفحات بمعدل ثابت في خيط آخر أثناء النقرات
+    stop = threading.Event()
+    queries = [0]
+
+    def query_loop():
+        while not stop.is_set():
+            board.rank(random.randrange(1000))
+            board.page(random.randrange(10))
+            queries[0] += 1
+            time.sleep(1.0 / args.query_rate)
+
+    thread = threading.Thread(target=query_loop)
+    thread.start()
+    elapsed = run_taps(store, args.taps, args.users)
+    stop.set()
+    thread.join()
+    report(f"taps, +{queries[0] / elapsed:,.0f} queries/s", args.taps, elapsed)
+
+    start = time.perf_counter()
+    for i in range(args.queries):
+        board.rank(i % 5000)
+    print(f"{'rank lookup':<28} {(time.perf_counter() - start) / args.queries * 1e6:8.2f} us")
+    start = time.perf_counter()
+    for i in range(args.queries):
+        board.page(i % 10)
+    print(f"{'top page':<28} {(time.perf_counter() - start) / args.queries * 1e6:8.2f} us")
+
+    start = time.perf_counter()
+    ranking = sorted((total for _, total in store.iter_totals()), reverse=True)
+    print(f"{'full sort (old approach)':<28} {(time.perf_counter() - start) * 1e3:8.1f} ms  ({len(ranking):,} users)")
+
+
+def bench_coldstart(args):
+    """زمن التشغيل البارد لتخزين السجل: تحميل اللقطة عبر mmap ثم إعادة ذيل السجل"""
+    with tempfile.TemporaryDirectory() as directory:
+        store = tast3.LogUserStore(threading.Lock(), directory, fsync=False)
+        start = time.perf_counter()
+        populate(store, args.users)
+        print(f"populated {args.users:,} users in {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        store.snapshot()
+        size = os.path.getsize(store.snapshot_path)
+        print(f"snapshot written in {time.perf_counter() - start:.2f}s ({size / 2 ** 20:.1f} MiB)")
+
+        elapsed = run_taps(store, args.tail_ops, args.users)
+        report('taps, logged', args.tail_ops, elapsed)
+        store.flush()
+        print(f"log tail: {os.path.getsize(store._log_path(store.generation)) / 2 ** 20:.1f} MiB")
+
+        # محاكاة انهيار: لا لقطة نهائية، فيُعاد ذيل السجل كاملاً
+        store._closed = True
+        start = time.perf_counter()
+        restored = tast3.LogUserStore(threading.Lock(), directory, fsync=False)
+        elapsed = time.perf_counter() - start
+        print(f"cold start: {restored.count():,} users, {restored.replayed:,} log records in {elapsed:.2f}s")
+        assert restored.get_counters(5000000000) == store.get_counters(5000000000)
+
+        restored.close()
+        start = time.perf_counter()
+        clean = tast3.LogUserStore(threading.Lock(), directory, fsync=False)
+        print(f"cold start after clean shutdown: {clean.count():,} users in {time.perf_counter() - start:.2f}s")
+
+
+class FakeBotAPI:
+    """خادم محلي بديل عن Bot API لتليجرام مع زمن استجابة قابل للضبط وحقن أخطاء 429
+
+    send_rate: حد عام لطرق إرسال الرسائل في الثانية (كما يفعل تليجرام)، ما يتجاوزه يُرفض بـ 429
+    """
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=1, send_rate=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.send_rate = send_rate
+        self._sent = collections.deque()
+        self.calls = collections.Counter()
+        self.answered = {}  # callback_query_id -> وقت الرد
+        self._updates = collections.deque()
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._next_update_id = 1
+        self._next_message_id = 1000
+        self._server = None
+
+    @property
+    def url(self):
+        """قالب عنوان API بصيغة telebot.apihelper.API_URL"""
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # إرسال الرأس والجسم معاً دون تأخير Nagle حتى لا يضيف الخادم زمناً وهمياً
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                parsed = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(parsed.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(urllib.parse.parse_qsl(body))
+                status, payload = api.handle(parsed.path.rsplit('/', 1)[-1], params)
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+
+    def push_update(self, update):
+        with self._cond:
+            update['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def handle(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if self.latency:
+            time.sleep(self.latency)
+        if (self.rate_limit_ratio and random.random() < self.rate_limit_ratio) or self._over_send_rate(method):
+            with self._lock:
+                self.calls['429'] += 1
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'u'}}
+        elif method in ('sendMessage', 'editMessageText'):
+            with self._lock:
+                self._next_message_id += 1
+                message_id = int(params.get('message_id') or self._next_message_id)
+            result = {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', '')
+            }
+        elif method == 'answerCallbackQuery':
+            self.answered[params['callback_query_id']] = time.perf_counter()
+            result = True
+        elif method in ('deleteMessage', 'deleteMessages', 'deleteWebhook', 'setWebhook'):
+            result = True
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        return 200, {'ok': True, 'result': result}
+
+    def _over_send_rate(self, method):
+        if not self.send_rate or method not in tast3.API_SEND_METHODS:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._sent and self._sent[0] <= now - 1.0:
+                self._sent.popleft()
+            if len(self._sent) >= self.send_rate:
+                return True
+            self._sent.append(now)
+            return False
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1.0)
+        with self._cond:
+            while self._updates and (offset < 0 or self._updates[0]['update_id'] < offset):
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates)[:limit]
+
+
+def message_update(user_id, text):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+    return {'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': text, 'from': user,
+        'chat': {'id': user_id, 'type': 'private'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else []
+    }}
+
+
+def callback_update(user_id, callback_id, data, message_id=1):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+    return {'callback_query': {
+        'id': callback_id, 'from': user, 'chat_instance': str(user_id), 'data': data,
+        'message': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}}
+    }}
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def start_fake_bot(args):
+    """تشغيل الخادم البديل وتوجيه البوت إليه بدلاً من تليجرام"""
+    api = FakeBotAPI(args.latency_ms / 1000.0).start()
+    if args.runtime == 'async':
+        tast3.asyncio_helper.API_URL = api.url
+        api.loop = asyncio.new_event_loop()
+        threading.Thread(target=api.loop.run_until_complete, args=(run_async_polling(api),), daemon=True).start()
+    else:
+        telebot.apihelper.API_URL = api.url
+        tast3.bot.worker_pool = telebot.util.ThreadPool(tast3.bot, num_threads=args.handler_threads)
+        threading.Thread(
+            target=tast3.bot.polling,
+            kwargs={'non_stop': True, 'interval': 0, 'timeout': 1, 'long_polling_timeout': 1},
+            daemon=True
+        ).start()
+    # skip_pending يتخطى كل التحديثات الموجودة عند البدء، لذا ننتظر أول استطلاع فعلي
+    wait_until(lambda: api.calls['getUpdates'] >= 2, 10)
+    return api
+
+
+async def run_async_polling(api):
+    """تشغيل نسخة asyncio من البوت في حلقة أحداث واحدة"""
+    api.abot = tast3.create_async_bot()
+    await api.abot.polling(non_stop=True, skip_pending=True, timeout=1)
+
+
+def bench_load(args):
+    """اختبار حمل شامل: مستخدمون اصطناعيون ينقرون على أزرار الأذكار عبر خادم Bot API محلي"""
+    api = start_fake_bot(args)
+    tast3.tap_limiter = tast3.TapRateLimiter(args.tap_rate, args.tap_burst)
+    tast3.api_gateway = tast3.ApiGateway(args.api_rate, args.api_burst, tast3.API_INTERACTIVE_RESERVE) if args.api_rate else None
+    users = list(range(1, args.users + 1))
+
+    # كل مستخدم يبدأ بـ /start ليحصل على رسالة رئيسية
+    for user_id in users:
+        api.push_update(message_update(user_id, '/start'))
+    if not wait_until(lambda: all(tast3.user_store.get_message_id(u) for u in users), 60):
+        raise SystemExit("users did not receive a main menu")
+    api.reset_counts()
+    # حقن أخطاء 429 يبدأ بعد تجهيز المستخدمين
+    api.rate_limit_ratio = args.rate_limit_ratio
+
+    sent_at = {}
+    buttons = ('dhikr_subhan', 'dhikr_alhamdulillah', 'dhikr_la_ilaha', 'dhikr_allahu_akbar')
+
+    def tapper(user_id):
+        for tap in range(args.taps):
+            callback_id = f"{user_id}-{tap}"
+            sent_at[callback_id] = time.perf_counter()
+            api.push_update(callback_update(user_id, callback_id, buttons[tap % 4]))
+            time.sleep(args.tap_interval_ms / 1000.0)
+
+    total_taps = len(users) * args.taps
+    start = time.perf_counter()
+    tappers = [threading.Thread(target=tapper, args=(u,)) for u in users]
+    for thread in tappers:
+        thread.start()
+    for thread in tappers:
+        thread.join()
+    # الانتظار حتى الرد على كل النقرات أو توقف التقدم (نقرات رُفضت بـ 429 لن يُرد عليها)
+    deadline = time.monotonic() + args.timeout
+    answered, idle_since = 0, time.monotonic()
+    while len(api.answered) < total_taps and time.monotonic() < deadline and time.monotonic() - idle_since < 5:
+        if len(api.answered) != answered:
+            answered, idle_since = len(api.answered), time.monotonic()
+        time.sleep(0.05)
+    elapsed = max(api.answered.values(), default=start) - start
+    # انتظار تفريغ تعديلات القائمة المدمجة قبل عد الاستدعاءات
+    time.sleep(tast3.MENU_EDIT_WINDOW + 0.5)
+
+    latencies = [api.answered[c] - sent_at[c] for c in api.answered if c in sent_at]
+    calls = {m: n for m, n in api.calls.items() if m not in ('getUpdates', '429')}
+    print(f"taps: {len(latencies)}/{total_taps} answered in {elapsed:.2f}s, {api.calls['429']} x 429 "
+          f"({len(latencies) / max(elapsed, 1e-9):,.0f} taps/s)")
+    print(f"tap-to-answer latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"API calls per tap: {sum(calls.values()) / max(total_taps, 1):.2f}  "
+          + '  '.join(f"{m}={n}" for m, n in sorted(calls.items())))
+    counted = sum(tast3.user_store.get_counters(u)[4] for u in users)
+    shed = sum(tast3.limited_taps.value('shed', outcome) for outcome in ('counted', 'dropped'))
+    print(f"absorbed taps: {tast3.tap_limiter.limited} over the per-user limit (not answered), "
+          f"{shed} shed under edit backlog (answered, edit deferred); {counted}/{total_taps} taps counted")
+
+    if args.broadcast_users:
+        broadcast_ids = [10 ** 9 + i for i in range(args.broadcast_users)]
+        for user_id in broadcast_ids:
+            tast3.initialize_user_data(user_id, user_id)
+        api.reset_counts()
+        with tempfile.TemporaryDirectory() as tmp:
+            tast3.broadcast_engine.journal_dir = tmp
+            start = time.perf_counter()
+            if args.runtime == 'async':
+                asyncio.run_coroutine_threadsafe(tast3.send_daily_notifications_async(
+                    api.abot, morning=True, run_id='bench', user_ids=broadcast_ids), api.loop).result()
+            else:
+                tast3.send_daily_notifications(morning=True, run_id='bench', user_ids=broadcast_ids)
+            elapsed = time.perf_counter() - start
+        print(f"broadcast: {args.broadcast_users} users in {elapsed:.2f}s "
+              f"({api.calls['sendMessage'] / max(elapsed, 1e-9):,.1f} msg/s, {api.calls['429']} x 429)")
+
+    if args.runtime == 'async':
+        api.abot._polling = False
+    else:
+        tast3.bot.stop_polling()
+    api.stop()
+
+
+class StubResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self._payload = {'ok': True, 'result': result}
+        self.text = json.dumps(self._payload)
+
+    def json(self):
+        return self._payload
+
+
+def stub_bot_api():
+    """يُستدعى في كل عملية عاملة: ردود Bot API جاهزة دون شبكة حتى يُقاس عمل المعالجات وحده"""
+    message_ids = itertools.count(1000)
+
+    def send(method, url, params=None, files=None, timeout=None, proxies=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = params or {}
+        if api_method == 'getChatMember':
+            user = {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'user'}
+            result = {'status': 'member', 'user': user}
+        elif api_method in ('sendMessage', 'editMessageText'):
+            message_id = int(params.get('message_id') or next(message_ids))
+            result = {'message_id': message_id, 'date': 0, 'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+        else:
+            result = True
+        return StubResponse(result)
+
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = send
+
+
+def bench_shards(args):
+    """قابلية التوسع: نفس النقرات موزعة على 1..N عمليات عاملة عبر ShardDispatcher"""
+    buttons = ('dhikr_subhan', 'dhikr_alhamdulillah', 'dhikr_la_ilaha', 'dhikr_allahu_akbar')
+    print(f"CPUs: {os.cpu_count()}")
+    baseline = None
+    for workers in [int(n) for n in args.workers.split(',')]:
+        dispatcher = tast3.ShardDispatcher(workers, tast3.SHARD_QUEUE_SIZE, initializer=stub_bot_api).start()
+        update_ids = itertools.count(1)
+
+        def processed():
+            return dispatcher.stats()['total'].get('update_queue', {}).get('processed', 0)
+
+        for user_id in range(1, args.users + 1):
+            dispatcher.route(dict(message_update(user_id, '/start'), update_id=next(update_ids)))
+        if not wait_until(lambda: processed() >= args.users, 120):
+            raise SystemExit("shard workers did not start")
+
+        start = time.perf_counter()
+        for tap in range(args.taps):
+            user_id = tap % args.users + 1
+            update = callback_update(user_id, str(tap), buttons[tap % 4])
+            dispatcher.route(dict(update, update_id=next(update_ids)))
+        wait_until(lambda: processed() >= args.users + args.taps, args.timeout)
+        elapsed = time.perf_counter() - start
+        taps = processed() - args.users
+        routed = dispatcher.stats()['dispatcher']['routed']
+        dispatcher.stop()
+
+        rate = taps / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>2} worker(s)  {taps:>8} taps  {elapsed:7.2f}s  {rate:>10,.0f} taps/s  "
+              f"x{rate / baseline:.2f}  per shard {routed}")
+
+
+# مرشحات المعالجات قبل CallbackRouter بنفس ترتيب تسجيلها في tast3.py
+LEGACY_CALLBACK_FILTERS = (
+    ('check_subscription', lambda call: call.data == 'check_sub'),
+    ('handle_dhikr_callback', lambda call: call.data.startswith('dhikr_')),
+    ('show_stats', lambda call: call.data == 'show_stats'),
+    ('leaderboard_callback', lambda call: call.data.startswith('leaderboard')),
+    ('reset_counters', lambda call: call.data == 'reset_counters'),
+    ('share_bot', lambda call: call.data == 'share_bot'),
+    ('developer_info', lambda call: call.data == 'developer_info'),
+    ('back_to_main', lambda call: call.data == 'back_to_main'),
+)
+ROUTER_ROUTES = (
+    ('check_subscription', ('check_sub',), None),
+    ('handle_dhikr_callback', tuple(tast3.DHIKR_ACTIONS), 'dhikr_'),
+    ('show_stats', ('show_stats',), None),
+    ('leaderboard_callback', ('leaderboard',), 'leaderboard_'),
+    ('reset_counters', ('reset_counters',), None),
+    ('share_bot', ('share_bot',), None),
+    ('developer_info', ('developer_info',), None),
+    ('back_to_main', ('back_to_main',), None),
+)
+
+
+def bench_router(args):
+    """كلفة اختيار معالج الزر لكل تحديث: سلسلة مرشحات telebot مقابل CallbackRouter
+
+    "telebot floor" بوت بمعالج واحد يقبل كل شيء: كلفة telebot الثابتة لكل تحديث (تفكيك التحديث،
+    الوسطاء، استدعاء المعالج) المشتركة بين الطريقتين؛ ما فوقها هو كلفة اختيار المعالج
+    """
+    legacy_hits, routed_hits, floor_hits = collections.Counter(), collections.Counter(), collections.Counter()
+
+    legacy = telebot.TeleBot('0:benchmark', threaded=False)
+    for name, func in LEGACY_CALLBACK_FILTERS:
+        legacy.register_callback_query_handler(lambda call, name=name: legacy_hits.update((name,)), func=func)
+
+    router = tast3.CallbackRouter()
+    for name, data, prefix in ROUTER_ROUTES:
+        router.handler(*data, prefix=prefix)(lambda call, name=name: routed_hits.update((name,)))
+    routed = telebot.TeleBot('0:benchmark', threaded=False)
+    routed.register_callback_query_handler(router.dispatch, func=lambda call: True)
+
+    floor = telebot.TeleBot('0:benchmark', threaded=False)
+    floor.register_callback_query_handler(lambda call: floor_hits.update(('any',)), func=lambda call: True)
+
+    mixes = {
+        # الأذكار ثاني مرشح في السلسلة القديمة، فلا يسبقها إلا مرشح واحد
+        'dhikr taps': list(tast3.DHIKR_ACTIONS),
+        'late buttons': ['share_bot', 'developer_info', 'back_to_main'],
+        'all buttons': list(tast3.DHIKR_ACTIONS) + ['check_sub', 'show_stats', 'leaderboard', 'leaderboard_2',
+                                                    'reset_counters', 'share_bot', 'developer_info', 'back_to_main'],
+    }
+    for mix, datas in mixes.items():
+        updates = [
+            types.Update.de_json(dict(callback_update(1, str(i), datas[i % len(datas)]), update_id=i + 1))
+            for i in range(args.updates)
+        ]
+        calls = [update.callback_query for update in updates]
+        results = {}
+        for name, bot in (('telebot floor', floor), ('filter chain', legacy), ('router', routed)):
+            # أفضل تكرار: ضجيج الجدولة يضيف ولا ينقص
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                for update in updates:
+                    bot.process_new_updates([update])
+                best = min(best, time.perf_counter() - start)
+            results[name] = best / len(updates)
+        start = time.perf_counter()
+        for call in calls:
+            router.resolve(call.data)
+        resolve = (time.perf_counter() - start) / len(calls)
+        base = results['telebot floor']
+        print(f"{mix:<12} per update: telebot floor {base * 1e6:5.2f}us  "
+              f"filter chain {results['filter chain'] * 1e6:5.2f}us ({(results['filter chain'] - base) * 1e6:+.2f})  "
+              f"router {results['router'] * 1e6:5.2f}us ({(results['router'] - base) * 1e6:+.2f}, "
+              f"resolve alone {resolve * 1e6:.2f}us)")
+    assert legacy_hits == routed_hits, (legacy_hits, routed_hits)
+
+
+def measure_taps(store, users, threads, interval, until):
+    """زمن كل نقرة (increment) من عدة خيوط حتى يصبح until() صحيحاً
+
+    الزمن يُحسب من الموعد المفترض للنقرة (نهاية السابقة + الفاصل) لا من بدء الاستدعاء،
+    فانتظار GIL أو الأقفال خلف خيط التصدير يظهر في النتيجة
+    """
+    latencies = []
+
+    def tapper(seed):
+        rng = random.Random(seed)
+        own = []
+        while not until():
+            user_id = rng.randrange(users)
+            due = time.perf_counter() + interval
+            time.sleep(interval)
+            store.increment(user_id, 'subhan_count')
+            own.append(time.perf_counter() - due)
+        latencies.extend(own)
+
+    tappers = [threading.Thread(target=tapper, args=(i,)) for i in range(threads)]
+    for thread in tappers:
+        thread.start()
+    for thread in tappers:
+        thread.join()
+    return latencies
+
+
+def bench_export(args):
+    """زمن النقرات أثناء تصدير كامل، ذاكرة التصدير الإضافية، وسرعة الاستيراد"""
+    def new_store():
+        if args.backend == 'memory':
+            return tast3.MemoryUserStore({}, {}, threading.Lock())
+        return tast3.ColumnarUserStore(threading.Lock())
+
+    store = new_store()
+    for user_id in range(args.users):
+        store.increment(user_id, 'subhan_count', user_id % 100)
+        if user_id % 5 == 0:
+            store.set_preferences(user_id, {'timezone': 'Africa/Algiers'})
+    print(f"{args.users:,} users ({args.backend}), chunk {args.chunk}, {args.tap_threads} tap threads")
+
+    def describe(name, latencies, elapsed):
+        print(f"{name:<16} {len(latencies) / elapsed:>8,.0f} taps/s  p50 {percentile(latencies, 0.5) * 1e6:7.1f}us  "
+              f"p99 {percentile(latencies, 0.99) * 1e6:8.1f}us  max {max(latencies) * 1e3:6.2f}ms")
+
+    deadline = time.perf_counter() + args.baseline_seconds
+    latencies = measure_taps(store, args.users, args.tap_threads, args.tap_interval_ms / 1000.0,
+                             lambda: time.perf_counter() >= deadline)
+    describe('no export', latencies, args.baseline_seconds)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.ndjson')
+        done = threading.Event()
+        exported = {}
+
+        def exporter():
+            start = time.perf_counter()
+            with open(path, 'w', encoding='utf-8') as f:
+                for text in tast3.export_stream(store, 'ndjson', args.chunk):
+                    f.write(text)
+            exported['elapsed'] = time.perf_counter() - start
+            done.set()
+
+        start = time.perf_counter()
+        threading.Thread(target=exporter).start()
+        latencies = measure_taps(store, args.users, args.tap_threads, args.tap_interval_ms / 1000.0, done.is_set)
+        describe('during export', latencies, time.perf_counter() - start)
+        size = os.path.getsize(path)
+        print(f"export: {args.users:,} users in {exported['elapsed']:.2f}s "
+              f"({args.users / exported['elapsed']:,.0f} users/s, {size / 2 ** 20:.0f} MiB NDJSON)")
+
+        # الذاكرة الإضافية أثناء التصدير (تتبع tracemalloc يبطئ التنفيذ لذا يُقاس منفصلاً)
+        tracemalloc.start()
+        for _ in tast3.export_stream(store, 'ndjson', args.chunk):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"export peak extra memory: {peak / 2 ** 20:.1f} MiB "
+              f"(id array {args.users * 8 / 2 ** 20:.1f} MiB + one chunk)")
+
+        restored = new_store()
+        start = time.perf_counter()
+        with open(path, encoding='utf-8') as f:
+            count = tast3.import_stream(restored, f, 'ndjson', args.chunk)
+        elapsed = time.perf_counter() - start
+        print(f"import: {count:,} users in {elapsed:.2f}s ({count / elapsed:,.0f} users/s)")
+        assert restored.count() == store.count()
+
+
+def bench_gateway(args):
+    """نقرات حية أثناء بث يومي مع حد معدل عام لدى الخادم البديل: إرسال مباشر مقابل بوابة الأولويات"""
+    args.runtime = 'threads'
+    tast3.api_gateway = None
+    api = start_fake_bot(args)
+    users = list(range(1, args.users + 1))
+    for user_id in users:
+        api.push_update(message_update(user_id, '/start'))
+    if not wait_until(lambda: all(tast3.user_store.get_message_id(u) for u in users), 60):
+        raise SystemExit("users did not receive a main menu")
+    broadcast_ids = [10 ** 9 + i for i in range(args.broadcast_users)]
+    for user_id in broadcast_ids:
+        tast3.initialize_user_data(user_id, user_id)
+    api.send_rate = args.telegram_rate
+    time.sleep(1.0)
+
+    buttons = ('dhikr_subhan', 'dhikr_alhamdulillah', 'dhikr_la_ilaha', 'dhikr_allahu_akbar')
+    for mode in ('direct', 'gateway'):
+        tast3.api_gateway = tast3.ApiGateway(args.api_rate, args.api_burst, tast3.API_INTERACTIVE_RESERVE) if mode == 'gateway' else None
+        api.reset_counts()
+        api.answered.clear()
+        sent_at = {}
+        result = {}
+
+        def broadcast():
+            with tempfile.TemporaryDirectory() as tmp:
+                tast3.broadcast_engine.journal_dir = tmp
+                start = time.perf_counter()
+                result.update(tast3.broadcast_engine.run(f"bench-{mode}", broadcast_ids, 'bench'))
+                result['elapsed'] = time.perf_counter() - start
+
+        def tapper(user_id):
+            # بدايات متفرقة حتى لا تصل نقرات كل المستخدمين في نفس اللحظة
+            time.sleep(random.random() * args.tap_interval_ms / 1000.0)
+            for tap in range(args.taps):
+                callback_id = f"{mode}-{user_id}-{tap}"
+                sent_at[callback_id] = time.perf_counter()
+                api.push_update(callback_update(user_id, callback_id, buttons[tap % 4]))
+                time.sleep(args.tap_interval_ms / 1000.0)
+
+        threads = [threading.Thread(target=broadcast)] + [threading.Thread(target=tapper, args=(u,)) for u in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total_taps = len(users) * args.taps
+        wait_until(lambda: len(api.answered) >= total_taps, 10)
+        time.sleep(tast3.MENU_EDIT_WINDOW + 0.5)
+
+        latencies = [api.answered[c] - sent_at[c] for c in api.answered if c in sent_at]
+        print(f"{mode}: taps answered {len(latencies)}/{total_taps}  "
+              f"p50 {percentile(latencies, 0.5) * 1000:.0f}ms  p99 {percentile(latencies, 0.99) * 1000:.0f}ms  "
+              f"{api.calls['429']} x 429")
+        print(f"{mode}: broadcast sent {result['sent']}/{len(broadcast_ids)} (failed {result['failed']}) "
+              f"in {result['elapsed']:.1f}s ({result['sent'] / max(result['elapsed'], 1e-9):.1f} msg/s)  "
+              f"menu edits {api.calls['editMessageText']}")
+        if tast3.api_gateway is not None:
+            for name, entry in tast3.api_gateway.stats()['classes'].items():
+                print(f"  {name:<12} admitted {entry['admitted']:>5}  max depth {entry['max_depth']:>4}  "
+                      f"wait avg {entry['wait_avg_ms']:8.1f}ms  max {entry['wait_max_ms']:8.1f}ms")
+
+    tast3.bot.stop_polling()
+    api.stop()
+
+
+def replay_speed(value):
+    return float('inf') if value == 'max' else float(value.rstrip('x'))
+
+
+def bench_replay(args):
+    """إعادة تشغيل سجل تحديثات مسجل (UPDATE_RECORD_DIR) بسرعة 1x أو 10x أو max عبر خادم Bot API محلي"""
+    entries = tast3.read_update_records(args.logs)[:args.limit or None]
+    if not entries:
+        raise SystemExit("no recorded updates")
+    first = entries[0]['ts']
+    span = entries[-1]['ts'] - first
+    per_minute = collections.Counter(int(e['ts'] // 60) for e in entries)
+    peak_minute, peak = per_minute.most_common(1)[0]
+    print(f"log: {len(entries)} updates over {span:.1f}s, {len(set(e['user'] for e in entries))} users, "
+          f"peak {peak}/min at {time.strftime('%H:%M', time.gmtime(peak_minute * 60))} UTC")
+
+    api = FakeBotAPI(args.latency_ms / 1000.0).start()
+    telebot.apihelper.API_URL = api.url
+    # المعالجات تعمل مباشرة في خيوط الطابور كما في وضع webhook
+    tast3.bot.threaded = False
+    tast3.api_gateway = tast3.ApiGateway(args.api_rate, args.api_burst, tast3.API_INTERACTIVE_RESERVE) if args.api_rate else None
+    speed = replay_speed(args.speed)
+    submitted, done = {}, {}
+
+    def handle(update):
+        tast3.process_update(update)
+        done[update.update_id] = time.perf_counter()
+
+    updates = tast3.UpdateQueue(handle, args.workers, args.queue_size)
+    start = time.perf_counter()
+    for update_id, entry in enumerate(entries, 1):
+        delay = start + (entry['ts'] - first) / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        update = types.Update.de_json(tast3.recorded_update(entry, update_id))
+        submitted[update_id] = time.perf_counter()
+        updates.submit(update, block=True)
+    updates.join()
+    elapsed = time.perf_counter() - start
+    # انتظار تفريغ تعديلات القائمة المدمجة قبل عد الاستدعاءات
+    time.sleep(tast3.MENU_EDIT_WINDOW + 0.5)
+    api.stop()
+
+    latencies = [done[u] - submitted[u] for u in done]
+    calls = {m: n for m, n in api.calls.items() if m != '429'}
+    offered = f"{len(entries) / (span / speed):,.0f}/s" if span and speed != float('inf') else 'unbounded'
+    print(f"replay at {args.speed}: {len(done)}/{len(entries)} updates in {elapsed:.2f}s "
+          f"({len(done) / max(elapsed, 1e-9):,.0f} updates/s, offered {offered}), "
+          f"max queue depth {updates.max_depth}")
+    print(f"update latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms  max {max(latencies, default=0) * 1000:.1f}ms")
+    print(f"API calls per update: {sum(calls.values()) / len(entries):.2f}  "
+          + '  '.join(f"{m}={n}" for m, n in sorted(calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    store = commands.add_parser('store', help='increments/sec: memory vs SQLite write-behind')
+    store.add_argument('--ops', type=int, default=500000)
+    store.add_argument('--users', type=int, default=10000)
+    store.add_argument('--flush-ms', type=int, default=tast3.STORAGE_FLUSH_MS)
+    store.add_argument('--flush-ops', type=int, default=tast3.STORAGE_FLUSH_OPS)
+    store.set_defaults(func=bench_store)
+
+    stress = commands.add_parser('stress', help='concurrent taps: lost updates and thread scaling')
+    stress.add_argument('--threads', default='1,2,4,8,16')
+    stress.add_argument('--taps', type=int, default=2000)
+    stress.add_argument('--users', type=int, default=8)
+    stress.add_argument('--io-ms', type=float, default=1.0)
+    stress.add_argument('--switch-interval-us', type=float, default=1.0)
+    stress.set_defaults(func=bench_stress)
+
+    render = commands.add_parser('render', help='per-render CPU and allocations of the main keyboard')
+    render.add_argument('--renders', type=int, default=20000)
+    render.set_defaults(func=bench_render)
+
+    memory = commands.add_parser('memory', help='memory per user: dict store vs columnar store')
+    memory.add_argument('--users', default='1000000,5000000')
+    memory.add_argument('--dict-max', type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    ranking = commands.add_parser('leaderboard', help='rank index: tap overhead and rank/top-K query latency')
+    ranking.add_argument('--users', type=int, default=1000000)
+    ranking.add_argument('--taps', type=int, default=300000)
+    ranking.add_argument('--queries', type=int, default=100000)
+    ranking.add_argument('--query-rate', type=float, default=200)
+    ranking.set_defaults(func=bench_leaderboard)
+
+    coldstart = commands.add_parser('coldstart', help='log store: snapshot size, logged taps/sec and cold-start time')
+    coldstart.add_argument('--users', type=int, default=1000000)
+    coldstart.add_argument('--tail-ops', type=int, default=500000)
+    coldstart.set_defaults(func=bench_coldstart)
+
+    load = commands.add_parser('load', help='end-to-end taps against a local fake Bot API server')
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--taps', type=int, default=20)
+    load.add_argument('--tap-interval-ms', type=float, default=50)
+    load.add_argument('--latency-ms', type=float, default=20)
+    load.add_argument('--rate-limit-ratio', type=float, default=0.0)
+    load.add_argument('--handler-threads', type=int, default=8)
+    load.add_argument('--tap-rate', type=float, default=tast3.TAP_RATE)
+    load.add_argument('--tap-burst', type=int, default=tast3.TAP_BURST)
+    load.add_argument('--broadcast-users', type=int, default=300)
+    # نفس بوابة الإنتاج افتراضياً؛ 0 = بدون بوابة لقياس المعالجات نفسها
+    load.add_argument('--api-rate', type=float, default=tast3.API_RATE)
+    load.add_argument('--api-burst', type=int, default=tast3.API_BURST)
+    load.add_argument('--timeout', type=float, default=120)
+    load.add_argument('--runtime', choices=('threads', 'async'), default='threads')
+    load.set_defaults(func=bench_load)
+
+    shards = commands.add_parser('shards', help='multi-process workers: tap throughput from 1 to N shards')
+    shards.add_argument('--workers', default=','.join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)) or '1')
+    shards.add_argument('--users', type=int, default=1000)
+    shards.add_argument('--taps', type=int, default=20000)
+    shards.add_argument('--timeout', type=float, default=300)
+    shards.set_defaults(func=bench_shards)
+
+    routing = commands.add_parser('router', help='callback dispatch overhead: filter chain vs CallbackRouter')
+    routing.add_argument('--updates', type=int, default=200000)
+    routing.add_argument('--repeat', type=int, default=3)
+    routing.set_defaults(func=bench_router)
+
+    export = commands.add_parser('export', help='tap latency during a full streaming export, and import speed')
+    export.add_argument('--users', type=int, default=1000000)
+    export.add_argument('--backend', choices=('columnar', 'memory'), default='columnar')
+    export.add_argument('--chunk', type=int, default=tast3.EXPORT_CHUNK_SIZE)
+    export.add_argument('--tap-threads', type=int, default=4)
+    export.add_argument('--tap-interval-ms', type=float, default=1.0)
+    export.add_argument('--baseline-seconds', type=float, default=3.0)
+    export.set_defaults(func=bench_export)
+
+    replay = commands.add_parser('replay', help='replay a recorded update log at 1x/10x/max against a local fake Bot API')
+    replay.add_argument('logs', nargs='+')
+    replay.add_argument('--speed', choices=('1x', '10x', 'max'), default='10x')
+    replay.add_argument('--limit', type=int, default=0)
+    replay.add_argument('--latency-ms', type=float, default=20)
+    replay.add_argument('--workers', type=int, default=tast3.WEBHOOK_WORKERS)
+    replay.add_argument('--queue-size', type=int, default=tast3.WEBHOOK_QUEUE_SIZE)
+    replay.add_argument('--api-rate', type=float, default=tast3.API_RATE)
+    replay.add_argument('--api-burst', type=int, default=tast3.API_BURST)
+    replay.set_defaults(func=bench_replay)
+
+    gateway = commands.add_parser('gateway', help='live taps during a broadcast under a global rate limit: direct vs priority gateway')
+    gateway.add_argument('--users', type=int, default=20)
+    gateway.add_argument('--taps', type=int, default=10)
+    gateway.add_argument('--tap-interval-ms', type=float, default=1000)
+    gateway.add_argument('--broadcast-users', type=int, default=300)
+    gateway.add_argument('--telegram-rate', type=int, default=30)
+    gateway.add_argument('--api-rate', type=float, default=25)
+    gateway.add_argument('--api-burst', type=int, default=5)
+    gateway.add_argument('--latency-ms', type=float, default=20)
+    gateway.add_argument('--handler-threads', type=int, default=8)
+    gateway.set_defaults(func=bench_gateway)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,50 @@ import os
 import logging
 import telebot
 from telebot import types
-from datetime import datetime
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import threading
 import time
-from flask import Flask, Response
+from flask import Flask, Response, request, jsonify
 import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import random
+import functools
+from functools import lru_cache
+from types import MappingProxyType
+import bisect
+import math
+from collections import OrderedDict
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import mmap
+import csv
+import io
+import argparse
+import struct
+import asyncio
+import inspect
+import contextvars
+import hmac
+import itertools
+import re
+import queue
+import multiprocessing
+import sqlite3
+import atexit
+import signal
+import sys
+
+try:
+    # وضع asyncio اختياري ويتطلب aiohttp
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    asyncio_helper = AsyncTeleBot = None
 
 # تكوين السجلات
 logging.basicConfig(
@@ -20,9 +58,14 @@ logger = logging.getLogger(__name__)
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME', '@Aymen_dj_max')
 CHANNEL_ID = int(os.getenv('CHANNEL_ID', '-1002807434205'))
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+BOT_THREADS = int(os.getenv('BOT_THREADS', '2'))
+# عدد العمليات العاملة (0 = عملية واحدة)؛ الموزع يمرر SHARD_INDEX وSHARD_COUNT لكل عملية عاملة
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if 'SHARD_INDEX' in os.environ else None
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
 
 # تهيئة البوت
-bot = telebot.TeleBot(BOT_TOKEN, skip_pending=True)
+bot = telebot.TeleBot(BOT_TOKEN, skip_pending=True, num_threads=BOT_THREADS)
 
 # تهيئة Flask
 app = Flask(__name__)
@@ -31,10 +74,468 @@ app = Flask(__name__)
 def ping():
     return Response("Bot is alive!", status=200, mimetype='text/plain')
 
+# ==================== المقاييس ====================
+# مقاييس بصيغة Prometheus النصية بدون مكتبات إضافية؛ كل تسجيل يكلف قفلاً وبحثاً ثنائياً فقط
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class CounterMetric:
+    """عداد تراكمي مع تسميات"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class HistogramMetric:
+    """مدرج تكراري تراكمي لأزمنة الاستجابة"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label_values -> [counts per bucket + inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self._series.items()]
+        for label_values, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+class GaugeCollector:
+    """قيم لحظية تُحسب عند كل قراءة لـ /metrics"""
+
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._collect = collect
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        for label_values, value in self._collect():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+metrics_registry = []
+
+def register_metric(metric):
+    metrics_registry.append(metric)
+    return metric
+
+handler_latency = register_metric(HistogramMetric(
+    'bot_handler_duration_seconds', 'Bot handler latency', ('handler',)))
+handler_calls = register_metric(CounterMetric(
+    'bot_handler_calls_total', 'Bot handler calls by outcome', ('handler', 'status')))
+api_latency = register_metric(HistogramMetric(
+    'bot_api_request_duration_seconds', 'Telegram Bot API request latency', ('method',)))
+api_calls = register_metric(CounterMetric(
+    'bot_api_requests_total', 'Telegram Bot API requests by method and status', ('method', 'status')))
+lock_wait = register_metric(HistogramMetric(
+    'bot_lock_wait_seconds', 'Time spent waiting for contended locks (uncontended acquisitions are not recorded)', ('lock',)))
+limited_taps = register_metric(CounterMetric(
+    'bot_limited_taps_total', 'Callback taps absorbed without API calls by the per-user limiter or load shedding',
+    ('reason', 'outcome')))
+
+# تتبع التحديثات البطيئة: كل معالج أبطأ من العتبة يُسجل زمن كل خطوة فيه (0 = معطل)
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '0'))
+
+# خطوات المعالج الجاري (None خارج التتبع) ومسار الخطوة الحالية؛ contextvars تعمل مع الخيوط وasyncio معاً
+trace_steps = contextvars.ContextVar('trace_steps', default=None)
+trace_path = contextvars.ContextVar('trace_path', default=())
+
+def record_step(name, elapsed):
+    """إضافة خطوة مقيسة مسبقاً إلى التتبع الجاري إن وجد"""
+    steps = trace_steps.get()
+    if steps is not None:
+        steps.append((trace_path.get() + (name,), elapsed))
+
+def traced_step(name, func):
+    """تغليف دالة كخطوة في التتبع؛ خارج التتبع تكلف قراءة متغير سياق واحد"""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            steps = trace_steps.get()
+            if steps is None:
+                return await func(*args, **kwargs)
+            path = trace_path.get() + (name,)
+            token = trace_path.set(path)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                steps.append((path, time.perf_counter() - start))
+                trace_path.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        steps = trace_steps.get()
+        if steps is None:
+            return func(*args, **kwargs)
+        path = trace_path.get() + (name,)
+        token = trace_path.set(path)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            steps.append((path, time.perf_counter() - start))
+            trace_path.reset(token)
+
+    return wrapper
+
+def trace_as(name):
+    """صيغة المزخرف من traced_step"""
+    return functools.partial(traced_step, name)
+
+class SlowUpdateTracer:
+    """تسجيل توزيع الزمن على الخطوات لكل معالج أبطأ من العتبة"""
+
+    def __init__(self, threshold_ms):
+        self.threshold = threshold_ms / 1000.0
+        self.traced = 0
+        self.logged = 0
+
+    def begin(self):
+        if not self.threshold:
+            return None
+        self.traced += 1
+        return trace_steps.set([])
+
+    def end(self, token, handler_name, elapsed):
+        if token is None:
+            return
+        steps = trace_steps.get()
+        trace_steps.reset(token)
+        if elapsed < self.threshold:
+            return
+        self.logged += 1
+        # الخطوات المتكررة تُجمع؛ المتداخلة تظهر بمسارها الكامل (subscription/api:getChatMember)
+        totals = {}
+        for path, duration in steps:
+            label = '/'.join(path)
+            count, total = totals.get(label, (0, 0.0))
+            totals[label] = (count + 1, total + duration)
+        parts = [
+            f"{label}={total * 1000:.1f}ms" + (f" x{count}" if count > 1 else '')
+            for label, (count, total) in totals.items()
+        ]
+        accounted = sum(duration for path, duration in steps if len(path) == 1)
+        parts.append(f"other={max(elapsed - accounted, 0) * 1000:.1f}ms")
+        logger.warning(f"Slow update in {handler_name}: {elapsed * 1000:.1f}ms ({', '.join(parts)})")
+
+slow_update_tracer = SlowUpdateTracer(SLOW_UPDATE_MS)
+
+def instrument_handler(handler):
+    """قياس زمن ونتيجة معالج البوت"""
+    name = handler.__name__
+
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_wrapper(*args, **kwargs):
+            trace = slow_update_tracer.begin()
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                handler_latency.observe(elapsed, name)
+                handler_calls.inc(name, status)
+                slow_update_tracer.end(trace, name, elapsed)
+
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        trace = slow_update_tracer.begin()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            handler_latency.observe(elapsed, name)
+            handler_calls.inc(name, status)
+            slow_update_tracer.end(trace, name, elapsed)
+
+    return wrapper
+
+def install_api_metrics():
+    """تغليف كل طلبات Bot API الصادرة لقياس الزمن والحالة"""
+    make_request = telebot.apihelper._make_request
+    if getattr(make_request, 'instrumented', False):
+        return
+
+    @functools.wraps(make_request)
+    def instrumented_request(token, method_name, *args, **kwargs):
+        start = time.perf_counter()
+        status = '200'
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            status = str(e.error_code)
+            raise
+        except telebot.apihelper.ApiHTTPException as e:
+            status = str(e.result.status_code)
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            api_latency.observe(elapsed, method_name)
+            api_calls.inc(method_name, status)
+            record_step(f"api:{method_name}", elapsed)
+
+    instrumented_request.instrumented = True
+    telebot.apihelper._make_request = instrumented_request
+
+install_api_metrics()
+
+def install_async_api_metrics():
+    """نفس القياس لطلبات AsyncTeleBot (الوسيط url هو اسم الطريقة)"""
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, 'instrumented', False):
+        return
+
+    @functools.wraps(process_request)
+    async def instrumented_request(token, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = '200'
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            status = str(e.error_code)
+            raise
+        except asyncio_helper.ApiHTTPException as e:
+            status = str(e.result.status)
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            api_latency.observe(elapsed, url)
+            api_calls.inc(url, status)
+            record_step(f"api:{url}", elapsed)
+
+    instrumented_request.instrumented = True
+    asyncio_helper._process_request = instrumented_request
+
+class TimedLock:
+    """قفل يسجل زمن الانتظار عند التنافس فقط؛ الحالة غير المتنافس عليها لا تكلف قياس وقت"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        lock_wait.observe(time.perf_counter() - start, self.name)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+@app.route('/metrics')
+def metrics():
+    """كل المقاييس بصيغة Prometheus النصية"""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", status=200, mimetype='text/plain; version=0.0.4')
+
+# ==================== التشخيص ====================
+# نقاط /debug تتطلب ADMIN_TOKEN (ترويسة Authorization: Bearer أو ?token=)، وتُعطل إذا لم يُضبط
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILE_MAX_SECONDS = 60
+# أطراف المكدس التي تعني أن الخيط ينتظر عملاً (طوابير ومجمعات خيوط خاملة)
+IDLE_FRAMES = frozenset((
+    ('threading.py', 'wait'), ('queue.py', 'get'), ('thread.py', '_worker'),
+    ('selectors.py', 'select'), ('socketserver.py', 'serve_forever')
+))
+
+def admin_authorized():
+    if not ADMIN_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    supplied = header[7:] if header.startswith('Bearer ') else request.args.get('token', '')
+    return hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+def admin_only(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not admin_authorized():
+            return Response(status=403)
+        return view(*args, **kwargs)
+    return wrapper
+
+class StackSampler:
+    """عينات دورية من مكدسات كل الخيوط عبر sys._current_frames دون أي تغليف للخيوط المقيسة"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}  # (thread, frame, ...) -> عدد العينات
+
+    def run(self, duration, include_idle=False):
+        own = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # خيوط نفس المجموعة (update-worker-0, update-worker-1...) تُدمج تحت اسم واحد
+                stack.append(re.sub(r'[-_]?\d+(_\d+)?$', '', names.get(ident, 'thread')))
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        """صيغة flamegraph.pl / speedscope: سطر لكل مكدس مع عدد عيناته"""
+        ordered = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in ordered) + "\n"
+
+    def top(self, limit=40):
+        """أكثر الدوال ظهوراً: ذاتياً (في قمة المكدس) وشاملاً (في أي موضع)"""
+        own, total = {}, {}
+        for stack, count in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for frame in set(stack[1:]):
+                total[frame] = total.get(frame, 0) + count
+        thread_samples = max(sum(self.stacks.values()), 1)
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:.0f}ms, {thread_samples} thread stacks",
+            f"{'self%':>7} {'total%':>7}  function"
+        ]
+        for frame, count in sorted(total.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f"{own.get(frame, 0) * 100 / thread_samples:7.1f} {count * 100 / thread_samples:7.1f}  {frame}")
+        return "\n".join(lines) + "\n"
+
+profile_lock = threading.Lock()
+
+def float_arg(name, default):
+    """معامل عددي من الطلب، أو None إذا لم يكن رقماً محدوداً"""
+    try:
+        value = float(request.args.get(name, default))
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+@app.route('/debug/profile')
+@admin_only
+def debug_profile():
+    """تشغيل المعاين لعدد من الثواني: ?seconds=10&interval_ms=10&format=collapsed|top&idle=0"""
+    seconds = float_arg('seconds', '10')
+    interval_ms = float_arg('interval_ms', '10')
+    if seconds is None or interval_ms is None:
+        return Response("seconds and interval_ms must be numbers\n", status=400, mimetype='text/plain')
+    seconds = min(max(seconds, 0.0), PROFILE_MAX_SECONDS)
+    interval = max(interval_ms, 1.0) / 1000.0
+    if not profile_lock.acquire(False):
+        return Response("Profiler already running\n", status=409, mimetype='text/plain')
+    try:
+        logger.info(f"Profiling for {seconds:.0f}s")
+        sampler = StackSampler(interval).run(seconds, request.args.get('idle') == '1')
+    finally:
+        profile_lock.release()
+    report = sampler.top() if request.args.get('format') == 'top' else sampler.collapsed()
+    return Response(report, status=200, mimetype='text/plain')
+
+@app.route('/debug/trace', methods=['GET', 'POST'])
+@admin_only
+def debug_trace():
+    """قراءة أو تعديل عتبة تتبع التحديثات البطيئة: POST ?threshold_ms=250 (0 للتعطيل)"""
+    if request.method == 'POST':
+        threshold_ms = float_arg('threshold_ms', '0')
+        if threshold_ms is None:
+            return Response("threshold_ms must be a number\n", status=400, mimetype='text/plain')
+        slow_update_tracer.threshold = max(threshold_ms, 0.0) / 1000.0
+        logger.info(f"Slow update threshold set to {slow_update_tracer.threshold * 1000:.0f}ms")
+    return jsonify({
+        'threshold_ms': slow_update_tracer.threshold * 1000,
+        'traced': slow_update_tracer.traced,
+        'logged': slow_update_tracer.logged
+    })
+
 # تخزين البيانات في الذاكرة
 users_data = {}
 user_messages = {}
-data_lock = threading.Lock()
+data_lock = TimedLock('data_lock')
 
 # هيكل بيانات المستخدم الافتراضي
 default_user_data = {
@@ -61,554 +562,4385 @@ evening_dhikr = [
     "اللهم إني أمسيت أشهدك، وأشهد حملة عرشك، وملائكتك، وجميع خلقك، أنك أنت الله لا إله إلا أنت، وحدك لا شريك لك، وأن محمداً عبدك ورسولك"
 ]
 
-def get_user_data(user_id):
-    with data_lock:
-        return users_data.get(user_id, {}).copy()
+# ==================== طبقة تخزين بيانات المستخدمين ====================
+# memory: في الذاكرة فقط، sqlite: ملف SQLite دائم بوضع WAL مع كتابة مؤجلة على دفعات،
+# columnar: في الذاكرة بتمثيل عمودي مضغوط لملايين المستخدمين،
+# log: التمثيل العمودي مع سجل عمليات للإضافة فقط ولقطات ثنائية دورية
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'memory')
 
-def update_user_data(user_id, data):
-    with data_lock:
-        if user_id not in users_data:
-            users_data[user_id] = default_user_data.copy()
-        users_data[user_id].update(data)
+def shard_path(path):
+    """مسار ملفات الشريحة الحالية: users.db -> users.shard1.db في العملية العاملة رقم 1"""
+    if SHARD_INDEX is None:
+        return path
+    root, ext = os.path.splitext(path.rstrip('/'))
+    return f"{root}.shard{SHARD_INDEX}{ext}"
 
-def initialize_user_data(user_id, chat_id=None):
-    with data_lock:
-        if user_id not in users_data:
-            users_data[user_id] = default_user_data.copy()
-        if chat_id is not None:
-            users_data[user_id]['chat_id'] = chat_id
-        return users_data[user_id].copy()
+SQLITE_PATH = shard_path(os.getenv('SQLITE_PATH', 'users.db'))
+STORAGE_FLUSH_MS = int(os.getenv('STORAGE_FLUSH_MS', '500'))
+STORAGE_FLUSH_OPS = int(os.getenv('STORAGE_FLUSH_OPS', '1000'))
 
-def is_user_subscribed(user_id):
-    """التحقق من اشتراك المستخدم في القناة"""
-    try:
-        chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
-    except Exception as e:
-        logger.error(f"Error checking subscription: {e}")
-        return False
+COUNTER_FIELDS = ('subhan_count', 'alhamdulillah_count', 'la_ilaha_count', 'allahu_akbar_count', 'total_count')
+USER_FIELDS = ('chat_id',) + COUNTER_FIELDS
+PREFERENCE_FIELDS = ('timezone', 'morning', 'evening')
+# صف التصدير/الاستيراد: المعرف، حقول المستخدم، معرف الرسالة الرئيسية، ثم التفضيلات
+EXPORT_FIELDS = ('user_id',) + USER_FIELDS + ('message_id',) + PREFERENCE_FIELDS
+EXPORT_MESSAGE_INDEX = len(USER_FIELDS) + 1
 
-def get_main_keyboard(user_id):
-    """إنشاء لوحة المفاتيح الرئيسية للأذكار"""
-    user_data = get_user_data(user_id)
-    
-    keyboard = types.InlineKeyboardMarkup(row_width=2)
-    
-    # أزرار الأذكار
-    keyboard.add(
-        types.InlineKeyboardButton(f"سبحان الله ({user_data['subhan_count']})", callback_data="dhikr_subhan"),
-        types.InlineKeyboardButton(f"الحمد لله ({user_data['alhamdulillah_count']})", callback_data="dhikr_alhamdulillah")
-    )
-    keyboard.add(
-        types.InlineKeyboardButton(f"لا إله إلا الله ({user_data['la_ilaha_count']})", callback_data="dhikr_la_ilaha"),
-        types.InlineKeyboardButton(f"الله اكبر ({user_data['allahu_akbar_count']})", callback_data="dhikr_allahu_akbar")
-    )
-    
-    # أزرار الخيارات
-    keyboard.add(
-        types.InlineKeyboardButton("📊 عرض إحصائياتي", callback_data="show_stats"),
-        types.InlineKeyboardButton("🗑️ مسح عدادي", callback_data="reset_counters")
-    )
-    keyboard.add(
-        types.InlineKeyboardButton("👨‍💻 المطور", callback_data="developer_info"),
-        types.InlineKeyboardButton("📤 شارك البوت", callback_data="share_bot")
-    )
-    
-    return keyboard
+# عدد أقفال الشرائح: مستخدمان في شريحتين مختلفتين لا يتنافسان على نفس القفل
+STORE_LOCK_SHARDS = int(os.getenv('STORE_LOCK_SHARDS', '64'))
 
-def get_main_message(user_id):
-    """إنشاء نص الرسالة الرئيسية"""
-    welcome_message = """
-🌺 بسم الله الرحمن الرحيم 
-اللهم صلي وسلم وبارك على سيدنا محمد 🌹
+class MemoryUserStore:
+    """تخزين بيانات المستخدمين ومعرفات رسائلهم الرئيسية وتفضيلاتهم في الذاكرة
 
-📿 *مرحباً بك في بوت نُور الذِّكْر* 
-هنا تجني الأجر وتنال الثواب بإذن الله تعالى
+    العمليات على مستخدم واحد تأخذ قفل الشريحة الخاصة به فقط، أما القفل العام
+    (data_lock) فيُستخدم لإضافة وحذف المستخدمين وسرد القائمة
+    """
 
-✨ *طريقة الاستخدام:*
-- اضغط على أي ذكر لزيادة العداد ورفع درجاتك في الجنة
-- استخدم زر "📊 عرض إحصائياتي" لمشاهدة تفاصيل أذكارك
-- شارك البوت مع أحبابك لنيل الأجر والثواب
+    def __init__(self, users, messages, lock, preferences=None, shards=STORE_LOCK_SHARDS):
+        self.users = users
+        self.messages = messages
+        self.lock = lock
+        self.preferences = preferences if preferences is not None else {}
+        self._shard_locks = [TimedLock('user_shard') for _ in range(shards)]
+        # يُستدعى (user_id, المجموع القديم، الجديد أو None عند الحذف) مع قفل شريحة المستخدم
+        self.total_listener = None
+        # يُستدعى (user_id, التفضيلات الجديدة أو None عند الحذف) مع قفل شريحة المستخدم
+        self.preferences_listener = None
 
-🌿 *فوائد الذكر:*
-• كل ذكر = 10 حسنات ⭐
-• محو الذنوب والخطايا 🍃
-• رفع الدرجات في الجنة 🕌
-• طمأنينة القلب والروح 💖
-• تقوية الإيمان واليقين ✨
-    """
-    
-    return welcome_message
+    def _shard(self, user_id):
+        return hash(user_id) % len(self._shard_locks)
 
-@bot.message_handler(commands=['start'])
-def start(message):
-    user_id = message.from_user.id
-    initialize_user_data(user_id, message.chat.id)
-    
-    # التحقق من الاشتراك
-    if is_user_subscribed(user_id):
-        show_main_menu(message)
-    else:
-        show_subscription_message(message)
+    def _lock_for(self, user_id):
+        return self._shard_locks[self._shard(user_id)]
 
-def show_subscription_message(message):
-    """عرض رسالة الاشتراك"""
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton("🔔 اشترك في القناة", url=f"https://t.me/{CHANNEL_USERNAME[1:]}")
-    )
-    keyboard.add(
-        types.InlineKeyboardButton("✅ تحقق من الاشتراك", callback_data="check_sub")
-    )
-    
-    subscription_message = f"""
-🕌 *مرحباً بك في بوت نُور الذِّكْر*
+    def _get_or_create(self, user_id):
+        """يُستدعى مع الاحتفاظ بقفل شريحة المستخدم"""
+        user = self.users.get(user_id)
+        if user is None:
+            with self.lock:
+                user = self.users[user_id] = default_user_data.copy()
+            self._mark_dirty(user_id)
+        return user
 
-⚠️ للاستفادة من البوت، يجب الاشتراك في القناة أولاً
+    def get(self, user_id):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            return user.copy() if user is not None else {}
 
-📢 القناة: {CHANNEL_USERNAME}
+    def get_counters(self, user_id):
+        """قيم العدادات بترتيب COUNTER_FIELDS دون نسخ القاموس"""
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            if user is None:
+                return (0,) * len(COUNTER_FIELDS)
+            return (user['subhan_count'], user['alhamdulillah_count'], user['la_ilaha_count'],
+                    user['allahu_akbar_count'], user['total_count'])
 
-اضغط على الزر أدناه للاشتراك، ثم اضغط "تحقق من الاشتراك"
-    """
-    
-    bot.send_message(
-        message.chat.id,
-        subscription_message,
-        parse_mode="Markdown",
-        reply_markup=keyboard
-    )
+    def update(self, user_id, data):
+        with self._lock_for(user_id):
+            user = self._get_or_create(user_id)
+            old_total = user['total_count']
+            user.update(data)
+            self._mark_dirty(user_id)
+            if user['total_count'] != old_total:
+                self._total_changed(user_id, old_total, user['total_count'])
 
-@bot.callback_query_handler(func=lambda call: call.data == 'check_sub')
-def check_subscription(call):
-    user_id = call.from_user.id
-    
-    if is_user_subscribed(user_id):
-        bot.answer_callback_query(call.id, "✅ تم التحقق من الاشتراك بنجاح!")
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        show_main_menu(call.message)
-    else:
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(
-            types.InlineKeyboardButton("🔔 اشترك الآن", url=f"https://t.me/{CHANNEL_USERNAME[1:]}")
-        )
-        keyboard.add(
-            types.InlineKeyboardButton("✅ تحقق مجدداً", callback_data="check_sub")
-        )
-        
-        bot.edit_message_text(
-            f"❌ لم يتم الاشتراك بعد!\n\nالرجاء الاشتراك في القناة {CHANNEL_USERNAME} ثم الضغط على 'تحقق مجدداً'",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-        bot.answer_callback_query(call.id, "❌ يجب الاشتراك أولاً")
+    def initialize(self, user_id, chat_id=None):
+        with self._lock_for(user_id):
+            user = self._get_or_create(user_id)
+            if chat_id is not None and user['chat_id'] != chat_id:
+                user['chat_id'] = chat_id
+                self._mark_dirty(user_id)
+            return user.copy()
 
-def show_main_menu(message):
-    """عرض القائمة الرئيسية"""
-    user_id = message.from_user.id
-    initialize_user_data(user_id, message.chat.id)
-    
-    main_message = get_main_message(user_id)
-    keyboard = get_main_keyboard(user_id)
-    
-    # إرسال الرسالة الرئيسية وحفظ معرفها
-    sent_message = bot.send_message(message.chat.id, main_message, parse_mode="Markdown", reply_markup=keyboard)
-    user_messages[user_id] = sent_message.message_id
+    def increment(self, user_id, key, amount=1):
+        """زيادة عداد الذكر والمجموع الكلي بشكل ذري؛ يُرجع المجموع الجديد"""
+        with self._lock_for(user_id):
+            user = self._get_or_create(user_id)
+            user[key] += amount
+            user['total_count'] += amount
+            self._mark_dirty(user_id)
+            self._total_changed(user_id, user['total_count'] - amount, user['total_count'])
+            return user['total_count']
 
-def update_main_menu(user_id, chat_id):
-    """تحديث القائمة الرئيسية"""
-    try:
-        if user_id in user_messages:
-            main_message = get_main_message(user_id)
-            keyboard = get_main_keyboard(user_id)
-            
-            bot.edit_message_text(
-                main_message,
-                chat_id,
-                user_messages[user_id],
-                parse_mode="Markdown",
-                reply_markup=keyboard
-            )
-        else:
-            # إعادة إنشاء القائمة إذا تم حذف الرسالة
-            main_message = get_main_message(user_id)
-            keyboard = get_main_keyboard(user_id)
-            sent_message = bot.send_message(chat_id, main_message, parse_mode="Markdown", reply_markup=keyboard)
-            user_messages[user_id] = sent_message.message_id
-    except Exception as e:
-        logger.error(f"Error updating main menu: {e}")
+    def reset(self, user_id):
+        """تصفير كل عدادات المستخدم بشكل ذري"""
+        with self._lock_for(user_id):
+            user = self._get_or_create(user_id)
+            old_total = user['total_count']
+            for field in COUNTER_FIELDS:
+                user[field] = 0
+            self._mark_dirty(user_id)
+            self._total_changed(user_id, old_total, 0)
 
-# معالجات الأذكار
-@bot.callback_query_handler(func=lambda call: call.data.startswith('dhikr_'))
-def handle_dhikr_callback(call):
-    user_id = call.from_user.id
-    initialize_user_data(user_id, call.message.chat.id)
-    
-    if not is_user_subscribed(user_id):
-        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
-        return
-    
-    user_data = get_user_data(user_id)
-    
-    dhikr_type = call.data.split('_', 1)[1]
-    
-    dhikr_responses = {
-        'subhan': {
-            'key': 'subhan_count',
-            'response': "سبحان الله وبحمده، سبحان الله العظيم 🌟"
-        },
-        'alhamdulillah': {
-            'key': 'alhamdulillah_count',
-            'response': "الحمد لله رب العالمين 🤲"
-        },
-        'la_ilaha': {
-            'key': 'la_ilaha_count',
-            'response': "لا إله إلا الله وحده لا شريك له 🕌"
-        },
-        'allahu_akbar': {
-            'key': 'allahu_akbar_count',
-            'response': "الله اكبر كبيراً والحمد لله كثيراً 🌙"
-        }
-    }
-    
-    if dhikr_type in dhikr_responses:
-        info = dhikr_responses[dhikr_type]
-        
-        # تحديث العداد
-        user_data[info['key']] += 1
-        user_data['total_count'] += 1
-        
-        # تحديث البيانات في الذاكرة
-        update_user_data(user_id, user_data)
-        
-        # رسالة التأكيد
-        confirm_msg = f"✅ {info['response']}\n💎 +10 حسنات بإذن الله"
-        
-        # إرسال إشعار غير مزعج
-        bot.answer_callback_query(call.id, confirm_msg, show_alert=False)
-        
-        # تحديث القائمة الرئيسية
-        update_main_menu(user_id, call.message.chat.id)
+    def delete(self, user_id):
+        with self._lock_for(user_id):
+            with self.lock:
+                user = self.users.pop(user_id, None)
+                self.messages.pop(user_id, None)
+                self.preferences.pop(user_id, None)
+            self._mark_deleted(user_id)
+            self._preferences_changed(user_id, None)
+            if user is not None:
+                self._total_changed(user_id, user['total_count'], None)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'show_stats')
-def show_stats(call):
-    user_id = call.from_user.id
-    initialize_user_data(user_id, call.message.chat.id)
-    user_data = get_user_data(user_id)
-    
-    if not is_user_subscribed(user_id):
-        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
-        return
-    
-    total = user_data['total_count']
-    hasanat = total * 10
-    
-    stats_message = f"""
-📊 *إحصائيات أذكارك التفصيلية:*
+    def user_ids(self):
+        with self.lock:
+            return list(self.users.keys())
 
-• سبحان الله: {user_data['subhan_count']} مرة 🌟
-• الحمد لله: {user_data['alhamdulillah_count']} مرة 🤲
-• لا إله إلا الله: {user_data['la_ilaha_count']} مرة 🕌
-• الله أكبر: {user_data['allahu_akbar_count']} مرة 🌙
+    def iter_totals(self):
+        """(user_id, المجموع الكلي) لكل المستخدمين من لقطة دون أخذ أقفال الشرائح"""
+        for user_id, user in list(self.users.items()):
+            yield user_id, user['total_count']
 
-📈 *المجموع الكلي:* {total} ذكر
-💎 *الحسنات المكتسبة:* {hasanat} حسنة بإذن الله
+    def _total_changed(self, user_id, old_total, new_total):
+        if self.total_listener is not None and old_total != new_total:
+            self.total_listener(user_id, old_total, new_total)
 
-✨ واصل ذكر الله لترتفع درجاتك في الجنة
-    """
-    
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")
-    )
-    
-    bot.edit_message_text(
-        stats_message,
-        call.message.chat.id,
-        call.message.message_id,
-        parse_mode="Markdown",
-        reply_markup=keyboard
-    )
+    def _preferences_changed(self, user_id, prefs):
+        if self.preferences_listener is not None:
+            self.preferences_listener(user_id, prefs)
 
-@bot.callback_query_handler(func=lambda call: call.data == 'reset_counters')
+    def count(self):
+        return len(self.users)
+
+    def get_message_id(self, user_id):
+        return self.messages.get(user_id)
+
+    def set_message_id(self, user_id, message_id):
+        with self._lock_for(user_id):
+            self.messages[user_id] = message_id
+            self._mark_dirty(user_id)
+
+    def get_preferences(self, user_id):
+        """تفضيلات التذكير: المنطقة الزمنية وأوقات الصباح والمساء"""
+        prefs = self.preferences.get(user_id)
+        return dict(prefs) if prefs else {}
+
+    def set_preferences(self, user_id, prefs):
+        with self._lock_for(user_id):
+            current = self.preferences.get(user_id, {})
+            merged = self.preferences[user_id] = {**current, **prefs}
+            self._mark_dirty(user_id)
+            self._preferences_changed(user_id, merged)
+
+    def all_preferences(self):
+        with self.lock:
+            items = list(self.preferences.items())
+        return {user_id: dict(prefs) for user_id, prefs in items}
+
+    def export_chunks(self, chunk_size=1000):
+        """صفوف كل المستخدمين بترتيب EXPORT_FIELDS على دفعات
+
+        لا يُنسخ مسبقاً إلا مصفوفة المعرفات (8 بايت لكل مستخدم)؛ كل دفعة تُقرأ شريحة بشريحة
+        مع قفل الشريحة فقط، فكل صف متسق والنقرات لا تنتظر إلا قراءة بضعة صفوف
+        """
+        with self.lock:
+            user_ids = array('q', self._user_keys())
+        for start in range(0, len(user_ids), chunk_size):
+            by_shard = {}
+            for user_id in user_ids[start:start + chunk_size]:
+                by_shard.setdefault(self._shard(user_id), []).append(user_id)
+            rows = []
+            for shard, members in by_shard.items():
+                with self._shard_locks[shard]:
+                    self._export_rows(members, rows)
+            yield rows
+
+    def import_rows(self, rows):
+        """استبدال بيانات المستخدمين بصفوف بترتيب EXPORT_FIELDS (قفل شريحة واحد لكل صف)"""
+        count = 0
+        for row in rows:
+            with self._lock_for(row[0]):
+                self._import_row(row)
+            count += 1
+        return count
+
+    def _user_keys(self):
+        return self.users.keys()
+
+    def _export_rows(self, user_ids, rows):
+        """يُستدعى مع قفل شريحة المستخدمين؛ المحذوفون بعد أخذ قائمة المعرفات يُتجاوزون"""
+        for user_id in user_ids:
+            user = self.users.get(user_id)
+            if user is None:
+                continue
+            prefs = self.preferences.get(user_id) or {}
+            rows.append((user_id,) + tuple(user[field] for field in USER_FIELDS) + (self.messages.get(user_id),)
+                        + tuple(prefs.get(field) for field in PREFERENCE_FIELDS))
+
+    def _import_row(self, row):
+        """يُستدعى مع قفل شريحة المستخدم"""
+        user_id = row[0]
+        user = self._get_or_create(user_id)
+        old_total = user['total_count']
+        user.update(zip(USER_FIELDS, row[1:EXPORT_MESSAGE_INDEX]))
+        if row[EXPORT_MESSAGE_INDEX] is None:
+            self.messages.pop(user_id, None)
+        else:
+            self.messages[user_id] = row[EXPORT_MESSAGE_INDEX]
+        self._import_preferences(user_id, row)
+        self._mark_dirty(user_id)
+        self._total_changed(user_id, old_total, user['total_count'])
+
+    def _import_preferences(self, user_id, row):
+        prefs = {field: value for field, value in zip(PREFERENCE_FIELDS, row[EXPORT_MESSAGE_INDEX + 1:]) if value}
+        if prefs:
+            self.preferences[user_id] = prefs
+        else:
+            self.preferences.pop(user_id, None)
+        self._preferences_changed(user_id, prefs)
+        return prefs
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _mark_dirty(self, user_id):
+        pass
+
+    def _mark_deleted(self, user_id):
+        pass
+
+class SQLiteUserStore(MemoryUserStore):
+    """تخزين دائم في SQLite (WAL): القراءة من الذاكرة والتغييرات تُكتب على دفعات في معاملة واحدة"""
+
+    def __init__(self, path, users, messages, lock, flush_ms=500, flush_ops=1000):
+        super().__init__(users, messages, lock)
+        self.path = path
+        self.flush_interval = flush_ms / 1000.0
+        self.flush_ops = flush_ops
+        # مجموعات التغييرات المعلقة لكل شريحة، محمية بقفل الشريحة نفسه
+        self._dirty = [set() for _ in self._shard_locks]
+        self._deleted = [set() for _ in self._shard_locks]
+        # مستخدمون أُفرغت تفضيلاتهم (استيراد صف بلا تفضيلات): صفهم في جدول التفضيلات يُحذف
+        self._cleared_preferences = [set() for _ in self._shard_locks]
+        # عدد التغييرات منذ آخر تفريغ؛ يُزاد من خيوط المعالجات ويُصفر من خيط الكتابة
+        self._pending_ops = 0
+        self._ops_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.flushes = 0
+        self.rows_written = 0
+        
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # في وضع WAL يكفي NORMAL: لا fsync عند كل معاملة مع بقاء القاعدة سليمة بعد الانهيار
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, chat_id INTEGER, "
+            "subhan_count INTEGER NOT NULL DEFAULT 0, alhamdulillah_count INTEGER NOT NULL DEFAULT 0, "
+            "la_ilaha_count INTEGER NOT NULL DEFAULT 0, allahu_akbar_count INTEGER NOT NULL DEFAULT 0, "
+            "total_count INTEGER NOT NULL DEFAULT 0, message_id INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS preferences ("
+            "user_id INTEGER PRIMARY KEY, timezone TEXT, morning TEXT, evening TEXT)"
+        )
+        self._load()
+        
+        self._thread = threading.Thread(target=self._run, name='sqlite-flusher', daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        """تحميل كل المستخدمين إلى الذاكرة عند بدء التشغيل"""
+        columns = ', '.join(('user_id',) + USER_FIELDS + ('message_id',))
+        with self.lock:
+            for row in self._conn.execute(f"SELECT {columns} FROM users"):
+                user_id = row[0]
+                self.users[user_id] = dict(zip(USER_FIELDS, row[1:-1]))
+                if row[-1] is not None:
+                    self.messages[user_id] = row[-1]
+            for row in self._conn.execute(f"SELECT user_id, {', '.join(PREFERENCE_FIELDS)} FROM preferences"):
+                self.preferences[row[0]] = {k: v for k, v in zip(PREFERENCE_FIELDS, row[1:]) if v is not None}
+        logger.info(f"Loaded {len(self.users)} users from {self.path}")
+
+    def _mark_dirty(self, user_id):
+        shard = self._shard(user_id)
+        self._dirty[shard].add(user_id)
+        self._deleted[shard].discard(user_id)
+        with self._ops_lock:
+            self._pending_ops += 1
+            pending = self._pending_ops
+        if pending >= self.flush_ops:
+            self._wakeup.set()
+
+    def _mark_deleted(self, user_id):
+        shard = self._shard(user_id)
+        self._dirty[shard].discard(user_id)
+        self._deleted[shard].add(user_id)
+
+    def _import_preferences(self, user_id, row):
+        prefs = super()._import_preferences(user_id, row)
+        if not prefs:
+            self._cleared_preferences[self._shard(user_id)].add(user_id)
+        return prefs
+
+    def flush(self):
+        """كتابة كل التغييرات المعلقة في معاملة واحدة"""
+        with self._flush_lock:
+            rows = []
+            preference_rows = []
+            deleted = []
+            cleared = []
+            with self._ops_lock:
+                self._pending_ops = 0
+            # أخذ لقطة شريحة بشريحة حتى لا تتوقف كل النقرات أثناء التفريغ
+            for shard, shard_lock in enumerate(self._shard_locks):
+                with shard_lock:
+                    dirty, self._dirty[shard] = self._dirty[shard], set()
+                    removed, self._deleted[shard] = self._deleted[shard], set()
+                    emptied, self._cleared_preferences[shard] = self._cleared_preferences[shard], set()
+                    for user_id in dirty:
+                        user = self.users.get(user_id)
+                        if user is not None:
+                            rows.append((user_id,) + tuple(user[f] for f in USER_FIELDS) + (self.messages.get(user_id),))
+                        prefs = self.preferences.get(user_id)
+                        if prefs:
+                            preference_rows.append((user_id,) + tuple(prefs.get(f) for f in PREFERENCE_FIELDS))
+                    deleted.extend((user_id,) for user_id in removed)
+                    # تفضيلات عُينت من جديد بعد الإفراغ تُكتب أعلاه بدلاً من الحذف
+                    cleared.extend((user_id,) for user_id in emptied if not self.preferences.get(user_id))
+            if not rows and not deleted and not cleared:
+                return
+            
+            placeholders = ', '.join('?' * (len(USER_FIELDS) + 2))
+            columns = ', '.join(('user_id',) + USER_FIELDS + ('message_id',))
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(f"INSERT OR REPLACE INTO users ({columns}) VALUES ({placeholders})", rows)
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO preferences (user_id, {', '.join(PREFERENCE_FIELDS)}) VALUES (?, ?, ?, ?)",
+                    preference_rows
+                )
+                self._conn.executemany("DELETE FROM users WHERE user_id = ?", deleted)
+                self._conn.executemany("DELETE FROM preferences WHERE user_id = ?", deleted + cleared)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                for (user_id,) in cleared:
+                    with self._lock_for(user_id):
+                        self._cleared_preferences[self._shard(user_id)].add(user_id)
+                # إعادة المستخدمين إلى قائمة التغييرات المعلقة لمحاولة لاحقة
+                for row in rows:
+                    with self._lock_for(row[0]):
+                        if row[0] not in self._deleted[self._shard(row[0])]:
+                            self._dirty[self._shard(row[0])].add(row[0])
+                for (user_id,) in deleted:
+                    with self._lock_for(user_id):
+                        if user_id not in self._dirty[self._shard(user_id)]:
+                            self._deleted[self._shard(user_id)].add(user_id)
+                raise
+            self.flushes += 1
+            self.rows_written += len(rows) + len(deleted)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing user store: {e}")
+
+    def close(self):
+        """إيقاف خيط الكتابة وتفريغ التغييرات المتبقية قبل الإغلاق"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        self._conn.close()
+        logger.info(f"User store flushed and closed ({self.rows_written} rows written)")
+
+# قيمة تمثل None في الأعمدة الرقمية (chat_id و message_id)
+NULL_ID = -(2 ** 63)
+
+class ColumnarUserStore(MemoryUserStore):
+    """تخزين عمودي مضغوط لملايين المستخدمين: فهرس من user_id إلى رقم صف وأعمدة array لكل حقل
+
+    الصفوف المحذوفة تُعاد استخدامها ولا تُنقل أبداً، لذا يبقى رقم صف المستخدم ثابتاً
+    ويكفي قفل شريحته للقراءة والتعديل
+    """
+
+    def __init__(self, lock, preferences=None, shards=STORE_LOCK_SHARDS):
+        super().__init__({}, {}, lock, preferences, shards)
+        self.index = {}  # user_id -> رقم الصف
+        self.columns = {field: array('q') for field in USER_FIELDS + ('message_id',)}
+        self._chat_ids = self.columns['chat_id']
+        self._message_ids = self.columns['message_id']
+        self._totals = self.columns['total_count']
+        self._counter_columns = tuple(self.columns[field] for field in COUNTER_FIELDS)
+        self._free_rows = []
+
+    def _row_or_create(self, user_id):
+        """يُستدعى مع الاحتفاظ بقفل شريحة المستخدم"""
+        row = self.index.get(user_id)
+        if row is None:
+            with self.lock:
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                    for column in self.columns.values():
+                        column[row] = 0
+                else:
+                    row = len(self._chat_ids)
+                    for column in self.columns.values():
+                        column.append(0)
+                self._chat_ids[row] = NULL_ID
+                self._message_ids[row] = NULL_ID
+                self.index[user_id] = row
+            self._mark_dirty(user_id)
+        return row
+
+    def _row_dict(self, row):
+        chat_id = self._chat_ids[row]
+        data = {'chat_id': None if chat_id == NULL_ID else chat_id}
+        for field, column in zip(COUNTER_FIELDS, self._counter_columns):
+            data[field] = column[row]
+        return data
+
+    def get(self, user_id):
+        with self._lock_for(user_id):
+            row = self.index.get(user_id)
+            return self._row_dict(row) if row is not None else {}
+
+    def get_counters(self, user_id):
+        with self._lock_for(user_id):
+            row = self.index.get(user_id)
+            if row is None:
+                return (0,) * len(COUNTER_FIELDS)
+            return tuple(column[row] for column in self._counter_columns)
+
+    def update(self, user_id, data):
+        with self._lock_for(user_id):
+            row = self._row_or_create(user_id)
+            old_total = self._totals[row]
+            for field, value in data.items():
+                if field not in USER_FIELDS:
+                    raise KeyError(f"Unknown user field: {field}")
+                self.columns[field][row] = NULL_ID if value is None else value
+            self._mark_dirty(user_id)
+            self._total_changed(user_id, old_total, self._totals[row])
+
+    def initialize(self, user_id, chat_id=None):
+        with self._lock_for(user_id):
+            row = self._row_or_create(user_id)
+            if chat_id is not None and self._chat_ids[row] != chat_id:
+                self._chat_ids[row] = chat_id
+                self._mark_dirty(user_id)
+            return self._row_dict(row)
+
+    def increment(self, user_id, key, amount=1):
+        with self._lock_for(user_id):
+            row = self._row_or_create(user_id)
+            self.columns[key][row] += amount
+            self._totals[row] += amount
+            self._mark_dirty(user_id)
+            self._total_changed(user_id, self._totals[row] - amount, self._totals[row])
+            return self._totals[row]
+
+    def reset(self, user_id):
+        with self._lock_for(user_id):
+            row = self._row_or_create(user_id)
+            old_total = self._totals[row]
+            for column in self._counter_columns:
+                column[row] = 0
+            self._mark_dirty(user_id)
+            self._total_changed(user_id, old_total, 0)
+
+    def delete(self, user_id):
+        with self._lock_for(user_id):
+            with self.lock:
+                row = self.index.pop(user_id, None)
+                if row is not None:
+                    old_total = self._totals[row]
+                    self._free_rows.append(row)
+                self.preferences.pop(user_id, None)
+            self._mark_deleted(user_id)
+            self._preferences_changed(user_id, None)
+            if row is not None:
+                self._total_changed(user_id, old_total, None)
+
+    def user_ids(self):
+        with self.lock:
+            return list(self.index.keys())
+
+    def _user_keys(self):
+        return self.index.keys()
+
+    def _export_rows(self, user_ids, rows):
+        chat_ids, message_ids = self._chat_ids, self._message_ids
+        counters = self._counter_columns
+        no_prefs = (None,) * len(PREFERENCE_FIELDS)
+        for user_id in user_ids:
+            position = self.index.get(user_id)
+            if position is None:
+                continue
+            chat_id, message_id = chat_ids[position], message_ids[position]
+            prefs = self.preferences.get(user_id)
+            rows.append(
+                (user_id, None if chat_id == NULL_ID else chat_id)
+                + tuple(column[position] for column in counters)
+                + (None if message_id == NULL_ID else message_id,)
+                + (tuple(prefs.get(field) for field in PREFERENCE_FIELDS) if prefs else no_prefs)
+            )
+
+    def _import_row(self, row):
+        user_id = row[0]
+        position = self._row_or_create(user_id)
+        old_total = self._totals[position]
+        for field, value in zip(USER_FIELDS + ('message_id',), row[1:EXPORT_MESSAGE_INDEX + 1]):
+            self.columns[field][position] = NULL_ID if value is None else value
+        self._import_preferences(user_id, row)
+        self._mark_dirty(user_id)
+        self._total_changed(user_id, old_total, self._totals[position])
+
+    def iter_totals(self):
+        totals = self._totals
+        for user_id, row in list(self.index.items()):
+            yield user_id, totals[row]
+
+    def count(self):
+        return len(self.index)
+
+    def get_message_id(self, user_id):
+        with self._lock_for(user_id):
+            row = self.index.get(user_id)
+            if row is None or self._message_ids[row] == NULL_ID:
+                return None
+            return self._message_ids[row]
+
+    def set_message_id(self, user_id, message_id):
+        with self._lock_for(user_id):
+            row = self._row_or_create(user_id)
+            self._message_ids[row] = NULL_ID if message_id is None else message_id
+            self._mark_dirty(user_id)
+
+# سجل العمليات: مجلد الملفات، الفاصل بين اللقطات، حجم السجل الذي يستدعي لقطة مبكرة، وfsync بعد كل تفريغ
+LOG_STORE_DIR = shard_path(os.getenv('LOG_STORE_DIR', 'data'))
+LOG_SNAPSHOT_INTERVAL = float(os.getenv('LOG_SNAPSHOT_INTERVAL', '600'))
+LOG_SNAPSHOT_BYTES = int(os.getenv('LOG_SNAPSHOT_BYTES', str(32 * 2 ** 20)))
+LOG_FSYNC = os.getenv('LOG_FSYNC', '1') == '1'
+
+# أنواع السجلات: صف كامل (قيم مطلقة فيُعاد تطبيقها بأمان)، حذف، وتفضيلات بصيغة JSON
+LOG_ROW = struct.Struct('<Bq7q')
+LOG_DELETE = struct.Struct('<Bq')
+LOG_PREFS = struct.Struct('<BqI')
+OP_ROW, OP_DELETE, OP_PREFS = 1, 2, 3
+SNAPSHOT_MAGIC = b'NZS1'
+SNAPSHOT_HEADER = struct.Struct('<4sQQQ')  # magic، رقم أول سجل بعد اللقطة، عدد الصفوف، حجم التفضيلات
+SNAPSHOT_COLUMNS = ('user_id',) + USER_FIELDS + ('message_id',)
+
+class LogUserStore(ColumnarUserStore):
+    """تخزين عمودي دائم: سجل عمليات ثنائي للإضافة فقط مع لقطات ثنائية مضغوطة دورية
+
+    كل تغيير يُضاف إلى ذاكرة مؤقتة بقيم الصف المطلقة، وخيط خلفي يكتبها إلى ملف السجل.
+    اللقطة تبدأ سجلاً جديداً ثم تنسخ الأعمدة، فالسجلات المتداخلة مع اللقطة تُعاد دون ضرر.
+    عند التشغيل تُحمّل آخر لقطة عبر mmap ثم تُعاد السجلات التالية لها
+    """
+
+    def __init__(self, lock, directory, flush_ms=500, snapshot_interval=600, snapshot_bytes=32 * 2 ** 20, fsync=True):
+        super().__init__(lock)
+        self.directory = directory
+        self.flush_interval = flush_ms / 1000.0
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync = fsync
+        self._buffer = None  # None أثناء التحميل حتى لا تُسجل العمليات المعادة
+        self._buffer_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.snapshots = 0
+        self.replayed = 0
+        self.bytes_logged = 0
+        
+        os.makedirs(directory, exist_ok=True)
+        start = time.perf_counter()
+        self.generation = self._load_snapshot()
+        self.generation = max([self.generation] + [self._replay(g) + 1 for g in self._log_generations(self.generation)])
+        logger.info(
+            f"Loaded {len(self.index)} users from {directory} in {time.perf_counter() - start:.2f}s "
+            f"({self.replayed} log records replayed)"
+        )
+        
+        self._buffer = bytearray()
+        self._log = open(self._log_path(self.generation), 'ab')
+        self._last_snapshot = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='oplog-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot.bin')
+
+    def _log_path(self, generation):
+        return os.path.join(self.directory, f"oplog.{generation:08d}.log")
+
+    def _log_generations(self, first):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith('oplog.') and name.endswith('.log'):
+                generation = int(name[6:-4])
+                if generation >= first:
+                    generations.append(generation)
+        return sorted(generations)
+
+    # ---------- المسار الساخن ----------
+
+    def _mark_dirty(self, user_id):
+        """يُستدعى مع قفل شريحة المستخدم بعد التغيير: إضافة الصف كاملاً إلى السجل"""
+        if self._buffer is None:
+            return
+        row = self.index.get(user_id)
+        if row is None:
+            return
+        columns = self.columns
+        record = LOG_ROW.pack(
+            OP_ROW, user_id, columns['chat_id'][row], columns['subhan_count'][row],
+            columns['alhamdulillah_count'][row], columns['la_ilaha_count'][row],
+            columns['allahu_akbar_count'][row], columns['total_count'][row], columns['message_id'][row]
+        )
+        with self._buffer_lock:
+            self._buffer += record
+
+    def _mark_deleted(self, user_id):
+        if self._buffer is None:
+            return
+        with self._buffer_lock:
+            self._buffer += LOG_DELETE.pack(OP_DELETE, user_id)
+
+    def set_preferences(self, user_id, prefs):
+        with self._lock_for(user_id):
+            merged = self.preferences[user_id] = {**self.preferences.get(user_id, {}), **prefs}
+            self._log_preferences(user_id, merged)
+            self._preferences_changed(user_id, merged)
+
+    def _import_preferences(self, user_id, row):
+        prefs = super()._import_preferences(user_id, row)
+        self._log_preferences(user_id, prefs)
+        return prefs
+
+    def _log_preferences(self, user_id, prefs):
+        """يُستدعى مع قفل شريحة المستخدم"""
+        if self._buffer is None:
+            return
+        payload = json.dumps(prefs).encode('utf-8')
+        with self._buffer_lock:
+            self._buffer += LOG_PREFS.pack(OP_PREFS, user_id, len(payload)) + payload
+
+    # ---------- الكتابة في الخلفية ----------
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if (time.monotonic() - self._last_snapshot >= self.snapshot_interval
+                        or self._log.tell() >= self.snapshot_bytes):
+                    self.snapshot()
+            except Exception as e:
+                logger.error(f"Error writing operation log: {e}")
+
+    def flush(self):
+        """كتابة السجلات المتراكمة إلى ملف السجل الحالي"""
+        with self._file_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """يُستدعى مع قفل الملف"""
+        with self._buffer_lock:
+            pending, self._buffer = self._buffer, bytearray()
+        if pending:
+            self._log.write(pending)
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self.bytes_logged += len(pending)
+
+    def snapshot(self):
+        """بدء سجل جديد ثم كتابة لقطة ثنائية لكل الأعمدة وحذف السجلات السابقة لها"""
+        start = time.perf_counter()
+        with self._file_lock:
+            self._write_pending()
+            self._log.close()
+            self.generation += 1
+            self._log = open(self._log_path(self.generation), 'ab')
+        generation = self.generation
+        
+        # نسخ الأعمدة بعد بدء السجل الجديد؛ ما يتغير أثناء النسخ موجود في السجل الجديد أيضاً
+        with self.lock:
+            rows = len(self._chat_ids)
+            index = list(self.index.items())
+            columns = {field: self.columns[field][:rows] for field in SNAPSHOT_COLUMNS[1:]}
+            # set_preferences يضيف مفاتيح مع قفل الشريحة فقط: نسخة واحدة بـ list() بدلاً من المرور على القاموس
+            preferences = list(self.preferences.items())
+        preferences = {str(user_id): prefs for user_id, prefs in preferences}
+        user_ids = array('q', [NULL_ID]) * rows
+        for user_id, row in index:
+            user_ids[row] = user_id
+        columns['user_id'] = user_ids
+        prefs_payload = json.dumps(preferences).encode('utf-8')
+        
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, rows, len(prefs_payload)))
+            for field in SNAPSHOT_COLUMNS:
+                f.write(columns[field].tobytes())
+            f.write(prefs_payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        
+        for old in self._log_generations(0):
+            if old < generation:
+                os.remove(self._log_path(old))
+        self._last_snapshot = time.monotonic()
+        self.snapshots += 1
+        logger.info(f"Snapshot of {len(index)} users written in {time.perf_counter() - start:.2f}s")
+
+    def close(self):
+        """إيقاف الكاتب وكتابة لقطة أخيرة حتى يكون التشغيل التالي سريعاً"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.snapshot()
+        self._log.close()
+
+    # ---------- التحميل ----------
+
+    def _load_snapshot(self):
+        """تحميل اللقطة إن وجدت؛ يُرجع رقم أول سجل يجب إعادته بعدها"""
+        if not os.path.exists(self.snapshot_path):
+            return 0
+        with open(self.snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, generation, rows, prefs_size = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"Unknown snapshot format in {self.snapshot_path}")
+            offset = SNAPSHOT_HEADER.size
+            loaded = {}
+            # نسخ الأعمدة مباشرة من الصفحات المعيّنة دون نسخة bytes وسيطة
+            with memoryview(data) as view:
+                for field in SNAPSHOT_COLUMNS:
+                    column = array('q')
+                    column.frombytes(view[offset:offset + rows * 8])
+                    loaded[field] = column
+                    offset += rows * 8
+            preferences = json.loads(data[offset:offset + prefs_size].decode('utf-8'))
+        
+        user_ids = loaded.pop('user_id')
+        self.columns.update(loaded)
+        self._chat_ids = self.columns['chat_id']
+        self._message_ids = self.columns['message_id']
+        self._totals = self.columns['total_count']
+        self._counter_columns = tuple(self.columns[field] for field in COUNTER_FIELDS)
+        self.index = {user_id: row for row, user_id in enumerate(user_ids) if user_id != NULL_ID}
+        self._free_rows = [row for row, user_id in enumerate(user_ids) if user_id == NULL_ID] if len(self.index) < rows else []
+        self.preferences.update((int(user_id), prefs) for user_id, prefs in preferences.items())
+        return generation
+
+    def _replay(self, generation):
+        """إعادة تطبيق سجل عمليات؛ السجل الأخير المبتور (انهيار أثناء الكتابة) يُقص من الملف"""
+        path = self._log_path(generation)
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset, size = 0, len(data)
+        while offset < size:
+            op = data[offset]
+            if op == OP_ROW and offset + LOG_ROW.size <= size:
+                _, user_id, *values = LOG_ROW.unpack_from(data, offset)
+                row = self._row_or_create(user_id)
+                for field, value in zip(SNAPSHOT_COLUMNS[1:], values):
+                    self.columns[field][row] = value
+                offset += LOG_ROW.size
+            elif op == OP_DELETE and offset + LOG_DELETE.size <= size:
+                _, user_id = LOG_DELETE.unpack_from(data, offset)
+                self.delete(user_id)
+                offset += LOG_DELETE.size
+            elif op == OP_PREFS and offset + LOG_PREFS.size <= size:
+                _, user_id, length = LOG_PREFS.unpack_from(data, offset)
+                end = offset + LOG_PREFS.size + length
+                if end > size:
+                    break
+                self.preferences[user_id] = json.loads(data[offset + LOG_PREFS.size:end].decode('utf-8'))
+                offset = end
+            else:
+                break
+            self.replayed += 1
+        if offset < size:
+            logger.warning(f"Truncating {size - offset} trailing bytes from {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return generation
+
+def create_user_store():
+    """إنشاء طبقة التخزين حسب متغير البيئة STORAGE_BACKEND"""
+    if SHARD_WORKERS and SHARD_INDEX is None:
+        # الموزع لا يعالج التحديثات؛ بيانات المستخدمين تملكها العمليات العاملة
+        return MemoryUserStore(users_data, user_messages, data_lock)
+    if STORAGE_BACKEND == 'log':
+        return LogUserStore(data_lock, LOG_STORE_DIR, STORAGE_FLUSH_MS, LOG_SNAPSHOT_INTERVAL, LOG_SNAPSHOT_BYTES, LOG_FSYNC)
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteUserStore(SQLITE_PATH, users_data, user_messages, data_lock, STORAGE_FLUSH_MS, STORAGE_FLUSH_OPS)
+    if STORAGE_BACKEND == 'columnar':
+        return ColumnarUserStore(data_lock)
+    return MemoryUserStore(users_data, user_messages, data_lock)
+
+# طرق التخزين المقيسة كخطوة store في تتبع التحديثات البطيئة
+TRACED_STORE_METHODS = (
+    'get', 'get_counters', 'update', 'increment', 'initialize', 'reset', 'delete',
+    'get_message_id', 'set_message_id', 'get_preferences', 'set_preferences'
+)
+
+def trace_store_access(store):
+    for method in TRACED_STORE_METHODS:
+        setattr(store, method, traced_step('store', getattr(store, method)))
+    return store
+
+user_store = trace_store_access(create_user_store())
+atexit.register(user_store.close)
+
+# ==================== تصدير واستيراد بيانات المستخدمين ====================
+# عدد المستخدمين في كل دفعة: الذاكرة المستخدمة ثابتة بحجم الدفعة مهما كان عدد المستخدمين
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '200'))
+EXPORT_FORMATS = ('ndjson', 'csv')
+# الحقول النصية؛ الباقي أعداد صحيحة، والمعرف والعدادات إلزامية
+EXPORT_TEXT_FIELDS = frozenset(PREFERENCE_FIELDS)
+EXPORT_REQUIRED_FIELDS = frozenset(('user_id',) + COUNTER_FIELDS)
+EXPORT_INTEGER_COLUMNS = tuple(
+    (index, field, field in EXPORT_REQUIRED_FIELDS)
+    for index, field in enumerate(EXPORT_FIELDS) if field not in EXPORT_TEXT_FIELDS
+)
+# سطر NDJSON بقالب ثابت: أسرع بعدة مرات من json.dumps لقاموس لكل صف
+NDJSON_TEMPLATE = '{' + ','.join(f'"{field}":%s' for field in EXPORT_FIELDS) + '}\n'
+
+def _json_scalar(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+def format_rows(rows, fmt):
+    """نص دفعة من الصفوف بصيغة ndjson أو csv"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(
+            ['' if value is None else value for value in row] for row in rows
+        )
+        return buffer.getvalue()
+    return ''.join(NDJSON_TEMPLATE % tuple(map(_json_scalar, row)) for row in rows)
+
+def export_stream(store, fmt='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    """تدفق نصي لكل المستخدمين، دفعة بعد دفعة"""
+    if fmt == 'csv':
+        yield ','.join(EXPORT_FIELDS) + '\n'
+    for rows in store.export_chunks(chunk_size):
+        if rows:
+            yield format_rows(rows, fmt)
+        # التصدير يشغل المعالج؛ ترك GIL بين الدفعات يجعل انتظار النقرات بطول دفعة لا بطول فترة التبديل (5ms)
+        time.sleep(0)
+
+def check_row(row, line_number):
+    """رفض الصف الذي ينقصه المعرف أو أحد العدادات، أو فيه قيمة غير صحيحة في حقل رقمي"""
+    for index, field, required in EXPORT_INTEGER_COLUMNS:
+        value = row[index]
+        if value is None:
+            if required:
+                raise ValueError(f"Line {line_number}: missing {field}")
+        elif type(value) is not int:
+            raise ValueError(f"Line {line_number}: {field} must be an integer, got {value!r}")
+    return row
+
+def parse_rows(lines, fmt='ndjson'):
+    """صفوف بترتيب EXPORT_FIELDS من أسطر ndjson أو csv؛ السطر غير الصالح يرفع ValueError برقمه"""
+    if fmt == 'csv':
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if header is not None and tuple(header) != EXPORT_FIELDS:
+            raise ValueError(f"Unexpected CSV header: {header}")
+        for values in reader:
+            if len(values) != len(EXPORT_FIELDS):
+                raise ValueError(f"Line {reader.line_num}: expected {len(EXPORT_FIELDS)} fields, got {len(values)}")
+            try:
+                row = tuple(
+                    (value or None) if field in EXPORT_TEXT_FIELDS else (int(value) if value else None)
+                    for field, value in zip(EXPORT_FIELDS, values)
+                )
+            except ValueError as e:
+                raise ValueError(f"Line {reader.line_num}: {e}") from None
+            yield check_row(row, reader.line_num)
+        return
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {line_number}: {e}") from None
+            yield check_row(tuple(record.get(field) for field in EXPORT_FIELDS), line_number)
+
+def import_stream(store, lines, fmt='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    """استيراد الأسطر على دفعات؛ يُرجع عدد المستخدمين المستوردين"""
+    rows = parse_rows(lines, fmt)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        count += store.import_rows(chunk)
+
+@app.route('/export')
+@admin_only
+def export_users():
+    """تنزيل كل المستخدمين كتدفق دون إيقاف النقرات: ?format=ndjson|csv"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return Response(f"Unknown format, use one of {', '.join(EXPORT_FORMATS)}\n", status=400, mimetype='text/plain')
+    return Response(
+        export_stream(user_store, fmt),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename=users.{fmt}'}
+    )
+
+def run_data_command(argv):
+    """أوامر سطر الأوامر على التخزين المحدد في متغيرات البيئة (والبوت متوقف):
+    python tast3.py export [--format csv] [--output users.csv]
+    python tast3.py import users.ndjson
+    """
+    parser = argparse.ArgumentParser(prog='tast3.py', description='Export or import user data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write all users as NDJSON or CSV')
+    export.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    export.add_argument('--output', default='-', help='file path, or - for stdout')
+    load = commands.add_parser('import', help='load users from an export file')
+    load.add_argument('path')
+    load.add_argument('--format', choices=EXPORT_FORMATS, help='default: from the file extension')
+    args = parser.parse_args(argv)
+    if args.command == 'import' and not isinstance(user_store, (SQLiteUserStore, LogUserStore)):
+        # التخزين في الذاكرة يضيع عند خروج الأمر، فالاستيراد إليه لا أثر له
+        parser.error(
+            f"import needs a persistent store (STORAGE_BACKEND=sqlite or log, and SHARD_INDEX when sharded); "
+            f"the current {type(user_store).__name__} is in memory only and would be lost on exit"
+        )
+    
+    start = time.perf_counter()
+    try:
+        if args.command == 'export':
+            output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+            try:
+                for text in export_stream(user_store, args.format):
+                    output.write(text)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+            logger.info(f"Exported {user_store.count()} users in {time.perf_counter() - start:.2f}s")
+        else:
+            fmt = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+            with open(args.path, encoding='utf-8', newline='') as f:
+                count = import_stream(user_store, f, fmt)
+            logger.info(f"Imported {count} users in {time.perf_counter() - start:.2f}s")
+    except ValueError as e:
+        # الدفعات السابقة للسطر غير الصالح مستوردة بالفعل
+        logger.error(f"Import stopped: {e}")
+        return 1
+    finally:
+        user_store.close()
+    return 0
+
+# ==================== لوحة المتصدرين ====================
+# عدد المستخدمين المحفوظين في قائمة الأوائل وعدد المستخدمين في كل صفحة
+LEADERBOARD_TOP_SIZE = int(os.getenv('LEADERBOARD_TOP_SIZE', '100'))
+LEADERBOARD_PAGE_SIZE = int(os.getenv('LEADERBOARD_PAGE_SIZE', '10'))
+# أكبر مجموع تغطيه شجرة الترتيب (تُقرب لقوة 2؛ 8 بايت لكل قيمة)، وما فوقه في قائمة مرتبة صغيرة
+LEADERBOARD_INDEX_MAX = int(os.getenv('LEADERBOARD_INDEX_MAX', str(2 ** 20)))
+
+class Leaderboard:
+    """ترتيب المستخدمين حسب المجموع الكلي يُحدّث مع كل تغيير بدلاً من الفرز عند كل طلب
+
+    شجرة فنويك على قيم المجموع (عدد المستخدمين لكل قيمة) تعطي الترتيب بـ O(log n)،
+    والمجاميع الأكبر من حد الشجرة في قائمة مرتبة منفصلة حتى لا يحدد مجموع واحد ضخم حجم الذاكرة.
+    قائمة الأوائل مرتبة ومحدودة الحجم؛ إذا خرج أحد الأوائل منها (تصفير أو حذف) تُعاد بناؤها
+    من التخزين عند أول قراءة لاحقة خارج القفل. المستخدمون بمجموع صفر خارج الفهرس
+    ويتشاركون المرتبة الأخيرة
+    """
+
+    def __init__(self, top_size, page_size, index_max=LEADERBOARD_INDEX_MAX):
+        self.top_size = top_size
+        self.page_size = page_size
+        self._size = 1024
+        self._max_size = max(self._size, 1 << (index_max - 1).bit_length())
+        self._tree = array('q', [0]) * (self._size + 1)
+        self._overflow = []   # المجاميع الأكبر من _max_size مرتبة تصاعدياً
+        self._ranked = 0      # عدد المستخدمين بمجموع أكبر من صفر
+        self._top = []        # (-total, user_id) مرتبة تصاعدياً
+        self._top_totals = {}  # user_id -> total لأعضاء القائمة
+        self._stale = False
+        self._rebuilding = None  # user_id -> المجموع الجديد للتغييرات أثناء إعادة البناء
+        self._source = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self.rebuilds = 0
+
+    def attach(self, store):
+        """بناء الفهرس من التخزين والاشتراك في تغييرات المجموع"""
+        self._source = store.iter_totals
+        with self._lock:
+            self._build(store.iter_totals())
+        store.total_listener = self.update
+
+    def update(self, user_id, old_total, new_total):
+        """تطبيق تغيير مجموع مستخدم (new_total = None عند الحذف)"""
+        with self._lock:
+            if old_total and new_total:
+                self._move(old_total, new_total)
+            elif old_total:
+                self._add(old_total, -1)
+                self._ranked -= 1
+            elif new_total:
+                self._add(new_total, 1)
+                self._ranked += 1
+            self._update_top(user_id, new_total or 0)
+            if self._rebuilding is not None:
+                self._rebuilding[user_id] = new_total or 0
+
+    def rank(self, total):
+        """المرتبة لمجموع معين: 1 + عدد المستخدمين بمجموع أكبر"""
+        with self._lock:
+            return self._rank(total)
+
+    def ranked_count(self):
+        return self._ranked
+
+    def page(self, number):
+        """صفحة من قائمة الأوائل: ([(المرتبة، user_id، المجموع)]، عدد الصفحات)"""
+        self._refresh_top()
+        with self._lock:
+            pages = max(1, -(-len(self._top) // self.page_size))
+            start = min(max(number, 0), pages - 1) * self.page_size
+            entries = [
+                (self._rank(-negative_total), user_id, -negative_total)
+                for negative_total, user_id in self._top[start:start + self.page_size]
+            ]
+            return entries, pages
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ranked_users': self._ranked,
+                'top_size': len(self._top),
+                'max_total_indexed': self._size,
+                'overflow_users': len(self._overflow),
+                'rebuilds': self.rebuilds
+            }
+
+    def _rank(self, total):
+        if total <= 0:
+            return self._ranked + 1
+        return self._ranked - self._prefix(total) + 1
+
+    def _prefix(self, total):
+        """عدد المستخدمين بمجموع بين 1 و total"""
+        i = min(total, self._size)
+        count = 0
+        while i > 0:
+            count += self._tree[i]
+            i &= i - 1
+        if total > self._max_size:
+            count += bisect.bisect_right(self._overflow, total)
+        return count
+
+    def _add(self, total, delta):
+        if total > self._max_size:
+            if delta > 0:
+                bisect.insort(self._overflow, total)
+            else:
+                del self._overflow[bisect.bisect_left(self._overflow, total)]
+            return
+        while total > self._size:
+            self._grow()
+        tree, size = self._tree, self._size
+        while total <= size:
+            tree[total] += delta
+            total += total & -total
+
+    def _move(self, old_total, new_total):
+        """نقل مستخدم من قيمة إلى أخرى؛ المسارات المشتركة في الشجرة تلغي بعضها فتتوقف عندها"""
+        if max(old_total, new_total) > self._max_size:
+            self._add(old_total, -1)
+            self._add(new_total, 1)
+            return
+        while new_total > self._size:
+            self._grow()
+        tree, size = self._tree, self._size
+        i, j = old_total, new_total
+        while i != j and min(i, j) <= size:
+            if i < j:
+                tree[i] -= 1
+                i += i & -i
+            else:
+                tree[j] += 1
+                j += j & -j
+
+    def _grow(self):
+        """مضاعفة مدى القيم؛ العقد الجديدة تغطي مدى فارغاً عدا الأخيرة التي تغطي الكل"""
+        everyone = self._prefix(self._size)
+        self._tree.extend(array('q', [0]) * self._size)
+        self._size *= 2
+        self._tree[self._size] = everyone
+
+    def _build(self, totals):
+        """بناء الشجرة بـ O(n + أكبر مجموع) بدلاً من إدراج كل مستخدم على حدة"""
+        totals = [(user_id, total) for user_id, total in totals if total > 0]
+        size = 1024
+        highest = max((total for _, total in totals if total <= self._max_size), default=0)
+        while size < highest:
+            size *= 2
+        tree = array('q', [0]) * (size + 1)
+        overflow = []
+        for _, total in totals:
+            if total > self._max_size:
+                overflow.append(total)
+            else:
+                tree[total] += 1
+        overflow.sort()
+        self._overflow = overflow
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree, self._size, self._ranked = tree, size, len(totals)
+        self._rebuild_top(totals)
+
+    def _refresh_top(self):
+        """إعادة بناء قائمة الأوائل القديمة بمسح التخزين خارج القفل حتى لا تنتظر النقرات
+
+        التغييرات أثناء المسح تُسجل في _rebuilding وتُطبق على النتيجة؛ الأعضاء الذين نقص مجموعهم
+        تحت أدنى مجموع ممسوح قد يسبقهم غيرهم فيُحذفون وتبقى القائمة قديمة لإعادة بناء لاحقة
+        """
+        with self._lock:
+            if not self._stale or self._source is None or self._rebuilding is not None:
+                return
+            self._rebuilding = {}
+        try:
+            scanned = heapq.nsmallest(self.top_size, ((-total, user_id) for user_id, total in self._source() if total > 0))
+        except Exception:
+            with self._lock:
+                self._rebuilding = None
+            raise
+        with self._lock:
+            changes, self._rebuilding = self._rebuilding, None
+            totals = {user_id: -negative_total for negative_total, user_id in scanned}
+            totals.update(changes)
+            # من لم يُمسح ولم يتغير مجموعه لا يتجاوز أدنى مجموع في المسح إذا امتلأت القائمة
+            floor = -scanned[-1][0] if len(scanned) >= self.top_size else 1
+            self._rebuild_top(
+                (user_id, total) for user_id, total in totals.items()
+                if total >= floor
+            )
+            if len(self._top) < min(self.top_size, self._ranked):
+                self._stale = True
+
+    def _rebuild_top(self, totals):
+        self._top = heapq.nsmallest(self.top_size, ((-total, user_id) for user_id, total in totals if total > 0))
+        self._top_totals = {user_id: -negative_total for negative_total, user_id in self._top}
+        self._stale = False
+        self.version += 1
+        self.rebuilds += 1
+
+    def _update_top(self, user_id, total):
+        current = self._top_totals.pop(user_id, None)
+        if current is None and len(self._top) >= self.top_size and (-total, user_id) > self._top[-1]:
+            # الحالة الشائعة: مستخدم خارج القائمة الممتلئة ويبقى خارجها
+            return
+        changed = False
+        if current is not None:
+            del self._top[bisect.bisect_left(self._top, (-current, user_id))]
+            changed = True
+        if total > 0 and (len(self._top) < self.top_size or (-total, user_id) < self._top[-1]):
+            bisect.insort(self._top, (-total, user_id))
+            self._top_totals[user_id] = total
+            changed = True
+            if len(self._top) > self.top_size:
+                _, dropped = self._top.pop()
+                del self._top_totals[dropped]
+        if changed:
+            self.version += 1
+        # عضو خرج من القائمة ولم يُعرف بعد من يحل محله
+        if len(self._top) < min(self.top_size, self._ranked):
+            self._stale = True
+
+leaderboard = Leaderboard(LEADERBOARD_TOP_SIZE, LEADERBOARD_PAGE_SIZE)
+leaderboard.attach(user_store)
+
+# ==================== سجل العدادات اليومي ====================
+# أيام التفصيل اليومي ثم التجميع الأسبوعي والشهري؛ ما يتجاوز ذلك يُسقط
+HISTORY_DAYS = int(os.getenv('HISTORY_DAYS', '14'))
+HISTORY_WEEKS = int(os.getenv('HISTORY_WEEKS', '8'))
+HISTORY_MONTHS = int(os.getenv('HISTORY_MONTHS', '12'))
+HISTORY_FIELD_INDEX = {field: i for i, field in enumerate(COUNTER_FIELDS[:4])}
+# السجل يُحفظ في ملف بجانب التخزين الدائم (sqlite وlog) كل HISTORY_SAVE_INTERVAL ثانية وعند الإغلاق؛
+# مع memory وcolumnar يبقى في الذاكرة فقط ويبدأ فارغاً بعد كل إعادة تشغيل
+HISTORY_PATH = shard_path(os.getenv('HISTORY_PATH', 'history.bin'))
+HISTORY_SAVE_INTERVAL = float(os.getenv('HISTORY_SAVE_INTERVAL', '300'))
+# سجل المستخدم الخامل أكثر من هذه المدة (بالأيام) يُحذف من الذاكرة مع سلسلته
+HISTORY_IDLE_DAYS = int(os.getenv('HISTORY_IDLE_DAYS', '60'))
+HISTORY_FILE_HEADER = struct.Struct('<4sIII')
+HISTORY_FILE_MAGIC = b'HIS1'
+# user_id، آخر يوم نشاط، بداية السلسلة، أفضل سلسلة، طول اسم المنطقة الزمنية
+HISTORY_RECORD = struct.Struct('<qIIIB')
+
+class BucketRing:
+    """حلقة ثابتة الحجم من الدلاء الزمنية في مصفوفة واحدة: لكل خانة [رقم الفترة، العدادات الأربعة]
+
+    الفترة الجديدة تحل محل أقدم فترة في خانتها، لذا يبقى الحجم ثابتاً مهما طال تاريخ المستخدم
+    """
+    __slots__ = ('size', 'slots')
+    WIDTH = 5
+
+    def __init__(self, size):
+        self.size = size
+        self.slots = array('I', [0]) * (size * self.WIDTH)
+
+    def add(self, period, field, amount):
+        base = (period % self.size) * self.WIDTH
+        slots = self.slots
+        if slots[base] != period:
+            if slots[base] > period:
+                return  # أقدم من مدة الاحتفاظ (تراجع الساعة)
+            slots[base:base + self.WIDTH] = array('I', (period, 0, 0, 0, 0))
+        slots[base + 1 + field] += amount
+
+    def get(self, period):
+        """العدادات الأربعة لفترة محددة (أصفار إذا خرجت من مدة الاحتفاظ)"""
+        base = (period % self.size) * self.WIDTH
+        if self.slots[base] != period:
+            return (0, 0, 0, 0)
+        return tuple(self.slots[base + 1:base + self.WIDTH])
+
+    def total(self, period):
+        return sum(self.get(period))
+
+class UserHistory:
+    __slots__ = ('days', 'weeks', 'months', 'tz', 'last_day', 'streak_start', 'best_streak')
+
+    def __init__(self, tz, days, weeks, months):
+        self.days = BucketRing(days)
+        self.weeks = BucketRing(weeks)
+        self.months = BucketRing(months)
+        self.tz = tz
+        self.last_day = 0
+        self.streak_start = 0
+        self.best_streak = 0
+
+class CounterHistory:
+    """سجل زمني لعدادات كل مستخدم: كل نقرة تُضاف إلى دلو اليوم والأسبوع والشهر مباشرة
+
+    الاستعلامات تقرأ دلواً واحداً لكل فترة، والسلسلة تُحدّث تدريجياً مع كل يوم نشاط،
+    فلا تعتمد الكلفة على طول تاريخ المستخدم. الأيام بتوقيت منطقة المستخدم
+    والأسبوع يبدأ يوم السبت
+    """
+
+    def __init__(self, days, weeks, months, timezone_of, shards=STORE_LOCK_SHARDS):
+        self.days = days
+        self.weeks = weeks
+        self.months = months
+        self._timezone_of = timezone_of
+        self._users = {}
+        self._shard_locks = [TimedLock('history_shard') for _ in range(shards)]
+        self._periods_cache = {}  # اسم المنطقة -> (اليوم، الأسبوع، الشهر، نهاية اليوم بتوقيت epoch)
+        self.path = None
+        self._stopped = None
+
+    def _lock_for(self, user_id):
+        return self._shard_locks[hash(user_id) % len(self._shard_locks)]
+
+    def _periods(self, tz_name):
+        """أرقام اليوم والأسبوع والشهر الحالية بتوقيت المنطقة؛ تُحسب مرة واحدة لكل منطقة في اليوم"""
+        now = time.time()
+        cached = self._periods_cache.get(tz_name)
+        if cached is not None and now < cached[3]:
+            return cached[:3]
+        tz = ZoneInfo(tz_name)
+        today = datetime.fromtimestamp(now, tz).date()
+        day = today.toordinal()
+        midnight = datetime.combine(today + timedelta(days=1), dtime(0), tz)
+        periods = (day, (day + 1) // 7, today.year * 12 + today.month - 1, midnight.timestamp())
+        self._periods_cache[tz_name] = periods
+        return periods[:3]
+
+    def record(self, user_id, key, amount=1):
+        """تسجيل نقرة في دلاء اليوم والأسبوع والشهر وتحديث السلسلة"""
+        field = HISTORY_FIELD_INDEX[key]
+        with self._lock_for(user_id):
+            history = self._users.get(user_id)
+            if history is None:
+                tz = self._timezone_of(user_id)
+                history = self._users[user_id] = UserHistory(tz, self.days, self.weeks, self.months)
+            day, week, month = self._periods(history.tz)
+            history.days.add(day, field, amount)
+            history.weeks.add(week, field, amount)
+            history.months.add(month, field, amount)
+            if day > history.last_day:
+                if history.last_day != day - 1:
+                    history.streak_start = day
+                history.last_day = day
+                history.best_streak = max(history.best_streak, day - history.streak_start + 1)
+
+    def summary(self, user_id):
+        """مجاميع اليوم والأسبوع والشهر وآخر 7 أيام والسلسلة الحالية والأفضل"""
+        with self._lock_for(user_id):
+            history = self._users.get(user_id)
+            if history is None:
+                return {'today': 0, 'week': 0, 'month': 0, 'last_7_days': 0, 'streak': 0, 'best_streak': 0}
+            day, week, month = self._periods(history.tz)
+            # السلسلة مستمرة إذا كان آخر نشاط اليوم أو أمس، وتنتهي عند آخر يوم نشاط
+            streak = history.last_day - history.streak_start + 1 if history.last_day >= day - 1 else 0
+            return {
+                'today': history.days.total(day),
+                'week': history.weeks.total(week),
+                'month': history.months.total(month),
+                'last_7_days': sum(history.days.total(d) for d in range(day - 6, day + 1)),
+                'streak': streak,
+                'best_streak': history.best_streak
+            }
+
+    def set_timezone(self, user_id, tz):
+        with self._lock_for(user_id):
+            history = self._users.get(user_id)
+            if history is not None:
+                history.tz = tz
+
+    def forget(self, user_id):
+        """حذف سجل المستخدم (عند تصفير العدادات أو حذف المستخدم)"""
+        with self._lock_for(user_id):
+            self._users.pop(user_id, None)
+
+    def count(self):
+        return len(self._users)
+
+    def evict_idle(self, idle_days):
+        """حذف سجلات المستخدمين الخاملين شريحة بشريحة؛ يُرجع عدد المحذوفين"""
+        by_shard = {}
+        for user_id in list(self._users):
+            by_shard.setdefault(hash(user_id) % len(self._shard_locks), []).append(user_id)
+        evicted = 0
+        for shard, members in by_shard.items():
+            with self._shard_locks[shard]:
+                for user_id in members:
+                    history = self._users.get(user_id)
+                    if history is not None and history.last_day < self._periods(history.tz)[0] - idle_days:
+                        del self._users[user_id]
+                        evicted += 1
+        return evicted
+
+    def save(self, path):
+        """كتابة كل السجلات في ملف مؤقت ثم استبدال الملف السابق به (قفل شريحة المستخدم لكل سجل)"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HISTORY_FILE_HEADER.pack(HISTORY_FILE_MAGIC, self.days, self.weeks, self.months))
+            for user_id in list(self._users):
+                with self._lock_for(user_id):
+                    history = self._users.get(user_id)
+                    if history is None:
+                        continue
+                    tz = history.tz.encode('utf-8')
+                    f.write(HISTORY_RECORD.pack(user_id, history.last_day, history.streak_start, history.best_streak, len(tz)))
+                    f.write(tz)
+                    f.write(history.days.slots.tobytes() + history.weeks.slots.tobytes() + history.months.slots.tobytes())
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """تحميل السجلات المحفوظة؛ يُتجاهل الملف إذا تغيرت أحجام الحلقات"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, days, weeks, months = HISTORY_FILE_HEADER.unpack_from(data)
+        if magic != HISTORY_FILE_MAGIC or (days, weeks, months) != (self.days, self.weeks, self.months):
+            logger.warning(f"Ignoring {path}: history layout changed")
+            return 0
+        itemsize = array('I').itemsize
+        sizes = [size * BucketRing.WIDTH * itemsize for size in (days, weeks, months)]
+        offset = HISTORY_FILE_HEADER.size
+        loaded = 0
+        while offset < len(data):
+            user_id, last_day, streak_start, best_streak, tz_length = HISTORY_RECORD.unpack_from(data, offset)
+            offset += HISTORY_RECORD.size
+            history = UserHistory(data[offset:offset + tz_length].decode('utf-8'), days, weeks, months)
+            offset += tz_length
+            for ring, size in zip((history.days, history.weeks, history.months), sizes):
+                ring.slots = array('I', data[offset:offset + size])
+                offset += size
+            history.last_day, history.streak_start, history.best_streak = last_day, streak_start, best_streak
+            self._users[user_id] = history
+            loaded += 1
+        return loaded
+
+    def start(self, path, interval, idle_days):
+        """تحميل السجل المحفوظ (path = None للسجل المؤقت) وتشغيل خيط الحذف والحفظ الدوري"""
+        self.path = path
+        if path:
+            logger.info(f"Loaded counter history for {self.load(path)} users from {path}")
+        self._stopped = threading.Event()
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.evict_idle(idle_days)
+                    if path:
+                        self.save(path)
+                except Exception as e:
+                    logger.error(f"Error maintaining counter history: {e}")
+
+        threading.Thread(target=run, name='history-maintenance', daemon=True).start()
+
+    def close(self):
+        if self._stopped is None:
+            return
+        self._stopped.set()
+        if self.path:
+            self.save(self.path)
+
+counter_history = CounterHistory(
+    HISTORY_DAYS, HISTORY_WEEKS, HISTORY_MONTHS,
+    lambda user_id: user_store.get_preferences(user_id).get('timezone') or REMINDER_DEFAULT_TZ
+)
+if not (SHARD_WORKERS and SHARD_INDEX is None):
+    counter_history.start(HISTORY_PATH if STORAGE_BACKEND in ('sqlite', 'log') else None, HISTORY_SAVE_INTERVAL, HISTORY_IDLE_DAYS)
+    atexit.register(counter_history.close)
+
+def get_user_data(user_id):
+    return user_store.get(user_id)
+
+def update_user_data(user_id, data):
+    user_store.update(user_id, data)
+
+def initialize_user_data(user_id, chat_id=None):
+    return user_store.initialize(user_id, chat_id)
+
+def increment_user_counter(user_id, key):
+    total = user_store.increment(user_id, key)
+    counter_history.record(user_id, key)
+    return total
+
+def reset_user_counters(user_id):
+    user_store.reset(user_id)
+    counter_history.forget(user_id)
+
+# ==================== ذاكرة مؤقتة لحالة الاشتراك ====================
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+# مدة صلاحية النتيجة الإيجابية والسلبية بالثواني والحد الأقصى لعدد المدخلات
+SUB_CACHE_POSITIVE_TTL = float(os.getenv('SUB_CACHE_POSITIVE_TTL', '600'))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv('SUB_CACHE_NEGATIVE_TTL', '20'))
+SUB_CACHE_MAX_SIZE = int(os.getenv('SUB_CACHE_MAX_SIZE', '100000'))
+
+class MembershipCache:
+    """ذاكرة مؤقتة محدودة الحجم لحالة الاشتراك مع مدة صلاحية وإخلاء الأقدم استخداماً"""
+
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (subscribed, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """إرجاع الحالة المخزنة أو None إذا لم تكن موجودة أو انتهت صلاحيتها"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, user_id, subscribed):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        with self._lock:
+            self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+membership_cache = MembershipCache(SUB_CACHE_POSITIVE_TTL, SUB_CACHE_NEGATIVE_TTL, SUB_CACHE_MAX_SIZE)
+
+@trace_as('subscription')
+def is_user_subscribed(user_id):
+    """التحقق من اشتراك المستخدم في القناة"""
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
+    try:
+        chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+    except Exception as e:
+        # لا نخزن الأخطاء حتى لا يُحجب المستخدم بسبب عطل مؤقت
+        logger.error(f"Error checking subscription: {e}")
+        return False
+    membership_cache.set(user_id, subscribed)
+    return subscribed
+
+@trace_as('subscription')
+async def is_user_subscribed_async(abot, user_id):
+    """نسخة asyncio من is_user_subscribed تشترك معها في نفس الذاكرة المؤقتة"""
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
+    try:
+        chat_member = await abot.get_chat_member(CHANNEL_ID, user_id)
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+    except Exception as e:
+        logger.error(f"Error checking subscription: {e}")
+        return False
+    membership_cache.set(user_id, subscribed)
+    return subscribed
+
+@bot.chat_member_handler(func=lambda update: update.chat.id == CHANNEL_ID)
+@instrument_handler
+def handle_channel_member_update(update):
+    """تحديث الذاكرة المؤقتة عند تغير عضوية مستخدم في القناة"""
+    member = update.new_chat_member
+    membership_cache.set(member.user.id, member.status in SUBSCRIBED_STATUSES)
+
+# ==================== ذاكرة العرض ====================
+# الشاشات الثابتة تُبنى وتُحوّل إلى JSON مرة واحدة عند التشغيل، ولوحة العدادات
+# تُنتج من قالب JSON جاهز بحسب قيم العدادات الأربعة
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '4096'))
+
+MAIN_MESSAGE = """
+🌺 بسم الله الرحمن الرحيم 
+اللهم صلي وسلم وبارك على سيدنا محمد 🌹
+
+📿 *مرحباً بك في بوت نُور الذِّكْر* 
+هنا تجني الأجر وتنال الثواب بإذن الله تعالى
+
+✨ *طريقة الاستخدام:*
+- اضغط على أي ذكر لزيادة العداد ورفع درجاتك في الجنة
+- استخدم زر "📊 عرض إحصائياتي" لمشاهدة تفاصيل أذكارك
+- شارك البوت مع أحبابك لنيل الأجر والثواب
+
+🌿 *فوائد الذكر:*
+• كل ذكر = 10 حسنات ⭐
+• محو الذنوب والخطايا 🍃
+• رفع الدرجات في الجنة 🕌
+• طمأنينة القلب والروح 💖
+• تقوية الإيمان واليقين ✨
+    """
+
+def _build_main_keyboard_template():
+    """بناء قالب JSON للوحة الرئيسية مع خانات %d مكان العدادات"""
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    
+    # أزرار الأذكار
+    keyboard.add(
+        types.InlineKeyboardButton("سبحان الله (__C0__)", callback_data="dhikr_subhan"),
+        types.InlineKeyboardButton("الحمد لله (__C1__)", callback_data="dhikr_alhamdulillah")
+    )
+    keyboard.add(
+        types.InlineKeyboardButton("لا إله إلا الله (__C2__)", callback_data="dhikr_la_ilaha"),
+        types.InlineKeyboardButton("الله اكبر (__C3__)", callback_data="dhikr_allahu_akbar")
+    )
+    
+    # أزرار الخيارات
+    keyboard.add(
+        types.InlineKeyboardButton("📊 عرض إحصائياتي", callback_data="show_stats"),
+        types.InlineKeyboardButton("🗑️ مسح عدادي", callback_data="reset_counters")
+    )
+    keyboard.add(
+        types.InlineKeyboardButton("👨‍💻 المطور", callback_data="developer_info"),
+        types.InlineKeyboardButton("📤 شارك البوت", callback_data="share_bot")
+    )
+    keyboard.add(types.InlineKeyboardButton("🏆 لوحة المتصدرين", callback_data="leaderboard"))
+    
+    template = keyboard.to_json().replace('%', '%%')
+    for i in range(4):
+        template = template.replace(f"__C{i}__", '%d')
+    return template
+
+MAIN_KEYBOARD_TEMPLATE = _build_main_keyboard_template()
+
+def _single_column_keyboard(*buttons):
+    keyboard = types.InlineKeyboardMarkup()
+    for button in buttons:
+        keyboard.add(button)
+    return keyboard.to_json()
+
+BACK_BUTTON = types.InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")
+BACK_KEYBOARD = _single_column_keyboard(BACK_BUTTON)
+
+SUBSCRIPTION_KEYBOARD = _single_column_keyboard(
+    types.InlineKeyboardButton("🔔 اشترك في القناة", url=f"https://t.me/{CHANNEL_USERNAME[1:]}"),
+    types.InlineKeyboardButton("✅ تحقق من الاشتراك", callback_data="check_sub")
+)
+
+SUBSCRIPTION_MESSAGE = f"""
+🕌 *مرحباً بك في بوت نُور الذِّكْر*
+
+⚠️ للاستفادة من البوت، يجب الاشتراك في القناة أولاً
+
+📢 القناة: {CHANNEL_USERNAME}
+
+اضغط على الزر أدناه للاشتراك، ثم اضغط "تحقق من الاشتراك"
+    """
+
+NOT_SUBSCRIBED_KEYBOARD = _single_column_keyboard(
+    types.InlineKeyboardButton("🔔 اشترك الآن", url=f"https://t.me/{CHANNEL_USERNAME[1:]}"),
+    types.InlineKeyboardButton("✅ تحقق مجدداً", callback_data="check_sub")
+)
+
+NOT_SUBSCRIBED_MESSAGE = f"❌ لم يتم الاشتراك بعد!\n\nالرجاء الاشتراك في القناة {CHANNEL_USERNAME} ثم الضغط على 'تحقق مجدداً'"
+
+DEVELOPER_KEYBOARD = _single_column_keyboard(
+    types.InlineKeyboardButton("💬 مراسلة المطور", url="https://t.me/Akio_co"),
+    BACK_BUTTON
+)
+
+DEVELOPER_TEXT = (
+    "👨‍💻 معلومات المطور:\n\n"
+    "• الاسم: @Akio_co\n"
+    "• المهمة: تطوير وتحديث البوت\n\n"
+    "🔧 لأي استفسار، اقتراح، أو مشكلة تقنية\n"
+    "📞 تواصل معنا في أي وقت"
+)
+
+SHARE_MESSAGE = (
+    "📤 *شارك البوت مع أحبابك لنيل الأجر والثواب*\n\n"
+    "اضغط على الزر أدناه لمشاركة البوت عبر التليجرام"
+)
+
+SHARE_LINES_BEFORE_COUNT = [
+    "📿 *بوت نُور الذِّكْر*",
+    "أداة رائعة لذكر الله وتحصيل الأجر",
+    "",
+    "قال رسول الله ﷺ:",
+    "\"من دعا إلى هدى كان له من الأجر مثل أجور من تبعه\"",
+    "",
+    "✨ *مميزات البوت:*",
+    "• عدّاد الأذكار التلقائي",
+    "• إحصائيات مفصلة",
+    "• تذكيرات يومية",
+    "• سهولة الاستخدام",
+    "",
+    "💎 أذكاري: "
+]
+
+SHARE_LINES_AFTER_COUNT = [
+    "",
+    "",
+    "انضم الآن: https://t.me/Ryukn_bot"
+]
+
+# ترميز النص الثابت للمشاركة مرة واحدة؛ العدد وحده يتغير والأرقام لا تحتاج إلى ترميز
+SHARE_URL_PREFIX = "https://t.me/share/url?url=https://t.me/Ryukn_bot&text=" + urllib.parse.quote("\n".join(SHARE_LINES_BEFORE_COUNT))
+SHARE_URL_SUFFIX = urllib.parse.quote("\n".join(SHARE_LINES_AFTER_COUNT))
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_main_keyboard(counters):
+    """لوحة المفاتيح الرئيسية بصيغة JSON لقيم العدادات (سبحان، الحمد، لا إله، الله أكبر)"""
+    return MAIN_KEYBOARD_TEMPLATE % counters
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_share_keyboard(total_count):
+    """لوحة مشاركة البوت بصيغة JSON مع عدد أذكار المستخدم"""
+    share_url = f"{SHARE_URL_PREFIX}{total_count}{SHARE_URL_SUFFIX}"
+    return _single_column_keyboard(
+        types.InlineKeyboardButton("📤 مشاركة البوت", url=share_url),
+        BACK_BUTTON
+    )
+
+LEADERBOARD_MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+_leaderboard_pages = {}  # رقم الصفحة -> (إصدار قائمة الأوائل، النص، اللوحة)
+
+def render_leaderboard(number):
+    """نص ولوحة صفحة المتصدرين؛ تُعاد من الذاكرة ما دامت قائمة الأوائل لم تتغير"""
+    version = leaderboard.version
+    cached = _leaderboard_pages.get(number)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    
+    entries, pages = leaderboard.page(number)
+    number = min(max(number, 0), pages - 1)
+    lines = ["🏆 *لوحة المتصدرين*", ""]
+    for rank, user_id, total in entries:
+        # إخفاء معرف المستخدم وإظهار آخر ثلاثة أرقام فقط
+        lines.append(f"{LEADERBOARD_MEDALS.get(rank, f'{rank}.')} •••{user_id % 1000:03d} — {total} ذكر")
+    if not entries:
+        lines.append("لا يوجد متصدرون بعد، كن أول الذاكرين 🌟")
+    lines.extend(["", f"صفحة {number + 1} من {pages}"])
+    
+    keyboard = types.InlineKeyboardMarkup()
+    navigation = []
+    if number > 0:
+        navigation.append(types.InlineKeyboardButton("◀️ السابق", callback_data=f"leaderboard_{number - 1}"))
+    if number < pages - 1:
+        navigation.append(types.InlineKeyboardButton("التالي ▶️", callback_data=f"leaderboard_{number + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.add(BACK_BUTTON)
+    
+    page = (version, "\n".join(lines), keyboard.to_json())
+    _leaderboard_pages[number] = page
+    return page[1], page[2]
+
+@trace_as('render')
+def build_leaderboard_message(user_id, number):
+    """صفحة المتصدرين مع سطر ترتيب المستخدم الحالي"""
+    text, keyboard = render_leaderboard(number)
+    total = user_store.get_counters(user_id)[4]
+    return f"{text}\n\n🏅 ترتيبك: #{leaderboard.rank(total)} — مجموعك: {total} ذكر", keyboard
+
+def leaderboard_page_number(data):
+    """رقم الصفحة من بيانات الزر (leaderboard أو leaderboard_N)"""
+    _, _, number = data.partition('_')
+    return int(number) if number.isdigit() else 0
+
+@trace_as('render')
+def get_main_keyboard(user_id):
+    """لوحة المفاتيح الرئيسية للأذكار بصيغة JSON جاهزة للإرسال"""
+    return render_main_keyboard(user_store.get_counters(user_id)[:4])
+
+def get_main_message(user_id):
+    """نص الرسالة الرئيسية"""
+    return MAIN_MESSAGE
+
+@bot.message_handler(commands=['start'])
+@instrument_handler
+def start(message):
+    user_id = message.from_user.id
+    initialize_user_data(user_id, message.chat.id)
+    
+    # التحقق من الاشتراك
+    if is_user_subscribed(user_id):
+        show_main_menu(message)
+    else:
+        show_subscription_message(message)
+
+@bot.message_handler(commands=['timezone'])
+@instrument_handler
+def set_timezone_command(message):
+    """تعيين المنطقة الزمنية للتذكيرات، مثال: /timezone Africa/Algiers"""
+    user_id = message.from_user.id
+    initialize_user_data(user_id, message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        show_subscription_message(message)
+        return
+    
+    bot.send_message(message.chat.id, apply_timezone_command(user_id, message.text))
+
+@bot.message_handler(commands=['reminders'])
+@instrument_handler
+def set_reminders_command(message):
+    """تعيين أوقات تذكير الصباح والمساء، مثال: /reminders 06:30 20:00 (أو off للتعطيل)"""
+    user_id = message.from_user.id
+    initialize_user_data(user_id, message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        show_subscription_message(message)
+        return
+    
+    bot.send_message(message.chat.id, apply_reminders_command(user_id, message.text))
+
+def apply_timezone_command(user_id, text):
+    """تنفيذ أمر /timezone وإرجاع نص الرد"""
+    parts = text.split()
+    current = user_store.get_preferences(user_id).get('timezone') or REMINDER_DEFAULT_TZ
+    if len(parts) != 2:
+        return f"🌍 منطقتك الزمنية الحالية: {current}\n\nللتغيير أرسل مثلاً:\n/timezone Africa/Algiers"
+    
+    try:
+        ZoneInfo(parts[1])
+    except (ZoneInfoNotFoundError, ValueError):
+        return "❌ منطقة زمنية غير معروفة، مثال صحيح: Africa/Algiers"
+    
+    user_store.set_preferences(user_id, {'timezone': parts[1]})
+    counter_history.set_timezone(user_id, parts[1])
+    schedule_user_reminders(user_id)
+    return f"✅ تم تعيين منطقتك الزمنية: {parts[1]}"
+
+def apply_reminders_command(user_id, text):
+    """تنفيذ أمر /reminders وإرجاع نص الرد"""
+    parts = text.split()[1:]
+    if len(parts) != 2 or not all(p == 'off' or REMINDER_TIME_PATTERN.match(p) for p in parts):
+        prefs = user_store.get_preferences(user_id)
+        return (
+            f"⏰ تذكير الصباح: {prefs.get('morning') or REMINDER_MORNING_TIME}\n"
+            f"🌙 تذكير المساء: {prefs.get('evening') or REMINDER_EVENING_TIME}\n\n"
+            "للتغيير أرسل مثلاً:\n/reminders 06:30 20:00\n(استخدم off لتعطيل أحدهما)"
+        )
+    
+    user_store.set_preferences(user_id, {'morning': parts[0], 'evening': parts[1]})
+    schedule_user_reminders(user_id)
+    return f"✅ تم ضبط التذكيرات: الصباح {parts[0]}، المساء {parts[1]}"
+
+def schedule_user_reminders(user_id):
+    """إضافة مواعيد المستخدم الجديدة إلى المجدول"""
+    prefs = user_store.get_preferences(user_id)
+    for kind in ('morning', 'evening'):
+        slot = reminder_slot(user_id, kind, prefs)
+        if slot is not None:
+            reminder_scheduler.add_slot(slot)
+
+# ==================== توجيه أزرار callback ====================
+class CallbackRouter:
+    """اختيار معالج الزر من callback_data ببحث في قاموس بدلاً من تجربة مرشح كل معالج بالترتيب"""
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        # أطوال البادئات المسجلة، من الأطول للأقصر حتى تفوز البادئة الأدق
+        self._prefix_lengths = ()
+
+    def handler(self, *data, prefix=None):
+        """مزخرف التسجيل: قيم callback_data مطابقة تماماً و/أو بادئة"""
+        def register(handler):
+            for value in data:
+                self._exact[value] = handler
+            if prefix is not None:
+                self._prefixes[prefix] = handler
+                self._prefix_lengths = tuple(sorted({len(p) for p in self._prefixes}, reverse=True))
+            return handler
+        return register
+
+    def resolve(self, data):
+        """المعالج المسجل لهذه البيانات أو None"""
+        handler = self._exact.get(data)
+        if handler is not None or data is None:
+            return handler
+        for length in self._prefix_lengths:
+            handler = self._prefixes.get(data[:length])
+            if handler is not None:
+                return handler
+        return None
+
+    def dispatch(self, call):
+        handler = self.resolve(call.data)
+        if handler is not None:
+            return handler(call)
+
+callback_router = CallbackRouter()
+
+# حد النقرات لكل مستخدم (نقرة/ثانية ورصيد أقصى)، وعدد تعديلات القائمة المعلقة وغير المكتملة الذي يبدأ عنده تخفيف الحمل
+TAP_RATE = float(os.getenv('TAP_RATE', '5'))
+TAP_BURST = int(os.getenv('TAP_BURST', '10'))
+LOAD_SHED_BACKLOG = int(os.getenv('LOAD_SHED_BACKLOG', '200'))
+
+class TapRateLimiter:
+    """دلو رموز لكل مستخدم؛ المستخدم الخامل يُحذف تلقائياً لأن دلوه ممتلئ كمستخدم جديد"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # بعد هذه المدة دون نقرات يكون الدلو قد امتلأ
+        self.idle_after = burst / rate
+        self._buckets = OrderedDict()  # user_id -> (tokens, updated_at) بترتيب آخر نقرة
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.expired = 0
+
+    def allow(self, user_id):
+        """استهلاك رمز للنقرة؛ يُرجع False إذا تجاوز المستخدم حده"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            bucket = self._buckets.pop(user_id, None)
+            tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                self.allowed += 1
+            else:
+                self.limited += 1
+            self._buckets[user_id] = (tokens, now)
+            return allowed
+
+    def _expire(self, now):
+        # المدخلات مرتبة حسب آخر نقرة، فالخاملون في البداية دائماً
+        cutoff = now - self.idle_after
+        while self._buckets:
+            user_id, (_, updated_at) = next(iter(self._buckets.items()))
+            if updated_at > cutoff:
+                break
+            del self._buckets[user_id]
+            self.expired += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked': len(self._buckets),
+                'allowed': self.allowed,
+                'limited': self.limited,
+                'expired': self.expired
+            }
+
+tap_limiter = TapRateLimiter(TAP_RATE, TAP_BURST)
+
+def absorb_tap(call, reason):
+    """نقرة دون تعديل فوري: الذكر يُحتسب ويظهر في تعديل القائمة المؤجل التالي، وغيره يُهمل"""
+    user_id = call.from_user.id
+    action = DHIKR_ACTIONS.get(call.data)
+    # نكتفي بحالة الاشتراك المخزنة بدلاً من سؤال تليجرام
+    if action is None or not membership_cache.get(user_id) or user_store.get_message_id(user_id) is None:
+        limited_taps.inc(reason, 'dropped')
+        return
+    increment_user_counter(user_id, action[0])
+    limited_taps.inc(reason, 'counted')
+    # النقرة تنضم إلى التعديل المعلق للمستخدم إن وجد، وإلا تجدول تعديلاً بعد نافذة واحدة،
+    # فيظهر المجموع في التعديل التالي المسموح ولو استمرت النقرات
+    menu_coalescer.request(user_id, call.message.chat.id, delay=MENU_EDIT_WINDOW)
+
+def admit_callback(call, answer):
+    """فحص النقرة قبل المعالجات؛ يُرجع False إذا استُوعبت محلياً
+
+    answer(call) يرد رداً فارغاً على النقرة المُخففة حتى لا يبقى مؤشر التحميل لدى المستخدم؛
+    الرد أرخص من التعديل ويسبقه في البوابة. النقرات فوق حد المستخدم لا يُرد عليها
+    """
+    if call.data in DHIKR_ACTIONS and menu_coalescer.backlog() >= LOAD_SHED_BACKLOG:
+        # التعديلات متأخرة: نقرات الأذكار تُحتسب فقط حتى يتقلص الطابور
+        absorb_tap(call, 'shed')
+        answer(call)
+        return False
+    if not tap_limiter.allow(call.from_user.id):
+        absorb_tap(call, 'rate')
+        return False
+    return True
+
+def answer_shed_tap(call):
+    try:
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Error answering shed tap: {e}")
+
+# مرشح telebot الوحيد لأزرار callback؛ الاختيار الفعلي في callback_router
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    if admit_callback(call, answer_shed_tap):
+        callback_router.dispatch(call)
+
+def show_subscription_message(message):
+    """عرض رسالة الاشتراك"""
+    bot.send_message(
+        message.chat.id,
+        SUBSCRIPTION_MESSAGE,
+        parse_mode="Markdown",
+        reply_markup=SUBSCRIPTION_KEYBOARD
+    )
+
+@callback_router.handler('check_sub')
+@instrument_handler
+def check_subscription(call):
+    user_id = call.from_user.id
+    
+    # المستخدم طلب التحقق صراحة، لذا نتجاوز النتيجة المخزنة
+    membership_cache.invalidate(user_id)
+    
+    if is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "✅ تم التحقق من الاشتراك بنجاح!")
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        show_main_menu(call.message)
+    else:
+        bot.edit_message_text(
+            NOT_SUBSCRIBED_MESSAGE,
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=NOT_SUBSCRIBED_KEYBOARD
+        )
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك أولاً")
+
+def show_main_menu(message):
+    """عرض القائمة الرئيسية"""
+    user_id = message.from_user.id
+    initialize_user_data(user_id, message.chat.id)
+    
+    main_message = get_main_message(user_id)
+    keyboard = get_main_keyboard(user_id)
+    
+    # إرسال الرسالة الرئيسية وحفظ معرفها
+    sent_message = bot.send_message(message.chat.id, main_message, parse_mode="Markdown", reply_markup=keyboard)
+    user_store.set_message_id(user_id, sent_message.message_id)
+    menu_coalescer.discard(user_id)
+    menu_coalescer.mark_rendered(user_id, sent_message.message_id, keyboard)
+
+# ==================== دمج تعديلات القائمة الرئيسية ====================
+# أقل فاصل زمني بين تعديلين لنفس الرسالة وعدد خيوط إرسال التعديلات
+MENU_EDIT_WINDOW = float(os.getenv('MENU_EDIT_WINDOW', '1.0'))
+MENU_EDIT_WORKERS = int(os.getenv('MENU_EDIT_WORKERS', '4'))
+
+class MenuEditCoalescer:
+    """دمج طلبات تحديث القائمة لكل مستخدم وإرسال تعديل واحد بآخر حالة في كل نافذة زمنية"""
+
+    def __init__(self, window, flush_callback, workers):
+        self.window = window
+        self._flush_callback = flush_callback
+        self._workers = workers
+        self._pending = {}    # user_id -> (chat_id, due_at)
+        self._heap = []       # (due_at, user_id)
+        self._last_sent = {}  # user_id -> وقت آخر تعديل
+        self._rendered = {}   # user_id -> (message_id, hash of markup)
+        self._prune_at = 2048
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._loop = None
+        self._flush_coroutine = None
+        self.requested = 0
+        self.flushed = 0
+        self.skipped = 0
+        self.in_flight = 0
+
+    def request(self, user_id, chat_id, delay=0.0):
+        """تسجيل طلب تحديث؛ الطلبات المتتالية خلال النافذة تُدمج في تعديل واحد
+
+        الطلب المعلق يحتفظ بموعده حتى لا تؤخره الطلبات المتتالية إلى ما لا نهاية
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.requested += 1
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                self._pending[user_id] = (chat_id, pending[1])
+                return
+            due_at = max(now + delay, self._last_sent.get(user_id, 0.0) + self.window)
+            self._pending[user_id] = (chat_id, due_at)
+            heapq.heappush(self._heap, (due_at, user_id))
+            self._ensure_started()
+            self._cond.notify()
+
+    def discard(self, user_id):
+        """إلغاء أي تعديل معلق ونسيان آخر عرض (عند انتقال الرسالة لشاشة أخرى)"""
+        with self._cond:
+            self._pending.pop(user_id, None)
+            self._rendered.pop(user_id, None)
+
+    def use_event_loop(self, loop, flush_coroutine):
+        """توجيه التعديلات المستحقة إلى حلقة asyncio بدلاً من مجمع الخيوط"""
+        self._loop = loop
+        self._flush_coroutine = flush_coroutine
+
+    def is_rendered(self, user_id, message_id, markup_json):
+        with self._cond:
+            return self._rendered.get(user_id) == (message_id, hash(markup_json))
+
+    def mark_rendered(self, user_id, message_id, markup_json):
+        with self._cond:
+            self._rendered[user_id] = (message_id, hash(markup_json))
+
+    def mark_skipped(self):
+        """تعديل لم يُرسل لأن العرض لم يتغير"""
+        with self._cond:
+            self.skipped += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'in_flight': self.in_flight,
+                'requested': self.requested,
+                'flushed': self.flushed,
+                'skipped': self.skipped
+            }
+
+    def backlog(self):
+        """تعديلات لم تكتمل بعد: المعلقة في النافذة والمرسلة التي تنتظر خيطاً أو البوابة أو رد تليجرام"""
+        with self._cond:
+            return len(self._pending) + self.in_flight
+
+    def _flush_done(self, future):
+        with self._cond:
+            self.in_flight -= 1
+
+    def _ensure_started(self):
+        if self._thread is None:
+            if self._loop is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='menu-edit')
+            self._thread = threading.Thread(target=self._run, name='menu-coalescer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due_at, user_id = heapq.heappop(self._heap)
+                    pending = self._pending.get(user_id)
+                    # تجاهل المدخلات الملغاة أو التي أُعيدت جدولتها
+                    if pending is None or pending[1] != due_at:
+                        continue
+                    del self._pending[user_id]
+                    self._last_sent[user_id] = now
+                    due.append((user_id, pending[0]))
+                self.flushed += len(due)
+                self.in_flight += len(due)
+                if len(self._last_sent) + len(self._rendered) > self._prune_at:
+                    # نسيان المستخدمين الخاملين؛ تعديلهم التالي يُرسل دون مقارنة بالعرض السابق
+                    expired = now - self.window
+                    self._last_sent = {u: t for u, t in self._last_sent.items() if t > expired}
+                    self._rendered = {
+                        u: r for u, r in self._rendered.items() if u in self._last_sent or u in self._pending
+                    }
+                    # الحد التالي ضعف الباقي حتى لا تتكرر المسحة مع كثرة المستخدمين النشطين
+                    self._prune_at = 2 * (len(self._last_sent) + len(self._rendered)) + 2048
+            for user_id, chat_id in due:
+                if self._loop is not None:
+                    future = asyncio.run_coroutine_threadsafe(self._flush_coroutine(user_id, chat_id), self._loop)
+                else:
+                    future = self._executor.submit(self._flush_callback, user_id, chat_id)
+                future.add_done_callback(self._flush_done)
+
+def update_main_menu(user_id, chat_id):
+    """طلب تحديث القائمة الرئيسية (تُدمج الطلبات المتقاربة في تعديل واحد)"""
+    menu_coalescer.request(user_id, chat_id)
+
+def flush_main_menu(user_id, chat_id):
+    """تحديث القائمة الرئيسية فعلياً بآخر حالة للعدادات"""
+    try:
+        main_message = get_main_message(user_id)
+        keyboard = get_main_keyboard(user_id)
+        
+        message_id = user_store.get_message_id(user_id)
+        if message_id is not None:
+            # لا حاجة للتعديل إذا لم يتغير شيء منذ آخر عرض
+            if menu_coalescer.is_rendered(user_id, message_id, keyboard):
+                menu_coalescer.mark_skipped()
+                return
+            
+            bot.edit_message_text(
+                main_message,
+                chat_id,
+                message_id,
+                parse_mode="Markdown",
+                reply_markup=keyboard
+            )
+        else:
+            # إعادة إنشاء القائمة إذا تم حذف الرسالة
+            sent_message = bot.send_message(chat_id, main_message, parse_mode="Markdown", reply_markup=keyboard)
+            message_id = sent_message.message_id
+            user_store.set_message_id(user_id, message_id)
+        menu_coalescer.mark_rendered(user_id, message_id, keyboard)
+    except telebot.apihelper.ApiTelegramException as e:
+        handle_menu_edit_error(user_id, chat_id, e)
+    except Exception as e:
+        logger.error(f"Error updating main menu: {e}")
+
+def handle_menu_edit_error(user_id, chat_id, error):
+    """معالجة خطأ Bot API أثناء تعديل القائمة (مشتركة بين الوضعين المتزامن وasyncio)"""
+    if error.error_code == 429:
+        retry_after = get_retry_after(error)
+        logger.warning(f"Menu edit rate limited for user {user_id}, retrying in {retry_after}s")
+        menu_coalescer.request(user_id, chat_id, delay=retry_after)
+    elif 'message is not modified' in str(error.description):
+        menu_coalescer.mark_skipped()
+    else:
+        logger.error(f"Error updating main menu: {error}")
+
+menu_coalescer = MenuEditCoalescer(MENU_EDIT_WINDOW, flush_main_menu, MENU_EDIT_WORKERS)
+
+# ==================== الإجراءات المؤجلة ====================
+# خيط واحد لكل الإجراءات المؤجلة (حذف الرسائل المؤقتة) بدلاً من خيط Timer لكل رسالة
+DELAYED_ACTIONS_CAPACITY = int(os.getenv('DELAYED_ACTIONS_CAPACITY', '10000'))
+DELAYED_DELETE_BATCH_WINDOW = float(os.getenv('DELAYED_DELETE_BATCH_WINDOW', '0.5'))
+TEMP_MESSAGE_TTL = 3.0
+DELETE_MESSAGES_LIMIT = 100  # أقصى عدد رسائل في طلب deleteMessages واحد
+
+class DelayedActionScheduler:
+    """كومة مواعيد يصرّفها خيط واحد؛ الحذف المستحق لنفس المحادثة يُرسل في طلب deleteMessages واحد"""
+
+    def __init__(self, delete_callback, capacity, batch_window):
+        self._delete_callback = delete_callback
+        self.capacity = capacity
+        self.batch_window = batch_window
+        self._heap = []  # (due_at, seq, chat_id, message_id)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._loop = None
+        self._delete_coroutine = None
+        self.scheduled = 0
+        self.deleted = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def delete_later(self, chat_id, message_id, delay):
+        """جدولة حذف رسالة؛ يُرجع False إذا كان المجدول ممتلئاً أو متوقفاً"""
+        # تقريب الموعد لأعلى إلى حد نافذة التجميع حتى تتشارك الرسائل المتقاربة نفس الموعد
+        due_at = math.ceil((time.monotonic() + delay) / self.batch_window) * self.batch_window
+        with self._cond:
+            if self._stopped or len(self._heap) >= self.capacity:
+                self.dropped += 1
+                return False
+            heapq.heappush(self._heap, (due_at, next(self._seq), chat_id, message_id))
+            self.scheduled += 1
+            self._ensure_started()
+            self._cond.notify()
+            return True
+
+    def use_event_loop(self, loop, delete_coroutine):
+        """تنفيذ الحذف كـ coroutine في حلقة asyncio بدلاً من هذا الخيط"""
+        self._loop = loop
+        self._delete_coroutine = delete_coroutine
+
+    def stop(self):
+        """إيقاف المجدول وإسقاط الإجراءات المعلقة؛ لا تُنفذ بعد إعادة التشغيل"""
+        with self._cond:
+            self._stopped = True
+            dropped = len(self._heap)
+            self.dropped += dropped
+            self._heap.clear()
+            self._cond.notify()
+        if dropped:
+            logger.info(f"Dropped {dropped} pending delayed actions on shutdown")
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._heap),
+                'scheduled': self.scheduled,
+                'deleted': self.deleted,
+                'batches': self.batches,
+                'dropped': self.dropped
+            }
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='delayed-actions', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                batches = {}
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, chat_id, message_id = heapq.heappop(self._heap)
+                    batches.setdefault(chat_id, []).append(message_id)
+            for chat_id, message_ids in batches.items():
+                for i in range(0, len(message_ids), DELETE_MESSAGES_LIMIT):
+                    self._delete(chat_id, message_ids[i:i + DELETE_MESSAGES_LIMIT])
+
+    def _delete(self, chat_id, message_ids):
+        self.batches += 1
+        self.deleted += len(message_ids)
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._delete_coroutine(chat_id, message_ids), self._loop)
+            return
+        try:
+            self._delete_callback(chat_id, message_ids)
+        except Exception as e:
+            logger.error(f"Error deleting messages: {e}")
+
+delayed_actions = DelayedActionScheduler(bot.delete_messages, DELAYED_ACTIONS_CAPACITY, DELAYED_DELETE_BATCH_WINDOW)
+atexit.register(delayed_actions.stop)
+
+# معالجات الأذكار
+DHIKR_RESPONSES = MappingProxyType({
+    'subhan': MappingProxyType({
+        'key': 'subhan_count',
+        'response': "سبحان الله وبحمده، سبحان الله العظيم 🌟"
+    }),
+    'alhamdulillah': MappingProxyType({
+        'key': 'alhamdulillah_count',
+        'response': "الحمد لله رب العالمين 🤲"
+    }),
+    'la_ilaha': MappingProxyType({
+        'key': 'la_ilaha_count',
+        'response': "لا إله إلا الله وحده لا شريك له 🕌"
+    }),
+    'allahu_akbar': MappingProxyType({
+        'key': 'allahu_akbar_count',
+        'response': "الله اكبر كبيراً والحمد لله كثيراً 🌙"
+    })
+})
+
+# callback_data -> (حقل العداد، رسالة التأكيد)، تُبنى مرة واحدة عند التحميل
+DHIKR_ACTIONS = MappingProxyType({
+    f"dhikr_{name}": (info['key'], f"✅ {info['response']}\n💎 +10 حسنات بإذن الله")
+    for name, info in DHIKR_RESPONSES.items()
+})
+
+# أزرار الأذكار المعروفة تُطابق من القاموس مباشرة (أكثر الأزرار نقراً)، والبادئة لأي قيمة قديمة أخرى
+@callback_router.handler(*DHIKR_ACTIONS, prefix='dhikr_')
+@instrument_handler
+def handle_dhikr_callback(call):
+    user_id = call.from_user.id
+    initialize_user_data(user_id, call.message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+        return
+    
+    action = DHIKR_ACTIONS.get(call.data)
+    
+    if action is not None:
+        counter_key, confirm_msg = action
+        
+        # تحديث العداد بشكل ذري حتى لا تضيع النقرات المتزامنة
+        increment_user_counter(user_id, counter_key)
+        
+        # إرسال إشعار غير مزعج
+        bot.answer_callback_query(call.id, confirm_msg, show_alert=False)
+        
+        # تحديث القائمة الرئيسية
+        update_main_menu(user_id, call.message.chat.id)
+
+@callback_router.handler('show_stats')
+@instrument_handler
+def show_stats(call):
+    user_id = call.from_user.id
+    initialize_user_data(user_id, call.message.chat.id)
+    user_data = get_user_data(user_id)
+    
+    if not is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+        return
+    
+    # إلغاء أي تحديث معلق للقائمة حتى لا يغطي شاشة الإحصائيات
+    menu_coalescer.discard(user_id)
+    
+    bot.edit_message_text(
+        build_stats_message(user_id, user_data),
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="Markdown",
+        reply_markup=BACK_KEYBOARD
+    )
+
+@trace_as('render')
+def build_stats_message(user_id, user_data):
+    """نص شاشة الإحصائيات التفصيلية"""
+    total = user_data['total_count']
+    hasanat = total * 10
+    rank = leaderboard.rank(total)
+    history = counter_history.summary(user_id)
+    
+    return f"""
+📊 *إحصائيات أذكارك التفصيلية:*
+
+• سبحان الله: {user_data['subhan_count']} مرة 🌟
+• الحمد لله: {user_data['alhamdulillah_count']} مرة 🤲
+• لا إله إلا الله: {user_data['la_ilaha_count']} مرة 🕌
+• الله أكبر: {user_data['allahu_akbar_count']} مرة 🌙
+
+📈 *المجموع الكلي:* {total} ذكر
+💎 *الحسنات المكتسبة:* {hasanat} حسنة بإذن الله
+🏆 *ترتيبك:* {rank} من أصل {user_store.count()} مستخدم
+
+📅 *اليوم:* {history['today']} • *هذا الأسبوع:* {history['week']} • *هذا الشهر:* {history['month']}
+🔥 *أيام متتالية:* {history['streak']} (أفضل سلسلة: {history['best_streak']})
+
+✨ واصل ذكر الله لترتفع درجاتك في الجنة
+    """
+
+@callback_router.handler('leaderboard', prefix='leaderboard_')
+@instrument_handler
+def leaderboard_callback(call):
+    user_id = call.from_user.id
+    initialize_user_data(user_id, call.message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+        return
+    
+    text, keyboard = build_leaderboard_message(user_id, leaderboard_page_number(call.data))
+    menu_coalescer.discard(user_id)
+    
+    bot.edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="Markdown",
+        reply_markup=keyboard
+    )
+
+@callback_router.handler('reset_counters')
+@instrument_handler
 def reset_counters_callback(call):
     user_id = call.from_user.id
     initialize_user_data(user_id, call.message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+        return
+    
+    # إعادة تعيين العدادات
+    reset_user_counters(user_id)
+    
+    bot.answer_callback_query(call.id, "✅ تم مسح جميع العدادات بنجاح!", show_alert=True)
+    
+    # تحديث القائمة الرئيسية
+    update_main_menu(user_id, call.message.chat.id)
+
+@callback_router.handler('share_bot')
+@instrument_handler
+def share_bot_callback(call):
+    user_id = call.from_user.id
+    initialize_user_data(user_id, call.message.chat.id)
     user_data = get_user_data(user_id)
     
-    if not is_user_subscribed(user_id):
-        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+    if not is_user_subscribed(user_id):
+        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+        return
+    
+    menu_coalescer.discard(user_id)
+    
+    bot.edit_message_text(
+        SHARE_MESSAGE,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="Markdown",
+        reply_markup=render_share_keyboard(user_data['total_count'])
+    )
+
+@callback_router.handler('developer_info')
+@instrument_handler
+def developer_info_callback(call):
+    try:
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
+        
+        if not is_user_subscribed(user_id):
+            bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً", show_alert=True)
+            return
+        
+        menu_coalescer.discard(user_id)
+        
+        bot.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=DEVELOPER_TEXT,
+            reply_markup=DEVELOPER_KEYBOARD
+        )
+        
+    except Exception as e:
+        logger.error(f"حدث خطأ في زر المطور: {e}")
+        bot.answer_callback_query(call.id, "❌ حدث خطأ، يرجى المحاولة لاحقاً", show_alert=True)
+
+@callback_router.handler('back_to_main')
+@instrument_handler
+def back_to_main_callback(call):
+    user_id = call.from_user.id
+    initialize_user_data(user_id, call.message.chat.id)
+    
+    main_message = get_main_message(user_id)
+    keyboard = get_main_keyboard(user_id)
+    
+    menu_coalescer.discard(user_id)
+    bot.edit_message_text(
+        main_message,
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode="Markdown",
+        reply_markup=keyboard
+    )
+    menu_coalescer.mark_rendered(user_id, call.message.message_id, keyboard)
+
+# معالج الرسائل النصية
+@bot.message_handler(func=lambda message: True)
+@instrument_handler
+def handle_text_messages(message):
+    user_id = message.from_user.id
+    initialize_user_data(user_id, message.chat.id)
+    
+    if not is_user_subscribed(user_id):
+        show_subscription_message(message)
+        return
+    
+    # حذف الرسالة النصية من المستخدم لتجنب التكديس
+    try:
+        bot.delete_message(message.chat.id, message.message_id)
+    except Exception as e:
+        logger.error(f"Error deleting message: {e}")
+    
+    # إذا لم تكن هناك رسالة رئيسية، إنشاء واحدة جديدة
+    if user_store.get_message_id(user_id) is None:
+        show_main_menu(message)
+    else:
+        # إرسال رسالة تنبيه مؤقتة
+        try:
+            temp_msg = bot.send_message(
+                message.chat.id,
+                "❓ استخدم الأزرار أدناه للتنقل في البوت"
+            )
+            # حذف الرسالة المؤقتة بعد 3 ثوانٍ، أو فوراً إذا كان المجدول ممتلئاً حتى لا تبقى بلا حذف
+            if not delayed_actions.delete_later(message.chat.id, temp_msg.message_id, TEMP_MESSAGE_TTL):
+                bot.delete_message(message.chat.id, temp_msg.message_id)
+        except Exception as e:
+            logger.error(f"Error sending temporary message: {e}")
+
+# ==================== بوابة طلبات Bot API ====================
+# كل الطلبات الصادرة (المتزامنة وغير المتزامنة) تمر ببوابة واحدة بثلاث فئات أولوية:
+# الرد على الأزرار، ثم باقي الطلبات التفاعلية (تعديل القائمة والرسائل)، ثم البث.
+# ميزانية API_RATE تخص إرسال الرسائل وتعديلها: الطلبات التفاعلية والبث ينتظران دورهما فيها في طابور
+# واحد مرتب حسب الفئة، والبث لا يأخذ من آخر API_INTERACTIVE_RESERVE رموز حتى تجدها الطلبات التفاعلية
+# فوراً. الرد على الأزرار لا تحده الميزانية. خطأ 429 في أي فئة يوقف كل الفئات حتى انتهاء retry_after
+API_RATE = float(os.getenv('API_RATE', '30'))
+API_BURST = int(os.getenv('API_BURST', '30'))
+API_INTERACTIVE_RESERVE = int(os.getenv('API_INTERACTIVE_RESERVE', '5'))
+API_PRIORITIES = ('callback', 'interactive', 'broadcast')
+# طرق إرسال الرسائل وتعديلها التي تُحتسب من الميزانية
+API_SEND_METHODS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendVideo', 'sendAnimation', 'sendAudio', 'sendVoice',
+    'sendSticker', 'sendMediaGroup', 'sendLocation', 'sendContact', 'sendPoll', 'copyMessage', 'forwardMessage'
+})
+API_BUDGET_METHODS = API_SEND_METHODS | {
+    'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption', 'editMessageMedia'
+}
+# طرق لا تمر بالبوابة: الاستطلاع وإعدادات البوت وقراءة حالة الاشتراك
+API_UNGATED_METHODS = frozenset({'getUpdates', 'getMe', 'getWebhookInfo', 'setWebhook', 'deleteWebhook', 'getChatMember'})
+
+# فئة الطلبات الصادرة من السياق الحالي (None = حسب الطريقة)؛ البث يضبطها على 'broadcast'
+api_priority = contextvars.ContextVar('api_priority', default=None)
+
+api_gateway_wait = register_metric(HistogramMetric(
+    'bot_api_gateway_wait_seconds', 'Time outbound Bot API requests waited in the gateway', ('class',)))
+
+def get_retry_after(error, default=1):
+    """استخراج مدة الانتظار المطلوبة من خطأ 429"""
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', default)
+
+class TokenBucket:
+    """دلو رموز مشترك بين الخيوط لتحديد المعدل العام، مع إيقاف مؤقت مشترك عند 429"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, reserve=0):
+        """استهلاك رمز إن بقي بعده reserve رموز على الأقل وإرجاع 0، وإلا إرجاع مدة الانتظار المقترحة"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1 + reserve:
+                self._tokens -= 1
+                return 0
+            return (1 + reserve - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """إيقاف كل المرسلين حتى انتهاء مدة retry_after"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def paused_for(self):
+        with self._lock:
+            return max(self._paused_until - time.monotonic(), 0.0)
+
+def api_priority_class(method_name):
+    override = api_priority.get()
+    if override is not None:
+        return override
+    return 'callback' if method_name == 'answerCallbackQuery' else 'interactive'
+
+class ApiGateway:
+    """بوابة الأولويات: طلبات الميزانية تنتظر في طابور واحد مرتب حسب الفئة ثم الوصول
+
+    كل منتظر يُوقظ عندما يصبح أول الطابور فقط، ومن في أوله ينام حتى موعد الرمز التالي أو نهاية الإيقاف.
+    البث يترك reserve رموز في الدلو للطلبات التفاعلية، وباقي الطلبات (الرد على الأزرار مثلاً)
+    لا تنتظر إلا نهاية إيقاف 429
+    """
+
+    def __init__(self, rate, burst, reserve):
+        self.bucket = TokenBucket(rate, burst)
+        self.reserve = min(reserve, self.bucket.capacity - 1)
+        self._lock = threading.Lock()
+        self._waiting = []  # كومة (أولوية، تسلسل، دالة الإيقاظ)
+        self._sequence = itertools.count()
+        self.rate_limited = 0
+        self._classes = {
+            name: {'depth': 0, 'max_depth': 0, 'admitted': 0, 'budgeted': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for name in API_PRIORITIES
+        }
+
+    def acquire(self, name, method_name):
+        """انتظار السماح بإرسال الطلب؛ يُرجع مدة الانتظار"""
+        start = self._enter(name)
+        if method_name not in API_BUDGET_METHODS:
+            wait = self.bucket.paused_for()
+            while wait:
+                time.sleep(wait)
+                wait = self.bucket.paused_for()
+            return self._admitted(name, start, False)
+        wakeup = threading.Event()
+        ticket = self._enqueue(name, wakeup.set)
+        while True:
+            wait = self._try_admit(name, ticket)
+            if wait == 0:
+                return self._admitted(name, start, True)
+            if wait is None:
+                wakeup.wait()
+                wakeup.clear()
+            else:
+                # طلب أعلى أولوية قد يصل أثناء النوم فيوقظنا حين يصبح دورنا من جديد
+                wakeup.wait(wait)
+                wakeup.clear()
+
+    async def acquire_async(self, name, method_name):
+        start = self._enter(name)
+        if method_name not in API_BUDGET_METHODS:
+            wait = self.bucket.paused_for()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.bucket.paused_for()
+            return self._admitted(name, start, False)
+        wakeup = asyncio.Event()
+        ticket = self._enqueue(name, functools.partial(asyncio.get_running_loop().call_soon_threadsafe, wakeup.set))
+        try:
+            while True:
+                wait = self._try_admit(name, ticket)
+                if wait == 0:
+                    return self._admitted(name, start, True)
+                if wait is None:
+                    await wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                wakeup.clear()
+        except BaseException:
+            # مهمة أُلغيت أثناء الانتظار: إزالة دورها حتى لا توقف من خلفها
+            self._abandon(name, ticket)
+            raise
+
+    def pause(self, seconds):
+        """إيقاف كل الفئات حتى انتهاء retry_after"""
+        self.bucket.pause(seconds)
+        with self._lock:
+            self.rate_limited += 1
+
+    def depth(self):
+        """عدد طلبات الميزانية المنتظرة في الطابور"""
+        with self._lock:
+            return len(self._waiting)
+
+    def stats(self):
+        with self._lock:
+            classes = {}
+            for name, entry in self._classes.items():
+                classes[name] = {
+                    'depth': entry['depth'],
+                    'max_depth': entry['max_depth'],
+                    'admitted': entry['admitted'],
+                    'budgeted': entry['budgeted'],
+                    'wait_avg_ms': round(entry['wait_total'] / max(entry['admitted'], 1) * 1000, 3),
+                    'wait_max_ms': round(entry['wait_max'] * 1000, 3)
+                }
+            rate_limited = self.rate_limited
+            queued = len(self._waiting)
+        return {
+            'rate': self.bucket.rate,
+            'reserve': self.reserve,
+            'queued': queued,
+            'rate_limited': rate_limited,
+            'paused_for': round(self.bucket.paused_for(), 3),
+            'classes': classes
+        }
+
+    def _enter(self, name):
+        with self._lock:
+            entry = self._classes[name]
+            entry['depth'] += 1
+            entry['max_depth'] = max(entry['max_depth'], entry['depth'])
+        return time.perf_counter()
+
+    def _enqueue(self, name, wake):
+        ticket = (API_PRIORITIES.index(name), next(self._sequence), wake)
+        with self._lock:
+            head = self._waiting[0] if self._waiting else None
+            heapq.heappush(self._waiting, ticket)
+            if head is not None and self._waiting[0] is ticket:
+                # الأول السابق قد ينام حتى رمزه: إيقاظه ليرى أنه لم يعد الأول
+                head[2]()
+        return ticket
+
+    def _try_admit(self, name, ticket):
+        """0 إذا أُخذ الطلب من الطابور، None إذا لم يصل دوره، وإلا مدة الانتظار حتى الرمز التالي"""
+        with self._lock:
+            if self._waiting[0] is not ticket:
+                return None
+            wait = self.bucket.try_acquire(self.reserve if name == 'broadcast' else 0)
+            if not wait:
+                heapq.heappop(self._waiting)
+                if self._waiting:
+                    self._waiting[0][2]()
+            return wait
+
+    def _abandon(self, name, ticket):
+        with self._lock:
+            if ticket in self._waiting:
+                head = self._waiting[0] is ticket
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                if head and self._waiting:
+                    self._waiting[0][2]()
+            self._classes[name]['depth'] -= 1
+
+    def _admitted(self, name, start, budgeted):
+        waited = time.perf_counter() - start
+        with self._lock:
+            entry = self._classes[name]
+            entry['depth'] -= 1
+            entry['admitted'] += 1
+            entry['budgeted'] += budgeted
+            entry['wait_total'] += waited
+            entry['wait_max'] = max(entry['wait_max'], waited)
+        api_gateway_wait.observe(waited, name)
+        record_step(f"gateway:{name}", waited)
+        return waited
+
+# كل شريحة تستهلك حصتها من الميزانية العامة (API_RATE=0 يعطل البوابة)
+api_gateway = ApiGateway(API_RATE / SHARD_COUNT, API_BURST, API_INTERACTIVE_RESERVE) if API_RATE else None
+
+def install_api_gateway():
+    """تمرير كل طلبات Bot API المتزامنة عبر api_gateway"""
+    make_request = telebot.apihelper._make_request
+    if getattr(make_request, 'gated', False):
+        return
+
+    @functools.wraps(make_request)
+    def gated_request(token, method_name, *args, **kwargs):
+        gateway = api_gateway
+        if gateway is None or method_name in API_UNGATED_METHODS:
+            return make_request(token, method_name, *args, **kwargs)
+        gateway.acquire(api_priority_class(method_name), method_name)
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                gateway.pause(get_retry_after(e))
+            raise
+
+    gated_request.gated = True
+    telebot.apihelper._make_request = gated_request
+
+install_api_gateway()
+
+def install_async_api_gateway():
+    """نفس البوابة لطلبات AsyncTeleBot (الوسيط url هو اسم الطريقة)"""
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, 'gated', False):
+        return
+
+    @functools.wraps(process_request)
+    async def gated_request(token, url, *args, **kwargs):
+        gateway = api_gateway
+        if gateway is None or url in API_UNGATED_METHODS:
+            return await process_request(token, url, *args, **kwargs)
+        await gateway.acquire_async(api_priority_class(url), url)
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            if e.error_code == 429:
+                gateway.pause(get_retry_after(e))
+            raise
+
+    gated_request.gated = True
+    asyncio_helper._process_request = gated_request
+
+# ==================== محرك البث ====================
+# عدد الخيوط، أقل فاصل بين رسالتين لنفس المحادثة، ومجلد سجلات التسليم؛ معدل البث تحدده بوابة الطلبات
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', '1.0'))
+BROADCAST_JOURNAL_DIR = shard_path(os.getenv('BROADCAST_JOURNAL_DIR', 'broadcasts'))
+BROADCAST_JOURNAL_RETENTION = 3 * 24 * 3600
+BROADCAST_MAX_RETRIES = 3
+
+class BroadcastEngine:
+    """إرسال رسالة واحدة لكل المستخدمين عبر مجموعة خيوط وسجل تسليم قابل للاستئناف
+
+    كل إرسال يمر بفئة 'broadcast' في api_gateway التي تحدد المعدل وتتوقف عند 429
+    """
+
+    def __init__(self, workers, per_chat_interval, journal_dir):
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.journal_dir = journal_dir
+        self._chat_last_sent = {}
+        self._chat_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self.runs = {}  # run_id -> تقدم البث
+
+    def run(self, run_id, user_ids, text, reply_markup=None, parse_mode=None, spread=0):
+        """تنفيذ البث؛ إعادة التشغيل بنفس run_id تتخطى المحادثات المسجلة في السجل
+
+        spread: توزيع الإرسال على هذه المدة (بالثواني) لتخفيف ذروة الحمل
+        """
+        journal_path, done, reply_markup, progress = self._start_run(run_id, user_ids, reply_markup)
+        tasks = queue.Queue(maxsize=self.workers * 16)
+        
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            threads = [
+                threading.Thread(
+                    target=self._worker,
+                    args=(tasks, journal, progress, text, reply_markup, parse_mode),
+                    name=f"broadcast-{i}",
+                    daemon=True
+                )
+                for i in range(self.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            
+            for index, target in self._targets(user_ids, done, progress):
+                if spread:
+                    delay = progress['started_at'] + spread * index / len(user_ids) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                tasks.put(target)
+            
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        
+        return self._finish_run(progress)
+
+    async def run_async(self, abot, run_id, user_ids, text, reply_markup=None, parse_mode=None, spread=0):
+        """نفس run لكن بمهام asyncio بدلاً من الخيوط، باستخدام البوت غير المتزامن abot"""
+        journal_path, done, reply_markup, progress = self._start_run(run_id, user_ids, reply_markup)
+        tasks = asyncio.Queue(maxsize=self.workers * 16)
+        
+        async def worker():
+            # كل مهمة تعمل في نسخة خاصة من السياق
+            api_priority.set('broadcast')
+            while True:
+                target = await tasks.get()
+                if target is None:
+                    return
+                user_id, chat_id = target
+                try:
+                    status = await self._deliver_async(abot, user_id, chat_id, text, reply_markup, parse_mode)
+                except Exception as e:
+                    logger.error(f"Error in sending notification to user {user_id}: {e}")
+                    status = None
+                self._record(journal, progress, chat_id, status)
+        
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+            for index, target in self._targets(user_ids, done, progress):
+                if spread:
+                    delay = progress['started_at'] + spread * index / len(user_ids) - time.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await tasks.put(target)
+            for _ in workers:
+                await tasks.put(None)
+            await asyncio.gather(*workers)
+        
+        return self._finish_run(progress)
+
+    def _start_run(self, run_id, user_ids, reply_markup):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._prune_journals()
+        journal_path = os.path.join(self.journal_dir, f"{run_id}.journal")
+        done = self._load_journal(journal_path)
+        
+        # تحويل لوحة المفاتيح إلى JSON مرة واحدة لكل البث
+        if isinstance(reply_markup, types.JsonSerializable):
+            reply_markup = reply_markup.to_json()
+        
+        progress = self.runs[run_id] = {
+            'run_id': run_id,
+            'total': len(user_ids),
+            'resumed': len(done),
+            'sent': 0,
+            'skipped': 0,
+            'blocked': 0,
+            'failed': 0,
+            'started_at': time.time(),
+            'finished_at': None
+        }
+        return journal_path, done, reply_markup, progress
+
+    def _targets(self, user_ids, done, progress):
+        """(ترتيب المستخدم، (user_id, chat_id)) لكل محادثة لم تستلم الرسالة بعد"""
+        # كل محادثة تستلم الرسالة مرة واحدة فقط
+        seen = set(done)
+        for index, user_id in enumerate(user_ids):
+            chat_id = get_user_data(user_id).get('chat_id')
+            if chat_id is None or chat_id in seen:
+                with self._journal_lock:
+                    progress['skipped'] += 1
+                continue
+            seen.add(chat_id)
+            yield index, (user_id, chat_id)
+
+    def _record(self, journal, progress, chat_id, status):
+        with self._journal_lock:
+            progress[status or 'failed'] += 1
+            # لا نسجل الإخفاقات المؤقتة حتى يعاد المحاولة عند الاستئناف
+            if status is not None:
+                journal.write(f"{chat_id} {status}\n")
+                journal.flush()
+
+    def _finish_run(self, progress):
+        progress['finished_at'] = time.time()
+        self._forget_finished_runs()
+        return dict(progress)
+
+    def _forget_finished_runs(self, keep=20):
+        finished = [run_id for run_id, p in list(self.runs.items()) if p['finished_at'] is not None]
+        for run_id in finished[:-keep]:
+            self.runs.pop(run_id, None)
+
+    def _worker(self, tasks, journal, progress, text, reply_markup, parse_mode):
+        api_priority.set('broadcast')
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            user_id, chat_id = task
+            try:
+                status = self._deliver(user_id, chat_id, text, reply_markup, parse_mode)
+            except Exception as e:
+                logger.error(f"Error in sending notification to user {user_id}: {e}")
+                status = None
+            self._record(journal, progress, chat_id, status)
+
+    def _deliver(self, user_id, chat_id, text, reply_markup, parse_mode):
+        if not is_user_subscribed(user_id):
+            return 'skipped'
+        
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            delay = self._reserve_chat_slot(chat_id)
+            if delay:
+                time.sleep(delay)
+            try:
+                bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+                return 'sent'
+            except telebot.apihelper.ApiTelegramException as e:
+                status = self._handle_send_error(user_id, e)
+                if status is not None:
+                    return status
+            except Exception as e:
+                # خطأ شبكة مؤقت: انتظار متزايد قبل إعادة المحاولة
+                logger.warning(f"Transient error sending to user {user_id}: {e}")
+                time.sleep(min(2 ** attempt, 10))
+        return None
+
+    async def _deliver_async(self, abot, user_id, chat_id, text, reply_markup, parse_mode):
+        if not await is_user_subscribed_async(abot, user_id):
+            return 'skipped'
+        
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            delay = self._reserve_chat_slot(chat_id)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                await abot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+                return 'sent'
+            except asyncio_helper.ApiTelegramException as e:
+                status = self._handle_send_error(user_id, e)
+                if status is not None:
+                    return status
+            except Exception as e:
+                logger.warning(f"Transient error sending to user {user_id}: {e}")
+                await asyncio.sleep(min(2 ** attempt, 10))
+        return None
+
+    def _handle_send_error(self, user_id, error):
+        """حالة نهائية للتسليم، أو None إذا كان يجب إعادة المحاولة"""
+        if error.error_code == 429:
+            # البوابة أوقفت كل الفئات عند هذا الخطأ؛ المحاولة التالية تنتظر نهاية الإيقاف
+            logger.warning(f"Broadcast rate limited, retrying after {get_retry_after(error)}s")
+            return None
+        if error.error_code == 403:  # المستخدم حظر البوت
+            logger.warning(f"User {user_id} blocked the bot. Removing from user store.")
+            user_store.delete(user_id)
+            counter_history.forget(user_id)
+            return 'blocked'
+        logger.error(f"Error sending notification to user {user_id}: {error}")
+        return 'failed'
+
+    def _reserve_chat_slot(self, chat_id):
+        """حجز موعد الإرسال التالي لهذه المحادثة وإرجاع مدة الانتظار حتى الموعد"""
+        with self._chat_lock:
+            now = time.monotonic()
+            send_at = max(now, self._chat_last_sent.get(chat_id, 0.0) + self.per_chat_interval)
+            self._chat_last_sent[chat_id] = send_at
+            if len(self._chat_last_sent) > 100000:
+                expired = now - self.per_chat_interval
+                self._chat_last_sent = {c: t for c, t in self._chat_last_sent.items() if t > expired}
+        return send_at - now
+
+    def _load_journal(self, path):
+        done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        done.add(int(parts[0]))
+            logger.info(f"Resuming broadcast from {path}: {len(done)} chats already handled")
+        return done
+
+    def _prune_journals(self):
+        """حذف سجلات البث القديمة"""
+        cutoff = time.time() - BROADCAST_JOURNAL_RETENTION
+        for name in os.listdir(self.journal_dir):
+            path = os.path.join(self.journal_dir, name)
+            try:
+                if name.endswith('.journal') and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+broadcast_engine = BroadcastEngine(BROADCAST_WORKERS, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_JOURNAL_DIR)
+
+# ==================== نظام التذكيرات اليومية ====================
+# تصميم زر للوصول السريع للبوت
+DAILY_KEYBOARD = _single_column_keyboard(
+    types.InlineKeyboardButton("📿 افتح بوت الذكر الآن", url="https://t.me/Ryukn_bot")
+)
+
+def build_daily_message(morning=True):
+    """إنشاء نص التذكير اليومي (مرة واحدة لكل بث)"""
+    if morning:
+        # رسالة الصباح
+        message_text = "🌅 *صباح الخير! حان وقت شروق شمس الأجر* 🌞\n\n"
+        message_text += "☀️ أسأل الله أن يجعل يومك بركة وذكراً وتقوى\n\n"
+        message_text += "🌸 *ذكر الصباح المختار:*\n"
+        message_text += f"➖ {random.choice(morning_dhikr)}\n\n"
+        message_text += "🌟 *فائدة اليوم:*\n"
+        message_text += "> \"من قال حين يصبح: سبحان الله وبحمده، مائة مرة، لم يأت أحد يوم القيامة بأفضل مما جاء به إلا أحد قال مثل ذلك أو زاد\" (رواه مسلم)\n\n"
+        message_text += "📿 استمر في الذكر لتحصد الأجر المضاعف"
+    else:
+        # رسالة المساء
+        message_text = "🌄 *مساء الخير! حان وقت غروب شمس الثواب* 🌙\n\n"
+        message_text += "🌠 أسأل الله أن يغفر لك ذنوبك ويرفع درجاتك\n\n"
+        message_text += "🌸 *ذكر المساء المختار:*\n"
+        message_text += f"➖ {random.choice(evening_dhikr)}\n\n"
+        message_text += "🌟 *فائدة اليوم:*\n"
+        message_text += "> \"من قال حين يمسي: سبحان الله وبحمده، مائة مرة، لم يأت أحد يوم القيامة بأفضل مما جاء به إلا أحد قال مثل ذلك أو زاد\" (رواه مسلم)\n\n"
+        message_text += "📿 استمر في الذكر لتحصد الأجر المضاعف"
+    return message_text
+
+def send_daily_notifications(morning=True, run_id=None, user_ids=None, spread=0):
+    """إرسال تذكيرات يومية لجميع المستخدمين (أو للمستخدمين المحددين)"""
+    try:
+        if user_ids is None:
+            user_ids = user_store.user_ids()
+        if run_id is None:
+            run_id = f"{'morning' if morning else 'evening'}-{datetime.utcnow():%Y-%m-%d}"
+        
+        result = broadcast_engine.run(
+            run_id,
+            user_ids,
+            build_daily_message(morning),
+            reply_markup=DAILY_KEYBOARD,
+            parse_mode="Markdown",
+            spread=spread
+        )
+        log_broadcast_result(result)
+    except Exception as e:
+        logger.error(f"Error in daily notifications: {e}")
+
+async def send_daily_notifications_async(abot, morning=True, run_id=None, user_ids=None, spread=0):
+    """نسخة asyncio من send_daily_notifications"""
+    try:
+        if user_ids is None:
+            user_ids = user_store.user_ids()
+        if run_id is None:
+            run_id = f"{'morning' if morning else 'evening'}-{datetime.utcnow():%Y-%m-%d}"
+        
+        result = await broadcast_engine.run_async(
+            abot,
+            run_id,
+            user_ids,
+            build_daily_message(morning),
+            reply_markup=DAILY_KEYBOARD,
+            parse_mode="Markdown",
+            spread=spread
+        )
+        log_broadcast_result(result)
+    except Exception as e:
+        logger.error(f"Error in daily notifications: {e}")
+
+def log_broadcast_result(result):
+    elapsed = result['finished_at'] - result['started_at']
+    logger.info(
+        f"Broadcast {result['run_id']} finished in {elapsed:.1f}s: {result['sent']} sent, "
+        f"{result['blocked']} blocked, {result['failed']} failed, {result['skipped']} skipped"
+    )
+
+# ==================== جدولة التذكيرات ====================
+# الأوقات الافتراضية للمستخدمين بدون تفضيلات، مدة توزيع الإرسال، ومدة تعويض المواعيد الفائتة بعد إعادة التشغيل
+REMINDER_DEFAULT_TZ = os.getenv('REMINDER_DEFAULT_TZ', 'UTC')
+REMINDER_MORNING_TIME = os.getenv('REMINDER_MORNING_TIME', '07:00')
+REMINDER_EVENING_TIME = os.getenv('REMINDER_EVENING_TIME', '19:00')
+REMINDER_SPREAD = float(os.getenv('REMINDER_SPREAD', '900'))
+REMINDER_CATCHUP = float(os.getenv('REMINDER_CATCHUP', '7200'))
+REMINDER_CONCURRENT_RUNS = int(os.getenv('REMINDER_CONCURRENT_RUNS', '4'))
+
+REMINDER_TIME_PATTERN = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+
+def reminder_slot(user_id, kind, prefs=None):
+    """موعد تذكير المستخدم (النوع، المنطقة الزمنية، الوقت المحلي) أو None إذا كان معطلاً"""
+    if prefs is None:
+        prefs = user_store.get_preferences(user_id)
+    default = REMINDER_MORNING_TIME if kind == 'morning' else REMINDER_EVENING_TIME
+    at = prefs.get(kind) or default
+    if at == 'off':
+        return None
+    return (kind, prefs.get('timezone') or REMINDER_DEFAULT_TZ, at)
+
+class ReminderScheduler:
+    """جدولة المواعيد المحلية في كومة أولويات والنوم حتى أقرب موعد مستحق"""
+
+    def __init__(self, fire_callback, catchup, concurrent_runs):
+        self._fire_callback = fire_callback
+        self.catchup = catchup
+        self._heap = []    # (due_at, seq, slot, local_date)
+        self._slots = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=concurrent_runs, thread_name_prefix='reminder')
+
+    def add_slot(self, slot, catch_up=False):
+        """إضافة موعد جديد؛ مع catch_up يُنفذ فوراً آخر موعد فائت إذا كان حديثاً"""
+        with self._cond:
+            if slot in self._slots:
+                return
+            self._slots.add(slot)
+            self._push_next(slot, time.time(), catch_up)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                # النوم حتى الموعد التالي (بحد أقصى 5 دقائق لتدارك تغيّر ساعة النظام)
+                wait, due = self._pop_due()
+                while due is None:
+                    self._cond.wait(min(wait, 300) if wait is not None else None)
+                    wait, due = self._pop_due()
+            self._executor.submit(self._fire, *due)
+
+    async def run_async(self, fire_async):
+        """حلقة الجدولة كـ coroutine؛ fire_async(slot, local_date) يُرجع عدد المستهدفين"""
+        while True:
+            with self._cond:
+                wait, due = self._pop_due()
+            if due is None:
+                # المواعيد المضافة أثناء النوم تُلتقط خلال 30 ثانية على الأكثر
+                await asyncio.sleep(min(wait, 30) if wait is not None else 30)
+                continue
+            asyncio.get_running_loop().create_task(self._fire_async(fire_async, *due))
+
+    def _pop_due(self):
+        """(None, (slot, local_date)) للموعد المستحق، أو (مدة الانتظار، None)؛ يُستدعى مع قفل المجدول"""
+        while self._heap:
+            due_at, _, slot, local_date = self._heap[0]
+            if due_at > time.time():
+                return due_at - time.time(), None
+            heapq.heappop(self._heap)
+            if slot in self._slots:
+                self._push_next(slot, max(time.time(), due_at), False)
+                return None, (slot, local_date)
+        return None, None
+
+    def _fire(self, slot, local_date):
+        try:
+            self._after_fire(slot, self._fire_callback(slot, local_date))
+        except Exception as e:
+            logger.error(f"Error in notification scheduler: {e}")
+
+    async def _fire_async(self, fire_async, slot, local_date):
+        try:
+            self._after_fire(slot, await fire_async(slot, local_date))
+        except Exception as e:
+            logger.error(f"Error in notification scheduler: {e}")
+
+    def _after_fire(self, slot, targeted):
+        if not targeted and slot not in default_reminder_slots():
+            # لم يعد أي مستخدم يستعمل هذا الموعد
+            with self._cond:
+                self._slots.discard(slot)
+
+    def _push_next(self, slot, now, catch_up):
+        kind, tz_name, at = slot
+        tz = ZoneInfo(tz_name)
+        hour, minute = map(int, at.split(':'))
+        today = datetime.fromtimestamp(now, tz).date()
+        for offset in (-1, 0, 1, 2):
+            local_date = today + timedelta(days=offset)
+            due_at = datetime.combine(local_date, dtime(hour, minute), tzinfo=tz).timestamp()
+            if due_at > now or (catch_up and now - due_at <= self.catchup):
+                heapq.heappush(self._heap, (due_at, next(self._seq), slot, local_date))
+                return
+
+    def pending(self):
+        with self._cond:
+            return [(due_at, slot) for due_at, _, slot, _ in sorted(self._heap) if slot in self._slots]
+
+def default_reminder_slots():
+    return {reminder_slot(None, 'morning', {}), reminder_slot(None, 'evening', {})}
+
+class ReminderIndex:
+    """فهرس المواعيد: مستخدمو كل موعد من أصحاب التفضيلات، ومن خرج منهم عن الموعد الافتراضي لكل نوع
+
+    المستخدم بلا تفضيلات في الموعد الافتراضي، فمستخدمو الموعد الافتراضي هم الكل عدا الخارجين عنه
+    """
+
+    KINDS = ('morning', 'evening')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slot_users = {}  # slot -> مجموعة المستخدمين
+        self._user_slots = {}  # user_id -> (موعد الصباح، موعد المساء)
+        self._away = {kind: set() for kind in self.KINDS}
+        self._defaults = {kind: reminder_slot(None, kind, {}) for kind in self.KINDS}
+
+    def attach(self, store):
+        """بناء الفهرس من التخزين والاشتراك في تغييرات التفضيلات"""
+        store.preferences_listener = self.update
+        # البناء مع القفل: التغييرات أثناءه تنتظر ثم تُطبق بعده فتبقى الأحدث
+        with self._lock:
+            for user_id, prefs in store.all_preferences().items():
+                self._set(user_id, prefs)
+
+    def update(self, user_id, prefs):
+        """تطبيق تفضيلات مستخدم (None أو {} = المواعيد الافتراضية)"""
+        with self._lock:
+            self._set(user_id, prefs)
+
+    def users(self, slot, all_user_ids):
+        """مستخدمو الموعد؛ all_user_ids() تُستدعى للموعد الافتراضي فقط"""
+        kind = slot[0]
+        with self._lock:
+            members = list(self._slot_users.get(slot, ()))
+            away = set(self._away[kind]) if slot == self._defaults[kind] else None
+        if away is None:
+            return members
+        # أصحاب التفضيلات المطابقة للافتراضي موجودون أصلاً في all_user_ids
+        return list(itertools.filterfalse(away.__contains__, all_user_ids())) if away else all_user_ids()
+
+    def slots(self):
+        with self._lock:
+            return set(self._slot_users) | (set(self._defaults.values()) - {None})
+
+    def _set(self, user_id, prefs):
+        """يُستدعى مع قفل الفهرس"""
+        old = self._user_slots.pop(user_id, None)
+        if old is not None:
+            for kind, slot in zip(self.KINDS, old):
+                members = self._slot_users.get(slot)
+                if members is not None:
+                    members.discard(user_id)
+                    if not members:
+                        del self._slot_users[slot]
+                self._away[kind].discard(user_id)
+        if not prefs:
+            return
+        slots = self._user_slots[user_id] = tuple(reminder_slot(user_id, kind, prefs) for kind in self.KINDS)
+        for kind, slot in zip(self.KINDS, slots):
+            if slot is not None:
+                self._slot_users.setdefault(slot, set()).add(user_id)
+            if slot != self._defaults[kind]:
+                self._away[kind].add(user_id)
+
+reminder_index = ReminderIndex()
+reminder_index.attach(user_store)
+
+def reminder_slot_users(slot):
+    """المستخدمون الذين يقع تذكيرهم في هذا الموعد"""
+    return reminder_index.users(slot, user_store.user_ids)
+
+def reminder_run_id(slot, local_date):
+    # معرف البث ثابت لكل موعد ويوم، فإعادة التشغيل تستأنف ولا تكرر الإرسال
+    kind, tz_name, at = slot
+    return f"{kind}-{tz_name.replace('/', '_')}-{at.replace(':', '')}-{local_date:%Y-%m-%d}"
+
+def fire_reminder_slot(slot, local_date):
+    """إرسال تذكير موعد محدد لكل المستخدمين المشتركين فيه؛ يُرجع عدد المستهدفين"""
+    kind, tz_name, at = slot
+    user_ids = reminder_slot_users(slot)
+    if user_ids:
+        send_daily_notifications(
+            morning=(kind == 'morning'), run_id=reminder_run_id(slot, local_date),
+            user_ids=user_ids, spread=REMINDER_SPREAD
+        )
+        logger.info(f"Sent {kind} notifications for {tz_name} {at} to {len(user_ids)} users")
+    return len(user_ids)
+
+reminder_scheduler = ReminderScheduler(fire_reminder_slot, REMINDER_CATCHUP, REMINDER_CONCURRENT_RUNS)
+
+async def fire_reminder_slot_async(abot, slot, local_date):
+    """نسخة asyncio من fire_reminder_slot"""
+    kind, tz_name, at = slot
+    user_ids = reminder_slot_users(slot)
+    if user_ids:
+        await send_daily_notifications_async(
+            abot, morning=(kind == 'morning'), run_id=reminder_run_id(slot, local_date),
+            user_ids=user_ids, spread=REMINDER_SPREAD
+        )
+        logger.info(f"Sent {kind} notifications for {tz_name} {at} to {len(user_ids)} users")
+    return len(user_ids)
+
+def load_reminder_slots():
+    """إضافة كل المواعيد المعروفة إلى المجدول مع تعويض المواعيد الفائتة حديثاً"""
+    for slot in reminder_index.slots():
+        reminder_scheduler.add_slot(slot, catch_up=True)
+
+def schedule_daily_notifications():
+    """جدولة التذكيرات اليومية"""
+    load_reminder_slots()
+    reminder_scheduler.run()
+
+# ==================== وضع Webhook ====================
+# polling للتطوير المحلي، webhook للإنتاج خلف موزع الحمل، async لحلقة asyncio واحدة (polling)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+class UpdateQueue:
+    """طابور محدود للتحديثات الواردة تستهلكه مجموعة خيوط معالجة"""
+
+    def __init__(self, handler, workers, maxsize):
+        self._handler = handler
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.max_depth = 0
+
+    def submit(self, update, block=False):
+        """إضافة تحديث (دون انتظار افتراضياً)؛ يُرجع False عند امتلاء الطابور"""
+        self._ensure_started()
+        try:
+            self._queue.put(update, block=block)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self._queue.qsize(),
+                'capacity': self._queue.maxsize,
+                'max_depth': self.max_depth,
+                'workers': self.workers,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed
+            }
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self._handler(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            with self._lock:
+                self.processed += 1
+            self._queue.task_done()
+
+    def join(self):
+        """انتظار انتهاء معالجة كل التحديثات المقبولة"""
+        self._queue.join()
+
+def process_update(update):
+    """تمرير التحديث إلى معالجات البوت في خيط العامل الحالي"""
+    bot.process_new_updates([update])
+
+update_queue = UpdateQueue(process_update, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def webhook():
+    """استقبال التحديثات من تليجرام ووضعها في طابور المعالجة"""
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return Response(status=403)
+    
+    if shard_dispatcher is not None:
+        accepted = shard_dispatcher.route(request.get_json(force=True), block=False)
+    else:
+        accepted = update_queue.submit(types.Update.de_json(request.get_data(as_text=True)))
+    if not accepted:
+        # الطابور ممتلئ: تليجرام سيعيد إرسال التحديث لاحقاً
+        logger.warning("Update queue full, rejecting webhook update")
+        return Response(status=503, headers={'Retry-After': '1'})
+    return Response(status=200)
+
+# ==================== تسجيل التحديثات ====================
+# مجلد سجل التحديثات (فارغ = معطل): ملف NDJSON لكل يوم (UTC) لإعادة تشغيل شكل حركة يوم حقيقي في اختبارات السعة
+UPDATE_RECORD_DIR = os.getenv('UPDATE_RECORD_DIR', '')
+# مفتاح إخفاء معرفات المستخدمين؛ إن لم يُحدد يُولد مفتاح عشوائي لكل تشغيل فلا يمكن ربط السجلات بالمستخدمين
+UPDATE_RECORD_KEY = os.getenv('UPDATE_RECORD_KEY', '')
+UPDATE_RECORD_FLUSH = 1.0
+
+def anonymize_user_id(key, user_id):
+    """معرف مجهول ثابت لنفس المستخدم ونفس المفتاح (48 بت من HMAC-SHA256)"""
+    digest = hmac.new(key, str(user_id).encode(), 'sha256').digest()
+    return int.from_bytes(digest[:6], 'big') + 1
+
+class UpdateRecorder:
+    """إضافة كل تحديث وارد إلى سجل مختصر: وقت الوصول، النوع، معرف مجهول، والأمر أو بيانات الزر"""
+
+    def __init__(self, directory, key, flush_interval=UPDATE_RECORD_FLUSH):
+        self.directory = directory
+        self.key = key.encode() if key else os.urandom(16)
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._lines = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wakeup = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='update-recorder', daemon=True)
+        self._thread.start()
+
+    def path(self, day):
+        return os.path.join(self.directory, f"updates-{day:%Y%m%d}.ndjson")
+
+    def record(self, updates):
+        ts = round(time.time(), 3)
+        lines = []
+        for update in updates:
+            entry = self._entry(update, ts)
+            if entry is not None:
+                lines.append(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+        if lines:
+            # الملف يُختار بيوم وصول التحديث لا بوقت التفريغ، فما وصل قبل منتصف الليل يبقى في ملف يومه
+            day = datetime.utcfromtimestamp(ts)
+            with self._lock:
+                self._lines.extend((day, line) for line in lines)
+                self.recorded += len(lines)
+
+    def _entry(self, update, ts):
+        if update.callback_query is not None:
+            call = update.callback_query
+            return {
+                'ts': ts, 'kind': 'callback_query', 'user': anonymize_user_id(self.key, call.from_user.id),
+                'data': call.data, 'message_id': call.message.message_id if call.message else None
+            }
+        if update.message is not None:
+            message = update.message
+            text = message.text or ''
+            return {
+                'ts': ts, 'kind': 'message', 'user': anonymize_user_id(self.key, message.from_user.id),
+                'message_id': message.message_id,
+                # نص المستخدم لا يُحفظ؛ الأوامر فقط لأنها تحدد المعالج
+                'text': text if text.startswith('/') else ''
+            }
+        if update.chat_member is not None:
+            member = update.chat_member
+            return {
+                'ts': ts, 'kind': 'chat_member', 'user': anonymize_user_id(self.key, member.new_chat_member.user.id),
+                'chat': member.chat.id, 'status': member.new_chat_member.status
+            }
+        return None
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        by_path = {}
+        for day, line in lines:
+            by_path.setdefault(self.path(day), []).append(line)
+        for path, day_lines in by_path.items():
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(day_lines) + '\n')
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing update record: {e}")
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+def install_update_recorder(target, recorder):
+    """تسجيل التحديثات قبل تمريرها للمعالجات؛ يغطي polling وwebhook والعمليات العاملة وAsyncTeleBot"""
+    process = target.process_new_updates
+    if inspect.iscoroutinefunction(process):
+        async def process_recorded(updates):
+            recorder.record(updates)
+            await process(updates)
+    else:
+        def process_recorded(updates):
+            recorder.record(updates)
+            process(updates)
+    target.process_new_updates = process_recorded
+
+def recorded_update(entry, update_id):
+    """تحويل سطر من سجل التحديثات إلى تحديث Telegram (dict) لإعادة التشغيل"""
+    user = {'id': entry['user'], 'is_bot': False, 'first_name': f"user{entry['user']}"}
+    chat = {'id': entry['user'], 'type': 'private'}
+    date = int(entry['ts'])
+    if entry['kind'] == 'callback_query':
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(entry['user']), 'data': entry['data'],
+            'message': {'message_id': entry['message_id'] or 1, 'date': date, 'chat': chat}
+        }}
+    if entry['kind'] == 'message':
+        text = entry['text']
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        return {'update_id': update_id, 'message': {
+            'message_id': entry['message_id'], 'date': date, 'text': text, 'from': user, 'chat': chat, 'entities': entities
+        }}
+    return {'update_id': update_id, 'chat_member': {
+        'chat': {'id': entry['chat'], 'type': 'channel'}, 'from': user, 'date': date,
+        'old_chat_member': {'user': user, 'status': 'left'},
+        'new_chat_member': {'user': user, 'status': entry['status']}
+    }}
+
+def read_update_records(paths):
+    """قراءة أسطر سجل (أو عدة سجلات) التحديثات مرتبة حسب وقت الوصول"""
+    entries = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+# الموزع لا يعالج التحديثات بنفسه؛ كل عملية عاملة تسجل في مجلدها الخاص
+update_recorder = None
+if UPDATE_RECORD_DIR and not (SHARD_WORKERS and SHARD_INDEX is None):
+    update_recorder = UpdateRecorder(shard_path(UPDATE_RECORD_DIR), UPDATE_RECORD_KEY)
+    install_update_recorder(bot, update_recorder)
+    atexit.register(update_recorder.close)
+
+# ==================== مجمع اتصالات HTTP ====================
+# جلسة requests واحدة لكل طلبات Bot API المتزامنة، بمجمع يتسع لكل الخيوط التي قد تتصل في نفس الوقت
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '15'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.25'))
+HTTP_POOL_SIZE = int(os.getenv(
+    'HTTP_POOL_SIZE',
+    # خيوط المعالجات + خيوط البث + خيوط تعديل القائمة + الاستطلاع والحذف المؤجل
+    str((WEBHOOK_WORKERS if BOT_MODE == 'webhook' else BOT_THREADS) + BROADCAST_WORKERS + MENU_EDIT_WORKERS + 2)
+))
+# طرق لا يضر تكرارها إذا وصل الطلب الأول فعلاً (sendMessage ليست منها)
+IDEMPOTENT_API_METHODS = frozenset((
+    'getMe', 'getUpdates', 'getChatMember', 'editMessageText', 'answerCallbackQuery',
+    'deleteMessage', 'deleteMessages', 'setWebhook', 'deleteWebhook'
+))
+
+class TelegramHTTPClient:
+    """جلسة requests مشتركة بمجمع محدد الحجم، مع إعادة محاولة بتأخير عشوائي للأخطاء العابرة"""
+
+    def __init__(self, pool_size, max_retries, backoff):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        # pool_block يجعل الخيوط الزائدة تنتظر اتصالاً حراً بدلاً من فتح اتصالات تُرمى بعد الاستخدام
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.errors = 0
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """بنفس توقيع CUSTOM_REQUEST_SENDER في telebot.apihelper"""
+        api_method = url.rsplit('/', 1)[-1]
+        idempotent = api_method in IDEMPOTENT_API_METHODS and not files
+        for attempt in itertools.count():
+            try:
+                response = self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+                # إذا فشل الاتصال نفسه فالطلب لم يُرسل وإعادته آمنة لكل الطرق
+                retryable, error = idempotent or self._not_sent(e), e
+            else:
+                if response.status_code < 500:
+                    return response
+                retryable, error = idempotent, None
+            
+            if not retryable or attempt >= self.max_retries:
+                if error is None:
+                    return response
+                with self._lock:
+                    self.errors += 1
+                raise error
+            with self._lock:
+                self.retries += 1
+            # تأخير أسي مع عشوائية كاملة حتى لا تعيد الخيوط المحاولة معاً
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            reason = error.__class__.__name__ if error is not None else f"HTTP {response.status_code}"
+            logger.warning(f"Retrying {api_method} in {delay:.2f}s after {reason}")
+            time.sleep(delay)
+
+    @staticmethod
+    def _not_sent(error):
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def stats(self):
+        """عدد الطلبات والاتصالات الجديدة عبر المجمع؛ نسبة إعادة الاستخدام = 1 - اتصالات/طلبات"""
+        pools = self._adapter.poolmanager.pools
+        connections = requests_sent = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'requests': requests_sent,
+                'connections': connections,
+                'reuse_ratio': round(1 - connections / requests_sent, 4) if requests_sent else 0.0,
+                'retries': self.retries,
+                'errors': self.errors
+            }
+
+def install_http_client(client):
+    """توجيه كل طلبات telebot.apihelper عبر الجلسة المشتركة"""
+    telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+    telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = client.request
+
+telegram_http = TelegramHTTPClient(HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_RETRY_BACKOFF)
+install_http_client(telegram_http)
+
+def collect_stats():
+    """حالة الطوابير والذاكرة المؤقتة في العملية الحالية"""
+    return {
+        'users': user_store.count(),
+        'update_queue': update_queue.stats(),
+        'membership_cache': membership_cache.stats(),
+        'menu_edits': menu_coalescer.stats(),
+        'delayed_actions': delayed_actions.stats(),
+        'http_pool': telegram_http.stats(),
+        'leaderboard': leaderboard.stats(),
+        'tap_limiter': tap_limiter.stats(),
+        'api_gateway': api_gateway.stats() if api_gateway is not None else {}
+    }
+
+@app.route('/stats')
+def stats():
+    """حالة الطوابير والذاكرة المؤقتة بصيغة JSON (مجمعة من كل الشرائح في وضع العمليات المتعددة)"""
+    if shard_dispatcher is not None:
+        return jsonify(shard_dispatcher.stats())
+    return jsonify(collect_stats())
+
+def _broadcast_progress():
+    for run_id, progress in list(broadcast_engine.runs.items()):
+        finished_at = progress['finished_at'] or time.time()
+        elapsed = max(finished_at - progress['started_at'], 1e-9)
+        for field in ('total', 'resumed', 'sent', 'skipped', 'blocked', 'failed'):
+            yield (run_id, field), progress[field]
+        yield (run_id, 'rate'), round(progress['sent'] / elapsed, 3)
+        yield (run_id, 'running'), int(progress['finished_at'] is None)
+
+register_metric(GaugeCollector(
+    'bot_users', 'Known users', lambda: [((), user_store.count())]))
+register_metric(GaugeCollector(
+    'bot_membership_cache', 'Subscription cache size and lookups',
+    lambda: [((key,), value) for key, value in membership_cache.stats().items()], ('stat',)))
+register_metric(GaugeCollector(
+    'bot_broadcast_progress', 'Broadcast delivery progress and send rate per run',
+    _broadcast_progress, ('run_id', 'stat')))
+register_metric(GaugeCollector(
+    'bot_update_queue', 'Webhook update queue depth and counters',
+    lambda: [((key,), value) for key, value in update_queue.stats().items()], ('stat',)))
+register_metric(GaugeCollector(
+    'bot_menu_edits', 'Coalesced main-menu edits',
+    lambda: [((key,), value) for key, value in menu_coalescer.stats().items()], ('stat',)))
+register_metric(GaugeCollector(
+    'bot_delayed_actions', 'Scheduled temporary-message deletions',
+    lambda: [((key,), value) for key, value in delayed_actions.stats().items()], ('stat',)))
+register_metric(GaugeCollector(
+    'bot_http_pool', 'Shared Bot API connection pool: requests, new connections and retries',
+    lambda: [((key,), value) for key, value in telegram_http.stats().items()], ('stat',)))
+register_metric(GaugeCollector(
+    'bot_tap_limiter', 'Per-user tap limiter: tracked users, allowed/limited taps and idle entries removed',
+    lambda: [((key,), value) for key, value in tap_limiter.stats().items()], ('stat',)))
+def _api_gateway_stats():
+    if api_gateway is None:
         return
+    stats = api_gateway.stats()
+    for name, entry in stats['classes'].items():
+        for key, value in entry.items():
+            yield (name, key), value
+    yield ('all', 'queued'), stats['queued']
+    yield ('all', 'rate_limited'), stats['rate_limited']
+    yield ('all', 'paused_for'), stats['paused_for']
+
+register_metric(GaugeCollector(
+    'bot_api_gateway', 'Outbound Bot API gateway: queue depth, admitted requests and wait time per priority class',
+    _api_gateway_stats, ('class', 'stat')))
+register_metric(GaugeCollector(
+    'bot_leaderboard', 'Ranking index size and top-list rebuilds',
+    lambda: [((key,), value) for key, value in leaderboard.stats().items()], ('stat',)))
+
+def start_webhook():
+    """تسجيل عنوان webhook لدى تليجرام"""
+    # المعالجات تعمل في خيوط الطابور مباشرة بدلاً من مجموعة خيوط البوت
+    bot.threaded = False
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=telebot.util.update_types,
+        max_connections=WEBHOOK_WORKERS
+    )
+    logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+
+def run_flask_app():
+    """تشغيل خادم Flask"""
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
+
+# ==================== وضع asyncio ====================
+# نفس المعالجات على AsyncTeleBot: حلقة أحداث واحدة وجلسة aiohttp مشتركة بدلاً من خيط لكل تحديث
+ASYNC_CONNECTION_LIMIT = int(os.getenv('ASYNC_CONNECTION_LIMIT', '100'))
+
+# عمليات النقرة على مستخدم واحد (قفل شريحة لبضع ميكروثوان) تبقى في الحلقة: الانتقال إلى خيط آخر
+# يكلف حتى فترة تبديل GIL كاملة تحت الحمل. ما قد يطول (لوحة المتصدرين، الإحصائيات، الأوامر) يُنقل إلى مجمع الخيوط
+async def run_blocking(func, *args):
+    """تشغيل استدعاء قد ينتظر قفلاً أو يطول في مجمع خيوط الحلقة بدلاً من حلقة الأحداث نفسها"""
+    # نسخة من السياق حتى تبقى خطوات التتبع مسجلة في المعالج الجاري
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+def create_async_bot():
+    """إنشاء AsyncTeleBot وتسجيل النسخ غير المتزامنة من المعالجات؛ يُستدعى من داخل حلقة asyncio"""
+    if AsyncTeleBot is None:
+        raise RuntimeError("BOT_MODE=async requires aiohttp")
+    # حد الاتصالات المفتوحة في مجمع aiohttp المشترك
+    asyncio_helper.REQUEST_LIMIT = ASYNC_CONNECTION_LIMIT
+    install_async_api_metrics()
+    install_async_api_gateway()
+    abot = AsyncTeleBot(BOT_TOKEN)
+    if update_recorder is not None:
+        install_update_recorder(abot, update_recorder)
+    router = CallbackRouter()
     
-    # إعادة تعيين العدادات
-    user_data['subhan_count'] = 0
-    user_data['alhamdulillah_count'] = 0
-    user_data['la_ilaha_count'] = 0
-    user_data['allahu_akbar_count'] = 0
-    user_data['total_count'] = 0
+    @abot.callback_query_handler(func=lambda call: True)
+    async def route_callback(call):
+        # الفحص أولاً كما في المسار المتزامن: النقرات المستوعبة لا تكلف التوجيه
+        if not admit_callback(call, answer_shed_tap):
+            return
+        handler = router.resolve(call.data)
+        if handler is not None:
+            await handler(call)
     
-    # تحديث البيانات
-    update_user_data(user_id, user_data)
+    async def answer_tap(call):
+        try:
+            await abot.answer_callback_query(call.id)
+        except Exception as e:
+            logger.error(f"Error answering shed tap: {e}")
     
-    bot.answer_callback_query(call.id, "✅ تم مسح جميع العدادات بنجاح!", show_alert=True)
+    def answer_shed_tap(call):
+        asyncio.get_running_loop().create_task(answer_tap(call))
     
-    # تحديث القائمة الرئيسية
-    update_main_menu(user_id, call.message.chat.id)
-
-@bot.callback_query_handler(func=lambda call: call.data == 'share_bot')
-def share_bot_callback(call):
-    user_id = call.from_user.id
-    initialize_user_data(user_id, call.message.chat.id)
-    user_data = get_user_data(user_id)
+    async def show_subscription_message(message):
+        await abot.send_message(
+            message.chat.id,
+            SUBSCRIPTION_MESSAGE,
+            parse_mode="Markdown",
+            reply_markup=SUBSCRIPTION_KEYBOARD
+        )
     
-    if not is_user_subscribed(user_id):
-        bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
-        return
+    async def show_main_menu(message):
+        user_id = message.from_user.id
+        initialize_user_data(user_id, message.chat.id)
+        keyboard = get_main_keyboard(user_id)
+        
+        sent_message = await abot.send_message(message.chat.id, get_main_message(user_id), parse_mode="Markdown", reply_markup=keyboard)
+        user_store.set_message_id(user_id, sent_message.message_id)
+        menu_coalescer.discard(user_id)
+        menu_coalescer.mark_rendered(user_id, sent_message.message_id, keyboard)
     
-    share_lines = [
-        "📿 *بوت نُور الذِّكْر*",
-        "أداة رائعة لذكر الله وتحصيل الأجر",
-        "",
-        "قال رسول الله ﷺ:",
-        "\"من دعا إلى هدى كان له من الأجر مثل أجور من تبعه\"",
-        "",
-        "✨ *مميزات البوت:*",
-        "• عدّاد الأذكار التلقائي",
-        "• إحصائيات مفصلة",
-        "• تذكيرات يومية",
-        "• سهولة الاستخدام",
-        "",
-        f"💎 أذكاري: {user_data['total_count']}",
-        "",
-        "انضم الآن: https://t.me/Ryukn_bot"
-    ]
-    
-    share_text = "\n".join(share_lines)
-    
-    # ترميز النص للمشاركة
-    encoded_text = urllib.parse.quote(share_text)
-    share_url = f"https://t.me/share/url?url=https://t.me/Ryukn_bot&text={encoded_text}"
+    async def flush_main_menu(user_id, chat_id):
+        try:
+            main_message = get_main_message(user_id)
+            keyboard = get_main_keyboard(user_id)
+            
+            message_id = user_store.get_message_id(user_id)
+            if message_id is not None:
+                if menu_coalescer.is_rendered(user_id, message_id, keyboard):
+                    menu_coalescer.mark_skipped()
+                    return
+                await abot.edit_message_text(main_message, chat_id, message_id, parse_mode="Markdown", reply_markup=keyboard)
+            else:
+                sent_message = await abot.send_message(chat_id, main_message, parse_mode="Markdown", reply_markup=keyboard)
+                message_id = sent_message.message_id
+                user_store.set_message_id(user_id, message_id)
+            menu_coalescer.mark_rendered(user_id, message_id, keyboard)
+        except asyncio_helper.ApiTelegramException as e:
+            handle_menu_edit_error(user_id, chat_id, e)
+        except Exception as e:
+            logger.error(f"Error updating main menu: {e}")
     
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton(
-            "📤 مشاركة البوت", 
-            url=share_url
-        )
-    )
-    keyboard.add(
-        types.InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")
-    )
+    # المدمج يبقى كما هو، لكن التعديلات المستحقة تُرسل كـ coroutines في هذه الحلقة
+    menu_coalescer.use_event_loop(asyncio.get_running_loop(), flush_main_menu)
     
-    bot.edit_message_text(
-        "📤 *شارك البوت مع أحبابك لنيل الأجر والثواب*\n\n"
-        "اضغط على الزر أدناه لمشاركة البوت عبر التليجرام",
-        call.message.chat.id,
-        call.message.message_id,
-        parse_mode="Markdown",
-        reply_markup=keyboard
-    )
-
-@bot.callback_query_handler(func=lambda call: call.data == 'developer_info')
-def developer_info_callback(call):
-    try:
+    async def delete_message(chat_id, message_id):
+        try:
+            await abot.delete_message(chat_id, message_id)
+        except Exception as e:
+            logger.error(f"Error deleting message: {e}")
+    
+    async def delete_messages(chat_id, message_ids):
+        try:
+            await abot.delete_messages(chat_id, message_ids)
+        except Exception as e:
+            logger.error(f"Error deleting messages: {e}")
+    
+    delayed_actions.use_event_loop(asyncio.get_running_loop(), delete_messages)
+    
+    @abot.chat_member_handler(func=lambda update: update.chat.id == CHANNEL_ID)
+    @instrument_handler
+    async def handle_channel_member_update(update):
+        member = update.new_chat_member
+        membership_cache.set(member.user.id, member.status in SUBSCRIBED_STATUSES)
+    
+    @abot.message_handler(commands=['start'])
+    @instrument_handler
+    async def start(message):
+        user_id = message.from_user.id
+        initialize_user_data(user_id, message.chat.id)
+        
+        if await is_user_subscribed_async(abot, user_id):
+            await show_main_menu(message)
+        else:
+            await show_subscription_message(message)
+    
+    @abot.message_handler(commands=['timezone'])
+    @instrument_handler
+    async def set_timezone_command(message):
+        user_id = message.from_user.id
+        initialize_user_data(user_id, message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await show_subscription_message(message)
+            return
+        await abot.send_message(message.chat.id, await run_blocking(apply_timezone_command, user_id, message.text))
+    
+    @abot.message_handler(commands=['reminders'])
+    @instrument_handler
+    async def set_reminders_command(message):
+        user_id = message.from_user.id
+        initialize_user_data(user_id, message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await show_subscription_message(message)
+            return
+        await abot.send_message(message.chat.id, await run_blocking(apply_reminders_command, user_id, message.text))
+    
+    @router.handler('check_sub')
+    @instrument_handler
+    async def check_subscription(call):
+        user_id = call.from_user.id
+        membership_cache.invalidate(user_id)
+        
+        if await is_user_subscribed_async(abot, user_id):
+            await asyncio.gather(
+                abot.answer_callback_query(call.id, "✅ تم التحقق من الاشتراك بنجاح!"),
+                abot.delete_message(call.message.chat.id, call.message.message_id),
+                show_main_menu(call.message)
+            )
+        else:
+            await asyncio.gather(
+                abot.edit_message_text(
+                    NOT_SUBSCRIBED_MESSAGE,
+                    call.message.chat.id,
+                    call.message.message_id,
+                    reply_markup=NOT_SUBSCRIBED_KEYBOARD
+                ),
+                abot.answer_callback_query(call.id, "❌ يجب الاشتراك أولاً")
+            )
+    
+    @router.handler(*DHIKR_ACTIONS, prefix='dhikr_')
+    @instrument_handler
+    async def handle_dhikr_callback(call):
         user_id = call.from_user.id
         initialize_user_data(user_id, call.message.chat.id)
         
-        if not is_user_subscribed(user_id):
-            bot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً", show_alert=True)
+        if not await is_user_subscribed_async(abot, user_id):
+            await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
             return
         
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(
-            types.InlineKeyboardButton("💬 مراسلة المطور", url="https://t.me/Akio_co")
-        )
-        keyboard.add(
-            types.InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")
-        )
+        action = DHIKR_ACTIONS.get(call.data)
+        if action is not None:
+            counter_key, confirm_msg = action
+            increment_user_counter(user_id, counter_key)
+            # التعديل يُجدول في المدمج ويُرسل بالتوازي مع الإجابة
+            update_main_menu(user_id, call.message.chat.id)
+            await abot.answer_callback_query(call.id, confirm_msg, show_alert=False)
+    
+    @router.handler('show_stats')
+    @instrument_handler
+    async def show_stats(call):
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+            return
         
-        developer_text = (
-            "👨‍💻 معلومات المطور:\n\n"
-            "• الاسم: @Akio_co\n"
-            "• المهمة: تطوير وتحديث البوت\n\n"
-            "🔧 لأي استفسار، اقتراح، أو مشكلة تقنية\n"
-            "📞 تواصل معنا في أي وقت"
+        text = await run_blocking(lambda: build_stats_message(user_id, get_user_data(user_id)))
+        menu_coalescer.discard(user_id)
+        await abot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode="Markdown",
+            reply_markup=BACK_KEYBOARD
         )
+    
+    @router.handler('leaderboard', prefix='leaderboard_')
+    @instrument_handler
+    async def leaderboard_callback(call):
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
         
-        bot.edit_message_text(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=developer_text,
+        if not await is_user_subscribed_async(abot, user_id):
+            await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+            return
+        
+        text, keyboard = await run_blocking(build_leaderboard_message, user_id, leaderboard_page_number(call.data))
+        menu_coalescer.discard(user_id)
+        await abot.edit_message_text(
+            text,
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode="Markdown",
             reply_markup=keyboard
         )
-        
-    except Exception as e:
-        logger.error(f"حدث خطأ في زر المطور: {e}")
-        bot.answer_callback_query(call.id, "❌ حدث خطأ، يرجى المحاولة لاحقاً", show_alert=True)
-
-@bot.callback_query_handler(func=lambda call: call.data == 'back_to_main')
-def back_to_main_callback(call):
-    user_id = call.from_user.id
-    initialize_user_data(user_id, call.message.chat.id)
-    
-    main_message = get_main_message(user_id)
-    keyboard = get_main_keyboard(user_id)
-    
-    bot.edit_message_text(
-        main_message,
-        call.message.chat.id,
-        call.message.message_id,
-        parse_mode="Markdown",
-        reply_markup=keyboard
-    )
-
-# معالج الرسائل النصية
-@bot.message_handler(func=lambda message: True)
-def handle_text_messages(message):
-    user_id = message.from_user.id
-    initialize_user_data(user_id, message.chat.id)
     
-    if not is_user_subscribed(user_id):
-        show_subscription_message(message)
-        return
+    @router.handler('reset_counters')
+    @instrument_handler
+    async def reset_counters_callback(call):
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+            return
+        
+        reset_user_counters(user_id)
+        update_main_menu(user_id, call.message.chat.id)
+        await abot.answer_callback_query(call.id, "✅ تم مسح جميع العدادات بنجاح!", show_alert=True)
     
-    # حذف الرسالة النصية من المستخدم لتجنب التكديس
-    try:
-        bot.delete_message(message.chat.id, message.message_id)
-    except Exception as e:
-        logger.error(f"Error deleting message: {e}")
+    @router.handler('share_bot')
+    @instrument_handler
+    async def share_bot_callback(call):
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً")
+            return
+        
+        menu_coalescer.discard(user_id)
+        await abot.edit_message_text(
+            SHARE_MESSAGE,
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode="Markdown",
+            reply_markup=render_share_keyboard(get_user_data(user_id)['total_count'])
+        )
     
-    # إذا لم تكن هناك رسالة رئيسية، إنشاء واحدة جديدة
-    if user_id not in user_messages:
-        show_main_menu(message)
-    else:
-        # إرسال رسالة تنبيه مؤقتة
+    @router.handler('developer_info')
+    @instrument_handler
+    async def developer_info_callback(call):
         try:
-            temp_msg = bot.send_message(
-                message.chat.id,
-                "❓ استخدم الأزرار أدناه للتنقل في البوت"
+            user_id = call.from_user.id
+            initialize_user_data(user_id, call.message.chat.id)
+            
+            if not await is_user_subscribed_async(abot, user_id):
+                await abot.answer_callback_query(call.id, "❌ يجب الاشتراك في القناة أولاً", show_alert=True)
+                return
+            
+            menu_coalescer.discard(user_id)
+            await abot.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=DEVELOPER_TEXT,
+                reply_markup=DEVELOPER_KEYBOARD
             )
-            # حذف الرسالة المؤقتة بعد 3 ثوانٍ
-            threading.Timer(3.0, lambda: bot.delete_message(message.chat.id, temp_msg.message_id)).start()
         except Exception as e:
-            logger.error(f"Error sending temporary message: {e}")
-
-# ==================== نظام التذكيرات اليومية ====================
-def send_daily_notifications(morning=True):
-    """إرسال تذكيرات يومية لجميع المستخدمين"""
-    try:
-        # نسخ قائمة المستخدمين لتجنب تغييرها أثناء التكرار
-        with data_lock:
-            user_ids = list(users_data.keys())
+            logger.error(f"حدث خطأ في زر المطور: {e}")
+            await abot.answer_callback_query(call.id, "❌ حدث خطأ، يرجى المحاولة لاحقاً", show_alert=True)
+    
+    @router.handler('back_to_main')
+    @instrument_handler
+    async def back_to_main_callback(call):
+        user_id = call.from_user.id
+        initialize_user_data(user_id, call.message.chat.id)
+        keyboard = get_main_keyboard(user_id)
         
-        for user_id in user_ids:
+        menu_coalescer.discard(user_id)
+        await abot.edit_message_text(
+            get_main_message(user_id),
+            call.message.chat.id,
+            call.message.message_id,
+            parse_mode="Markdown",
+            reply_markup=keyboard
+        )
+        menu_coalescer.mark_rendered(user_id, call.message.message_id, keyboard)
+    
+    @abot.message_handler(func=lambda message: True)
+    @instrument_handler
+    async def handle_text_messages(message):
+        user_id = message.from_user.id
+        initialize_user_data(user_id, message.chat.id)
+        
+        if not await is_user_subscribed_async(abot, user_id):
+            await show_subscription_message(message)
+            return
+        
+        if user_store.get_message_id(user_id) is None:
+            await asyncio.gather(
+                delete_message(message.chat.id, message.message_id),
+                show_main_menu(message)
+            )
+        else:
             try:
-                user_data = users_data.get(user_id)
-                if not user_data:
-                    continue
-                    
-                chat_id = user_data.get('chat_id')
-                if chat_id is None:
-                    continue
-                
-                # التحقق من الاشتراك
-                if not is_user_subscribed(user_id):
-                    continue
-                
-                # إعداد الرسالة المناسبة
-                if morning:
-                    # رسالة الصباح
-                    message_text = "🌅 *صباح الخير! حان وقت شروق شمس الأجر* 🌞\n\n"
-                    message_text += "☀️ أسأل الله أن يجعل يومك بركة وذكراً وتقوى\n\n"
-                    message_text += "🌸 *ذكر الصباح المختار:*\n"
-                    message_text += f"➖ {random.choice(morning_dhikr)}\n\n"
-                    message_text += "🌟 *فائدة اليوم:*\n"
-                    message_text += "> \"من قال حين يصبح: سبحان الله وبحمده، مائة مرة، لم يأت أحد يوم القيامة بأفضل مما جاء به إلا أحد قال مثل ذلك أو زاد\" (رواه مسلم)\n\n"
-                    message_text += "📿 استمر في الذكر لتحصد الأجر المضاعف"
-                else:
-                    # رسالة المساء
-                    message_text = "🌄 *مساء الخير! حان وقت غروب شمس الثواب* 🌙\n\n"
-                    message_text += "🌠 أسأل الله أن يغفر لك ذنوبك ويرفع درجاتك\n\n"
-                    message_text += "🌸 *ذكر المساء المختار:*\n"
-                    message_text += f"➖ {random.choice(evening_dhikr)}\n\n"
-                    message_text += "🌟 *فائدة اليوم:*\n"
-                    message_text += "> \"من قال حين يمسي: سبحان الله وبحمده، مائة مرة، لم يأت أحد يوم القيامة بأفضل مما جاء به إلا أحد قال مثل ذلك أو زاد\" (رواه مسلم)\n\n"
-                    message_text += "📿 استمر في الذكر لتحصد الأجر المضاعف"
-                
-                # تصميم زر للوصول السريع للبوت
-                keyboard = types.InlineKeyboardMarkup()
-                keyboard.add(
-                    types.InlineKeyboardButton("📿 افتح بوت الذكر الآن", url="https://t.me/Ryukn_bot")
+                _, temp_msg = await asyncio.gather(
+                    delete_message(message.chat.id, message.message_id),
+                    abot.send_message(message.chat.id, "❓ استخدم الأزرار أدناه للتنقل في البوت")
                 )
-                
-                # إرسال الرسالة بتنسيق جميل
-                bot.send_message(
-                    chat_id,
-                    message_text,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-                
-                # تأجيل صغير لتجنب الضغط على الخادم
-                time.sleep(0.1)
-                
-            except telebot.apihelper.ApiException as e:
-                if e.result.status_code == 403:  # المستخدم حظر البوت
-                    logger.warning(f"User {user_id} blocked the bot. Removing from users_data.")
-                    with data_lock:
-                        if user_id in users_data:
-                            del users_data[user_id]
-                else:
-                    logger.error(f"Error sending notification to user {user_id}: {e}")
+                if not delayed_actions.delete_later(message.chat.id, temp_msg.message_id, TEMP_MESSAGE_TTL):
+                    await delete_message(message.chat.id, temp_msg.message_id)
             except Exception as e:
-                logger.error(f"Error in sending notification to user {user_id}: {e}")
+                logger.error(f"Error sending temporary message: {e}")
     
-    except Exception as e:
-        logger.error(f"Error in daily notifications: {e}")
+    return abot
 
-def schedule_daily_notifications():
-    """جدولة التذكيرات اليومية"""
+async def run_async_bot():
+    """تشغيل البوت والتذكيرات كـ coroutines في حلقة أحداث واحدة"""
+    abot = create_async_bot()
+    load_reminder_slots()
+    scheduler_task = asyncio.get_running_loop().create_task(
+        reminder_scheduler.run_async(functools.partial(fire_reminder_slot_async, abot))
+    )
+    try:
+        await abot.delete_webhook()
+        await abot.infinity_polling(timeout=30, skip_pending=True, allowed_updates=telebot.util.update_types)
+    finally:
+        scheduler_task.cancel()
+        await abot.close_session()
+
+# ==================== وضع العمليات المتعددة ====================
+# الموزع يستقبل التحديثات ويرسل كل تحديث إلى العملية العاملة user_id % SHARD_WORKERS؛
+# كل عملية تملك مستخدمي شريحتها (تخزين وذاكرة مؤقتة وتذكيرات) فلا أقفال بين العمليات
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))
+SHARD_STATS_TIMEOUT = 5.0
+
+def update_user_id(update):
+    """معرف المستخدم صاحب التحديث الخام (dict) لاختيار الشريحة"""
+    member = update.get('chat_member') or update.get('my_chat_member')
+    if member is not None:
+        # from في chat_member هو من نفذ التغيير، والاشتراك يخص new_chat_member
+        return member['new_chat_member']['user']['id']
+    for body in update.values():
+        if isinstance(body, dict) and 'from' in body:
+            return body['from']['id']
+    return update['update_id']
+
+def merge_stats(snapshots):
+    """جمع إحصائيات الشرائح: الأعداد الصحيحة تُجمع والنسب (float) يؤخذ متوسطها"""
+    merged = {}
+    for key, first in snapshots[0].items():
+        values = [snapshot[key] for snapshot in snapshots if key in snapshot]
+        if isinstance(first, dict):
+            merged[key] = merge_stats(values)
+        elif isinstance(first, bool) or not isinstance(first, (int, float)):
+            merged[key] = first
+        elif isinstance(first, int):
+            merged[key] = sum(values)
+        else:
+            merged[key] = round(sum(values) / len(values), 4)
+    return merged
+
+class ShardDispatcher:
+    """تشغيل العمليات العاملة وتوزيع التحديثات الخام عليها حسب user_id"""
+
+    def __init__(self, workers, queue_size, initializer=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        # دالة تُستدعى في كل عملية عاملة قبل المعالجة (لقياسات الأداء)
+        self.initializer = initializer
+        # spawn بدلاً من fork: لا نرث خيوط الموزع ولا اتصالات SQLite المفتوحة
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes = []
+        self._controls = []
+        self._processes = []
+        self._lock = threading.Lock()
+        self.routed = [0] * workers
+        self.rejected = 0
+        # رقم كل طلب إحصائيات: رد متأخر لطلب انتهت مهلته يُتجاهل بدلاً من أن يُقرأ كرد للطلب التالي
+        self._stats_sequence = itertools.count(1)
+
+    def start(self):
+        for index in range(self.workers):
+            inbox = self._context.Queue(self.queue_size)
+            control, child_control = self._context.Pipe()
+            process = self._context.Process(
+                target=run_shard_worker,
+                args=(index, inbox, child_control, self.initializer),
+                name=f"shard-{index}",
+                daemon=True
+            )
+            # العملية الجديدة تقرأ رقم شريحتها من البيئة عند استيراد الوحدة
+            os.environ['SHARD_INDEX'] = str(index)
+            os.environ['SHARD_COUNT'] = str(self.workers)
+            try:
+                process.start()
+            finally:
+                del os.environ['SHARD_INDEX']
+            self._inboxes.append(inbox)
+            self._controls.append((control, threading.Lock()))
+            self._processes.append(process)
+        logger.info(f"Started {self.workers} shard workers")
+        return self
+
+    def route(self, update, block=True):
+        """إرسال تحديث إلى شريحته؛ مع block=False يُرجع False إذا كان طابورها ممتلئاً"""
+        index = update_user_id(update) % self.workers
+        try:
+            self._inboxes[index].put(update, block=block)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.routed[index] += 1
+        return True
+
+    def stats(self):
+        """إحصائيات كل شريحة ومجموعها"""
+        shards = []
+        for index, (control, lock) in enumerate(self._controls):
+            with lock:
+                try:
+                    reply = self._request_stats(control, next(self._stats_sequence))
+                except (OSError, EOFError):
+                    reply = None
+            if reply is not None:
+                shards.append(reply)
+            else:
+                logger.warning(f"Shard {index} did not answer stats request")
+        with self._lock:
+            dispatcher = {
+                'workers': self.workers,
+                'alive': sum(process.is_alive() for process in self._processes),
+                'routed': list(self.routed),
+                'rejected': self.rejected
+            }
+        return {
+            'dispatcher': dispatcher,
+            'total': merge_stats(shards) if shards else {},
+            'shards': shards
+        }
+
+    def _request_stats(self, control, sequence):
+        """يُستدعى مع قفل قناة التحكم؛ None إذا لم يصل الرد خلال المهلة"""
+        control.send(('stats', sequence))
+        deadline = time.monotonic() + SHARD_STATS_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not control.poll(remaining):
+                return None
+            reply_sequence, stats = control.recv()
+            if reply_sequence == sequence:
+                return stats
+
+    def stop(self, timeout=10):
+        """إيقاف العمليات العاملة بعد إنهاء طوابيرها حتى تُفرغ بياناتها"""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Shard {process.name} did not stop in time")
+                process.terminate()
+
+def serve_shard_control(control):
+    """الرد على طلبات الإحصائيات من الموزع"""
     while True:
         try:
-            now = datetime.utcnow()
-            current_hour = now.hour
-            current_minute = now.minute
-            
-            # تذكير الصباح الساعة 7 صباحاً (توقيت غرينتش)
-            if current_hour == 7 and current_minute == 0:
-                send_daily_notifications(morning=True)
-                logger.info("Sent morning notifications")
-            
-            # تذكير المساء الساعة 7 مساءً (توقيت غرينتش)
-            elif current_hour == 19 and current_minute == 0:
-                send_daily_notifications(morning=False)
-                logger.info("Sent evening notifications")
-            
-            # الانتظار 60 ثانية قبل التحقق مرة أخرى
-            time.sleep(60)
-            
+            command = control.recv()
+        except (EOFError, OSError):
+            return
+        name, sequence = command
+        if name == 'stats':
+            control.send((sequence, collect_stats()))
+
+def run_shard_worker(index, inbox, control, initializer=None):
+    """نقطة دخول العملية العاملة: معالجة تحديثات شريحتها وتذكيرات مستخدميها"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if initializer is not None:
+        initializer()
+    logger.info(f"Shard {index}/{SHARD_COUNT} started (pid {os.getpid()})")
+    bot.threaded = False
+    threading.Thread(target=serve_shard_control, args=(control,), daemon=True).start()
+    threading.Thread(target=schedule_daily_notifications, daemon=True).start()
+    try:
+        while True:
+            update = inbox.get()
+            if update is None:
+                break
+            # الانتظار عند امتلاء الطابور المحلي يوقف الموزع بدلاً من إسقاط التحديثات
+            update_queue.submit(types.Update.de_json(update), block=True)
+        update_queue.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        user_store.close()
+
+def poll_updates_to_shards():
+    """استطلاع التحديثات في الموزع وتوزيعها دون تحليلها"""
+    bot.remove_webhook()
+    # مثل skip_pending: تجاهل التحديثات المتراكمة قبل التشغيل
+    pending = telebot.apihelper.get_updates(BOT_TOKEN, offset=-1)
+    offset = pending[-1]['update_id'] + 1 if pending else None
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(
+                BOT_TOKEN, offset, timeout=40,
+                allowed_updates=telebot.util.update_types, long_polling_timeout=30
+            )
         except Exception as e:
-            logger.error(f"Error in notification scheduler: {e}")
-            time.sleep(60)  # انتظار قبل إعادة المحاولة
+            logger.error(f"Error polling updates: {e}")
+            time.sleep(1)
+            continue
+        for update in updates:
+            offset = update['update_id'] + 1
+            shard_dispatcher.route(update)
 
-def run_flask_app():
-    """تشغيل خادم Flask"""
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
+def run_shard_dispatcher():
+    """تشغيل العمليات العاملة ثم استقبال التحديثات (polling أو webhook) وتوزيعها"""
+    shard_dispatcher.start()
+    try:
+        if BOT_MODE == 'webhook':
+            start_webhook()
+            run_flask_app()
+        else:
+            web_thread = threading.Thread(target=run_flask_app, daemon=True)
+            web_thread.start()
+            poll_updates_to_shards()
+    finally:
+        shard_dispatcher.stop()
+
+shard_dispatcher = ShardDispatcher(SHARD_WORKERS, SHARD_QUEUE_SIZE) if SHARD_WORKERS and SHARD_INDEX is None else None
 
 # تشغيل البوت
 if __name__ == '__main__':
+    # أوامر التصدير والاستيراد تعمل على التخزين ثم تخرج دون تشغيل البوت
+    if sys.argv[1:2] in (['export'], ['import']):
+        sys.exit(run_data_command(sys.argv[1:]))
+    
     try:
         logger.info("Starting bot...")
         
-        # بدء خيط خادم الويب
-        web_thread = threading.Thread(target=run_flask_app, daemon=True)
-        web_thread.start()
+        # تحويل SIGTERM (إيقاف الحاوية) إلى خروج طبيعي حتى يتم تفريغ البيانات
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         
-        # بدء خيط التذكيرات اليومية
-        notification_thread = threading.Thread(target=schedule_daily_notifications, daemon=True)
-        notification_thread.start()
+        # بدء خيط التذكيرات اليومية (وضع asyncio يشغلها كـ coroutine، والعمليات العاملة لكل شريحة)
+        if BOT_MODE != 'async' and not SHARD_WORKERS:
+            notification_thread = threading.Thread(target=schedule_daily_notifications, daemon=True)
+            notification_thread.start()
         
-        # تشغيل البوت
-        bot.infinity_polling(none_stop=True, timeout=30)
+        if SHARD_WORKERS:
+            # الموزع يستقبل التحديثات فقط والمعالجة في العمليات العاملة
+            run_shard_dispatcher()
+        elif BOT_MODE == 'async':
+            # المعالجات والبث والتذكيرات كلها في حلقة asyncio واحدة
+            web_thread = threading.Thread(target=run_flask_app, daemon=True)
+            web_thread.start()
+            asyncio.run(run_async_bot())
+        elif BOT_MODE == 'webhook':
+            # استقبال التحديثات عبر Flask في الخيط الرئيسي
+            start_webhook()
+            run_flask_app()
+        else:
+            # بدء خيط خادم الويب
+            web_thread = threading.Thread(target=run_flask_app, daemon=True)
+            web_thread.start()
+            
+            # تشغيل البوت
+            # تضمين تحديثات chat_member لإبطال ذاكرة الاشتراك المؤقتة
+            bot.remove_webhook()
+            bot.infinity_polling(none_stop=True, timeout=30, allowed_updates=telebot.util.update_types)
     except Exception as e:
         logger.error(f"Bot stopped: {e}")
+    finally:
+        # تفريغ التغييرات المعلقة إلى التخزين الدائم
+        user_store.close()